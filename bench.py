@@ -0,0 +1,294 @@
+# bench.py — Chartify performance benchmarks (JSON output for regression tracking)
+# -----------------------------------------------------------------------
+# Usage:
+#   python bench.py                      # full suite, JSON to stdout
+#   python bench.py --quick --out bench.json
+#   python bench.py --only history,chat --sizes 10,1000
+#   python bench.py --latency 0.2        # slower fake model backend
+#
+# Runs in a throwaway directory with its own history/chat/cache databases,
+# so nothing here touches real data. Model calls go to the in-process stub
+# backend (deterministic text after --latency seconds), never the network.
+# -----------------------------------------------------------------------
+
+import os
+import io
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import statistics
+import subprocess
+from datetime import datetime
+from typing import List, Dict, Any, Callable, Optional
+
+from PIL import Image, ImageDraw
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+SUITES = ["decode", "thumbnails", "pdf", "history", "chat", "e2e"]
+
+
+class FakeUpload:
+    """Just enough of Streamlit's UploadedFile for decode_uploaded_files."""
+
+    def __init__(self, name: str, data: bytes):
+        self.name = name
+        self.file_id = name
+        self._data = data
+
+    def getvalue(self) -> bytes:
+        return self._data
+
+
+def make_chart(w: int, h: int, fmt: str = "PNG", seed: int = 0) -> bytes:
+    """A synthetic bar chart (flat colours + gridlines, like real exports)."""
+    img = Image.new("RGB", (w, h), (255, 255, 255))
+    draw = ImageDraw.Draw(img)
+    for y in range(0, h, max(1, h // 10)):
+        draw.line([(0, y), (w, y)], fill=(230, 230, 230), width=1)
+    bars = 12
+    bw = w // (bars * 2)
+    for i in range(bars):
+        bh = int(h * (0.15 + 0.7 * ((i * 37 + seed * 11) % 100) / 100.0))
+        x = bw // 2 + i * 2 * bw
+        draw.rectangle([x, h - bh, x + bw, h - 1], fill=((40 + seed * 13) % 255, 110, 200))
+    buf = io.BytesIO()
+    img.save(buf, format=fmt, **({"quality": 90} if fmt in ("JPEG", "WEBP") else {}))
+    return buf.getvalue()
+
+
+def measure(fn: Callable[[], Any], repeat: int, warmup: int = 1,
+            setup: Optional[Callable[[], None]] = None) -> Dict[str, float]:
+    """Wall-clock stats (ms) over `repeat` runs; `setup` runs untimed before each."""
+    for _ in range(warmup):
+        if setup:
+            setup()
+        fn()
+    samples = []
+    for _ in range(repeat):
+        if setup:
+            setup()
+        t0 = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - t0) * 1000.0)
+    samples.sort()
+    return {
+        "repeat": repeat,
+        "mean_ms": round(statistics.fmean(samples), 3),
+        "p50_ms": round(samples[len(samples) // 2], 3),
+        "p95_ms": round(samples[min(len(samples) - 1, int(len(samples) * 0.95))], 3),
+        "min_ms": round(samples[0], 3),
+        "max_ms": round(samples[-1], 3),
+    }
+
+
+class Bench:
+    def __init__(self, args):
+        self.args = args
+        self.results: List[Dict[str, Any]] = []
+
+    def record(self, suite: str, name: str, stats: Dict[str, float], **params) -> None:
+        row = {"suite": suite, "name": name, "params": params, **stats}
+        self.results.append(row)
+        print(f"  {suite:<10} {name:<34} {json.dumps(params):<44} mean {stats['mean_ms']:>10.3f} ms",
+              file=sys.stderr, flush=True)
+
+    def repeat(self, n: int) -> int:
+        return max(1, n // 3) if self.args.quick else n
+
+    # ---- image paths ----------------------------------------------------
+    def bench_decode(self, tools) -> None:
+        for w, h in [(640, 480), (1920, 1080), (3840, 2160)]:
+            for fmt in ["PNG", "JPEG", "WEBP"]:
+                files = [FakeUpload(f"c{i}.{fmt.lower()}", make_chart(w, h, fmt, seed=i)) for i in range(4)]
+                size = sum(len(f.getvalue()) for f in files)
+                params = {"size": f"{w}x{h}", "format": fmt, "files": len(files), "input_bytes": size}
+                self.record("decode", "decode_uploaded_files", measure(
+                    lambda: tools.decode_uploaded_files(files), self.repeat(10)), **params)
+
+                def _payload():
+                    for rec in tools.decode_uploaded_files(files):
+                        rec["b64"]               # preprocess + encode the model payload
+                self.record("decode", "decode+model_payload", measure(
+                    _payload, self.repeat(5), setup=tools._UPLOAD_VIEWS.clear), **params)
+
+    def bench_thumbnails(self, tools) -> None:
+        for w, h in [(1920, 1080), (3840, 2160)]:
+            recs = tools.decode_uploaded_files([FakeUpload(f"c{i}.png", make_chart(w, h, seed=i)) for i in range(8)])
+            self.record("thumbnails", "make_thumbnails", measure(
+                lambda: tools.make_thumbnails(recs), self.repeat(5), setup=tools._UPLOAD_VIEWS.clear),
+                size=f"{w}x{h}", charts=len(recs))
+            self.record("thumbnails", "make_thumbnails(cached)", measure(
+                lambda: tools.make_thumbnails(recs), self.repeat(5)), size=f"{w}x{h}", charts=len(recs))
+        jpegs = tools.decode_uploaded_files(
+            [FakeUpload(f"j{i}.jpg", make_chart(3840, 2160, "JPEG", seed=i)) for i in range(30)])
+        self.record("thumbnails", "make_thumbnails", measure(
+            lambda: tools.make_thumbnails(jpegs), self.repeat(5), setup=tools._UPLOAD_VIEWS.clear),
+            size="3840x2160", format="JPEG", charts=len(jpegs))
+
+    def bench_pdf(self, tools) -> None:
+        summary = "\n\n".join(f"**Chart {i}**\n- Revenue up {i}%\n- Costs flat" for i in range(16))
+        for n in [4, 16]:
+            recs = tools.decode_uploaded_files([FakeUpload(f"c{i}.png", make_chart(1920, 1080, seed=i)) for i in range(n)])
+            self.record("pdf", "build_pdf_bytes", measure(
+                lambda: tools.build_pdf_bytes(recs, summary), self.repeat(3)), charts=n)
+
+    # ---- storage --------------------------------------------------------
+    def bench_history(self, tools) -> None:
+        def payload(i: int) -> Dict[str, Any]:
+            return {
+                "analysis_mode": "Single Chart Analysis",
+                "analysis_summary": f"**chart_{i}.png**\n\n- Revenue rose {i % 40}% quarter on quarter",
+                "analysis_details": [{"name": f"chart_{i}.png", "insight": f"- Revenue rose {i % 40}%"}],
+                "combined_insight": "",
+                "thumbnails": [],
+            }
+
+        seeded = 0
+        for n in self.args.sizes:
+            t0 = time.perf_counter()
+            while seeded < n:
+                tools.save_analysis(payload(seeded))
+                seeded += 1
+            print(f"  (history seeded to {n} in {time.perf_counter() - t0:.1f}s)", file=sys.stderr)
+            counter = [seeded]
+
+            def _save():
+                tools.save_analysis(payload(counter[0]))
+                counter[0] += 1
+            self.record("history", "save_analysis", measure(_save, self.repeat(30)), records=n)
+            seeded = counter[0]
+            self.record("history", "load_analyses", measure(
+                tools.load_analyses, self.repeat(5) if n < 100_000 else 1), records=n)
+            self.record("history", "list_analyses(page)", measure(
+                lambda: tools.list_analyses(0, 20), self.repeat(30)), records=n)
+            self.record("history", "load_latest_analysis", measure(
+                tools.load_latest_analysis, self.repeat(30)), records=n)
+            self.record("history", "search_analyses", measure(
+                lambda: tools.search_analyses("revenue rose", k=20), self.repeat(30)), records=n)
+
+    def bench_chat(self, storage) -> None:
+        for n in self.args.sizes:
+            tid = storage.create_thread("bench-user", f"bench {n}")
+            for start in range(0, n, 1000):
+                batch = [{"role": "user" if (start + i) % 2 == 0 else "assistant",
+                          "content": f"Message {start + i}: why did revenue change in Q{(start + i) % 4 + 1}?"}
+                         for i in range(min(1000, n - start))]
+                storage.save_messages(tid, batch)
+            turn = [{"role": "user", "content": "And costs?"}, {"role": "assistant", "content": "Costs were flat."}]
+            self.record("chat", "save_messages(2)", measure(
+                lambda: storage.save_messages(tid, turn), self.repeat(30)), messages=n)
+            self.record("chat", "load_messages", measure(
+                lambda: storage.load_messages(tid), self.repeat(10) if n < 100_000 else 3), messages=n)
+
+    # ---- end to end -----------------------------------------------------
+    def bench_e2e(self, tools) -> None:
+        audience, style = "Business Professional", "Structured (bulleted)"
+        run = [0]
+
+        def _fresh(n: int):
+            # new pixels every run so the insight cache never answers
+            run[0] += 1
+            return tools.decode_uploaded_files(
+                [FakeUpload(f"e{run[0]}_{i}.png", make_chart(1280, 720, seed=run[0] * 100 + i)) for i in range(n)])
+
+        for n in [1, 8, 32]:
+            batch: Dict[str, Any] = {}
+
+            def _single():
+                list(tools.iter_individual_insights(batch["recs"], audience, tools.STUB_MODEL, style))
+            self.record("e2e", "single", measure(
+                _single, self.repeat(3), setup=lambda: batch.update(recs=_fresh(n))),
+                charts=n, latency_s=self.args.latency)
+
+        for n in [4, 8, 24]:
+            batch = {}
+
+            def _cross():
+                tools.generate_cross_chart_insight(batch["recs"], audience, tools.STUB_MODEL, style)
+            self.record("e2e", "cross" if n <= tools.CROSS_MAP_REDUCE_THRESHOLD else "cross(map-reduce)", measure(
+                _cross, self.repeat(3), setup=lambda: batch.update(recs=_fresh(n))),
+                charts=n, latency_s=self.args.latency)
+
+
+def _git_rev() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR,
+                              capture_output=True, text=True, timeout=5).stdout.strip()
+    except Exception:
+        return ""
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Chartify hot-path benchmarks (JSON output).")
+    parser.add_argument("--only", default=",".join(SUITES), help=f"Comma-separated suites from {SUITES}.")
+    parser.add_argument("--sizes", default="10,1000,100000", help="Record counts for history/chat suites.")
+    parser.add_argument("--latency", type=float, default=0.05, help="Fake backend latency per call (s).")
+    parser.add_argument("--quick", action="store_true", help="Fewer repeats and sizes ≤ 1000.")
+    parser.add_argument("--out", default="", help="Write JSON here instead of stdout.")
+    args = parser.parse_args(argv)
+    args.sizes = sorted(int(s) for s in args.sizes.split(",") if s.strip())
+    if args.quick:
+        args.sizes = [s for s in args.sizes if s <= 1000] or [10]
+    suites = [s for s in args.only.split(",") if s in SUITES]
+
+    # Isolated working directory: set paths before tools/storage open their databases
+    workdir = tempfile.mkdtemp(prefix="chartify-bench-")
+    out_path = os.path.abspath(args.out) if args.out else ""
+    os.environ.update({
+        "HISTORY_DB_PATH": os.path.join(workdir, "history.sqlite3"),
+        "CHAT_DB_PATH": os.path.join(workdir, "chat.sqlite3"),
+        "INSIGHT_CACHE_PATH": os.path.join(workdir, "cache.sqlite3"),
+        "THUMBNAIL_DIR": os.path.join(workdir, "thumbnails"),
+        "PENDING_UPLOAD_DIR": os.path.join(workdir, "pending_uploads"),
+        "STUB_LATENCY_S": str(args.latency),
+    })
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    sys.path.insert(0, REPO_DIR)
+    try:
+        import tools
+        import storage
+
+        bench = Bench(args)
+        started = time.perf_counter()
+        for suite in suites:
+            print(f"[{suite}]", file=sys.stderr, flush=True)
+            if suite == "chat":
+                bench.bench_chat(storage)
+            else:
+                getattr(bench, f"bench_{suite}")(tools)
+
+        report = {
+            "meta": {
+                "timestamp": datetime.now().isoformat(timespec="seconds"),
+                "git_rev": _git_rev(),
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "cpu_count": os.cpu_count(),
+                "suites": suites,
+                "sizes": args.sizes,
+                "latency_s": args.latency,
+                "quick": args.quick,
+                "elapsed_s": round(time.perf_counter() - started, 2),
+            },
+            "results": bench.results,
+        }
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    text = json.dumps(report, indent=2)
+    if out_path:
+        with open(out_path, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
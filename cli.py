@@ -0,0 +1,294 @@
+# cli.py — Chartify headless batch analysis (no Streamlit UI)
+# -----------------------------------------------------------------------
+# Usage:
+#   python cli.py analyze ./dashboards --out runs/nightly
+#   python cli.py analyze "exports/**/*.png" --mode cross --pdf
+#   python cli.py analyze ./dashboards --stub           # offline dry run
+#   python cli.py export --format md --out history.zip
+#
+# analyze writes into --out:
+#   manifest.jsonl   one line per chart/run (sha, settings, insight or error);
+#                    re-running skips charts already analyzed with the same settings
+#   insights/        one Markdown file per chart (single) or per run (cross)
+#   reports/         PDF reports (with --pdf)
+# Each batch is also saved to the analysis history, like a run from the app.
+# -----------------------------------------------------------------------
+
+import os
+import sys
+import glob
+import json
+import argparse
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import List, Dict, Any, Iterator, Set, Tuple
+
+import tools
+from tools import (
+    MODEL_CHOICES, STUB_MODEL, Insight, UploadRecord,
+    decode_chart_files, iter_individual_insights, generate_cross_chart_insight,
+    make_thumbnails, save_analysis, build_pdf_bytes,
+    preprocess_signature, export_history_pdf, export_history_markdown_zip,
+)
+
+IMAGE_EXTS = (".png", ".jpg", ".jpeg", ".webp", ".bmp")
+AUDIENCES = ["Business Professional", "Data Scientist"]          # the values the prompts branch on
+AUDIENCE_ALIASES = {"Business Person": "Business Professional", "Tech Person": "Data Scientist"}  # UI labels
+STYLES = ["Structured (bulleted)", "Narrative (story)"]
+
+
+def _log(msg: str) -> None:
+    print(msg, file=sys.stderr, flush=True)
+
+
+def discover(inputs: List[str]) -> List[str]:
+    """Directories (recursive) and glob patterns → sorted, de-duplicated image paths."""
+    found: Set[str] = set()
+    for item in inputs:
+        if os.path.isdir(item):
+            for root, _, names in os.walk(item):
+                found.update(os.path.join(root, n) for n in names if n.lower().endswith(IMAGE_EXTS))
+        else:
+            found.update(p for p in glob.glob(item, recursive=True)
+                         if os.path.isfile(p) and p.lower().endswith(IMAGE_EXTS))
+    return sorted(found)
+
+
+def _chunks(items: List[str], size: int) -> Iterator[List[str]]:
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+class Manifest:
+    """Append-only JSONL progress log; a crash loses at most the line being written."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.entries: List[Dict[str, Any]] = []
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        self.entries.append(json.loads(line))
+                    except ValueError:
+                        continue            # torn last line from an interrupted run
+        self._fh = open(path, "a", encoding="utf-8")
+
+    def done(self, settings: str) -> Set[str]:
+        """Keys analyzed successfully under these settings (errors are retried)."""
+        return {e["key"] for e in self.entries if e.get("settings") == settings and not e.get("error")}
+
+    def insights(self, settings: str) -> Dict[str, str]:
+        return {e["key"]: e["insight"] for e in self.entries if e.get("settings") == settings and e.get("insight")}
+
+    def append(self, entry: Dict[str, Any]) -> None:
+        self.entries.append(entry)
+        self._fh.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        self._fh.flush()
+
+    def close(self) -> None:
+        self._fh.close()
+
+
+def _settings(mode: str, args) -> str:
+    return "|".join([mode, args.model, args.audience, args.style, preprocess_signature()])
+
+
+def _stem(name: str, sha: str) -> str:
+    return f"{os.path.splitext(name)[0]}-{sha[:8]}"
+
+
+def _write(path: str, data, mode: str = "w") -> None:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f"{path}.tmp"
+    with open(tmp, mode, **({} if "b" in mode else {"encoding": "utf-8"})) as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+def _finish_batch(args, mode: str, recs: List[UploadRecord], details: List[Dict[str, Any]],
+                  summary: str, combined: str, routing: List[Dict[str, Any]], tag: str) -> None:
+    """History record + optional PDF for one completed batch."""
+    if not summary:
+        return
+    if not args.no_save:
+        save_analysis({
+            "analysis_mode": mode,
+            "analysis_summary": summary,
+            "analysis_details": details,
+            "combined_insight": combined,
+            "thumbnails": make_thumbnails(recs),
+            "routing": routing,
+        })
+    if args.pdf:
+        ok = {d["name"] for d in details if not d.get("error")} if details else None
+        pdf_recs = [r for r in recs if ok is None or r.name in ok]
+        _write(os.path.join(args.out, "reports", f"{tag}.pdf"), build_pdf_bytes(pdf_recs, summary), "wb")
+
+
+def _record_rejected(rejected: List[Tuple[str, str]], settings: str, manifest: Manifest) -> int:
+    """Log + manifest every input that could not be read or decoded; returns how many."""
+    for path, reason in rejected:
+        _log(f"{path}: FAILED ({reason})")
+        manifest.append({"key": f"path:{os.path.abspath(path)}", "name": os.path.basename(path),
+                         "settings": settings, "ts": datetime.now().isoformat(), "error": reason})
+    return len(rejected)
+
+
+def run_single(args, paths: List[str], manifest: Manifest) -> Dict[str, int]:
+    settings = _settings("single", args)
+    done = manifest.done(settings)
+    stats = {"analyzed": 0, "skipped": 0, "failed": 0}
+    stamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+
+    # Decode batch k+1 on a helper thread while batch k is with the model
+    with ThreadPoolExecutor(max_workers=1, thread_name_prefix="decode") as prefetch:
+        batches = list(_chunks(paths, args.batch_size))
+        rejected: List[List[Tuple[str, str]]] = [[] for _ in batches]     # per batch, filled by the prefetch
+        pending = prefetch.submit(decode_chart_files, batches[0], rejected[0]) if batches else None
+        for b in range(len(batches)):
+            recs = pending.result()
+            pending = (prefetch.submit(decode_chart_files, batches[b + 1], rejected[b + 1])
+                       if b + 1 < len(batches) else None)
+            stats["failed"] += _record_rejected(rejected[b], settings, manifest)
+
+            todo = [r for r in recs if r.sha not in done]
+            stats["skipped"] += len(recs) - len(todo)
+            if not todo:
+                continue
+            insights = [Insight("")] * len(todo)
+            routes: List[Dict[str, Any]] = [{} for _ in todo]
+            for i, result in iter_individual_insights(todo, args.audience, args.model, args.style,
+                                                      max_workers=args.workers, routes=routes):
+                rec = todo[i]
+                insights[i] = result
+                entry = {"key": rec.sha, "name": rec.name, "settings": settings, "ts": datetime.now().isoformat()}
+                if result.failed:
+                    stats["failed"] += 1
+                    entry["error"] = result.error or "No insights generated."
+                else:
+                    stats["analyzed"] += 1
+                    entry["insight"] = result.text
+                    done.add(rec.sha)
+                    _write(os.path.join(args.out, "insights", f"{_stem(rec.name, rec.sha)}.md"),
+                           f"# {rec.name}\n\n{result.text}\n")
+                manifest.append(entry)
+                n = stats["analyzed"] + stats["failed"]
+                _log(f"[{n + stats['skipped']}/{len(paths)}] {rec.name}: {'FAILED' if 'error' in entry else 'ok'}")
+
+            details, blocks = [], []
+            for rec, result in zip(todo, insights):
+                if result.failed:
+                    details.append({"name": rec.name, "insight": "", "error": result.error or "No insights generated."})
+                else:
+                    details.append({"name": rec.name, "insight": result.text})
+                    blocks.append(f"**{rec.name}**\n\n{result.text}")
+            _finish_batch(
+                args, "Single Chart Analysis", todo, details, "\n\n---\n\n".join(blocks), "",
+                [{"name": r.name, **route} for r, route in zip(todo, routes)], f"single-{stamp}-{b + 1:04d}",
+            )
+    return stats
+
+
+def run_cross(args, paths: List[str], manifest: Manifest) -> Dict[str, int]:
+    settings = _settings("cross", args)
+    rejected: List[Tuple[str, str]] = []
+    recs = decode_chart_files(paths, rejected)
+    failed = _record_rejected(rejected, settings, manifest)
+    if not recs:
+        return {"analyzed": 0, "skipped": 0, "failed": failed}
+    key = hashlib.sha256("|".join(sorted(r.sha for r in recs)).encode()).hexdigest()
+    if key in manifest.done(settings):
+        _log(f"Cross analysis of these {len(recs)} charts already done — skipping.")
+        return {"analyzed": 0, "skipped": len(recs), "failed": failed}
+
+    _log(f"Cross analysis of {len(recs)} chart(s)…")
+    route: Dict[str, Any] = {}
+    existing = manifest.insights(_settings("single", args))    # per-chart results from earlier single runs
+    result = generate_cross_chart_insight(recs, args.audience, args.model, args.style, route=route, existing=existing)
+    entry = {"key": key, "name": f"{len(recs)} charts", "settings": settings, "ts": datetime.now().isoformat()}
+    if result.failed:
+        entry["error"] = result.error or "No insights generated."
+        manifest.append(entry)
+        _log(entry["error"])
+        return {"analyzed": 0, "skipped": 0, "failed": len(recs) + failed}
+    text = entry["insight"] = result.text
+    manifest.append(entry)
+    _write(os.path.join(args.out, "insights", f"cross-{key[:12]}.md"),
+           "# Cross-chart analysis\n\n" + "\n".join(f"- {r.name}" for r in recs) + f"\n\n{text}\n")
+    _finish_batch(args, "Cross Chart Analysis", recs, [], text, text, [route], f"cross-{key[:12]}")
+    return {"analyzed": len(recs), "skipped": 0, "failed": failed}
+
+
+def cmd_analyze(args) -> int:
+    if args.stub:
+        args.model = STUB_MODEL
+    if args.stub_latency is not None:
+        tools.STUB_LATENCY_S = args.stub_latency
+    paths = discover(args.inputs)
+    if args.limit:
+        paths = paths[:args.limit]
+    if not paths:
+        _log("No chart images found.")
+        return 2
+    os.makedirs(args.out, exist_ok=True)
+    manifest = Manifest(os.path.join(args.out, "manifest.jsonl"))
+    _log(f"{len(paths)} chart(s) • {args.mode} • {args.model} → {args.out}")
+    try:
+        run = run_cross if args.mode == "cross" else run_single
+        stats = run(args, paths, manifest)
+    finally:
+        manifest.close()
+    _log(f"Done: {stats['analyzed']} analyzed, {stats['skipped']} skipped (already done), {stats['failed']} failed.")
+    return 1 if stats["failed"] else 0
+
+
+def cmd_export(args) -> int:
+    ids = [int(x) for x in args.ids.split(",")] if args.ids else None
+    export = export_history_pdf if args.format == "pdf" else export_history_markdown_zip
+
+    def _tick(k: int) -> None:
+        if k % 50 == 0:
+            _log(f"exported {k}…")
+
+    n = export(args.out, ids=ids, progress=_tick)
+    _log(f"Exported {n} run(s) → {args.out}")
+    return 0
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(prog="chartify", description="Headless chart analysis.")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    an = sub.add_parser("analyze", help="Analyze a directory or glob of chart images.")
+    an.add_argument("inputs", nargs="+", help="Directories (searched recursively) and/or glob patterns.")
+    an.add_argument("--out", default="chartify_out", help="Output directory (manifest, insights, reports).")
+    an.add_argument("--mode", choices=["single", "cross"], default="single")
+    an.add_argument("--model", default=MODEL_CHOICES[0], help=f"One of {MODEL_CHOICES} or '{STUB_MODEL}'.")
+    an.add_argument("--audience", choices=AUDIENCES, default=AUDIENCES[0],
+                    type=lambda a: AUDIENCE_ALIASES.get(a, a))
+    an.add_argument("--style", choices=STYLES, default=STYLES[0])
+    an.add_argument("--workers", type=int, default=None, help="Concurrent model calls (default ANALYSIS_MAX_WORKERS).")
+    an.add_argument("--batch-size", type=int, default=50, help="Charts per history record / report (single mode).")
+    an.add_argument("--limit", type=int, default=0, help="Analyze at most N charts.")
+    an.add_argument("--pdf", action="store_true", help="Also write a PDF report per batch.")
+    an.add_argument("--no-save", action="store_true", help="Do not add runs to the analysis history.")
+    an.add_argument("--stub", action="store_true", help="Offline: use the built-in stub backend (no failover).")
+    an.add_argument("--stub-latency", type=float, default=None, help="Stub response time in seconds.")
+    an.set_defaults(func=cmd_analyze)
+
+    ex = sub.add_parser("export", help="Export saved runs to one PDF or a zip of Markdown files.")
+    ex.add_argument("--format", choices=["pdf", "md"], default="pdf")
+    ex.add_argument("--out", required=True, help="Output file (.pdf or .zip).")
+    ex.add_argument("--ids", default="", help="Comma-separated history ids (default: all runs).")
+    ex.set_defaults(func=cmd_export)
+
+    args = parser.parse_args(argv)
+    if getattr(args, "batch_size", 1) < 1:
+        parser.error("--batch-size must be at least 1")
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
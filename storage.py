@@ -1,71 +1,299 @@
+import os
+import json
 import uuid
+import sqlite3
+import threading
+from contextlib import contextmanager
 from datetime import datetime
 from typing import List, Dict, Any
-from tinydb import TinyDB, Query
 
-_DB = TinyDB("chat_threads_db.json")
+CHAT_DB_PATH = os.getenv("CHAT_DB_PATH", "chat_threads.sqlite3")
+LEGACY_CHAT_JSON = "chat_threads_db.json"
+
+# threads.next_seq is the per-thread message counter; messages are keyed
+# (thread_id, seq), so appends and loads never scan other threads.
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    user_id      TEXT PRIMARY KEY,
+    display_name TEXT NOT NULL DEFAULT '',
+    created_at   TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS threads (
+    thread_id  TEXT PRIMARY KEY,
+    user_id    TEXT NOT NULL,
+    title      TEXT NOT NULL,
+    created_at TEXT NOT NULL,
+    updated_at TEXT NOT NULL,
+    next_seq   INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS ix_threads_user_updated ON threads(user_id, updated_at);
+CREATE TABLE IF NOT EXISTS messages (
+    thread_id TEXT NOT NULL,
+    seq       INTEGER NOT NULL,
+    role      TEXT NOT NULL,
+    content   TEXT NOT NULL,
+    ts        TEXT NOT NULL,
+    PRIMARY KEY (thread_id, seq)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+"""
+
+_LOCK = threading.Lock()
+_DB = sqlite3.connect(CHAT_DB_PATH, check_same_thread=False, isolation_level=None)
+_DB.execute("PRAGMA journal_mode=WAL")
+_DB.execute("PRAGMA synchronous=NORMAL")
+_DB.executescript(_SCHEMA)
+
+# Local full-text retrieval over saved analyses + chat messages (FTS5, BM25-ranked).
+# kind = "analysis" (ref = history id) | "message" (ref = "<thread_id>:<seq>")
+try:
+    _DB.execute(
+        "CREATE VIRTUAL TABLE IF NOT EXISTS search_index USING fts5("
+        " kind UNINDEXED, ref UNINDEXED, ts UNINDEXED, title, body, tokenize = 'porter unicode61')"
+    )
+    SEARCH_ENABLED = True
+except sqlite3.OperationalError:  # SQLite built without FTS5
+    SEARCH_ENABLED = False
 
 def _now_iso():
     return datetime.utcnow().isoformat()
 
+@contextmanager
+def _tx(mode: str = ""):
+    """Hold _LOCK for one transaction on _DB; an exception rolls it back so the connection stays usable."""
+    with _LOCK:
+        _DB.execute(f"BEGIN {mode}".strip())
+        try:
+            yield
+        except BaseException:
+            _DB.execute("ROLLBACK")
+            raise
+        _DB.execute("COMMIT")
+
+def _thread_doc(row) -> Dict[str, Any]:
+    return {"thread_id": row[0], "user_id": row[1], "title": row[2], "created_at": row[3], "updated_at": row[4]}
+
+def migrate_tinydb_chat(json_path: str = LEGACY_CHAT_JSON) -> int:
+    """
+    One-shot import of the old TinyDB file (users/threads/messages tables).
+    Returns the number of imported messages; a meta marker prevents re-runs
+    (re-checked under the write lock, so concurrent starts import once).
+    """
+    marker = f"migrated:{os.path.abspath(json_path)}"
+    with _LOCK:
+        if _DB.execute("SELECT 1 FROM meta WHERE key = ?", (marker,)).fetchone():
+            return 0
+    if not os.path.exists(json_path):
+        return 0
+    try:
+        with open(json_path, "r", encoding="utf-8") as f:
+            raw = json.load(f)
+    except (OSError, ValueError):
+        return 0
+
+    users = list((raw.get("users") or {}).values())
+    threads = list((raw.get("threads") or {}).values())
+    # stable sort: messages sharing an "order" value keep their file order and all get their own seq
+    messages = sorted((raw.get("messages") or {}).values(), key=lambda m: (m.get("thread_id", ""), m.get("order", 0)))
+
+    with _tx("IMMEDIATE"):
+        if _DB.execute("SELECT 1 FROM meta WHERE key = ?", (marker,)).fetchone():
+            return 0
+        _DB.executemany(
+            "INSERT OR IGNORE INTO users (user_id, display_name, created_at) VALUES (?, ?, ?)",
+            [(u["user_id"], u.get("display_name", ""), u.get("created_at", _now_iso())) for u in users],
+        )
+        _DB.executemany(
+            "INSERT OR IGNORE INTO threads (thread_id, user_id, title, created_at, updated_at)"
+            " VALUES (?, ?, ?, ?, ?)",
+            [
+                (t["thread_id"], t.get("user_id", ""), t.get("title", "New Thread"),
+                 t.get("created_at", _now_iso()), t.get("updated_at", _now_iso()))
+                for t in threads
+            ],
+        )
+        next_seq: Dict[str, int] = {}
+        rows = []
+        for m in messages:
+            tid = m["thread_id"]
+            if tid not in next_seq:
+                (next_seq[tid],) = _DB.execute(
+                    "SELECT COALESCE(MAX(seq) + 1, 0) FROM messages WHERE thread_id = ?", (tid,)
+                ).fetchone()
+            rows.append((tid, next_seq[tid], m["role"], m["content"], m.get("ts", "")))
+            next_seq[tid] += 1
+        _DB.executemany("INSERT INTO messages (thread_id, seq, role, content, ts) VALUES (?, ?, ?, ?, ?)", rows)
+        _DB.executemany(
+            "UPDATE threads SET next_seq = MAX(next_seq, ?) WHERE thread_id = ?",
+            [(n, tid) for tid, n in next_seq.items()],
+        )
+        if SEARCH_ENABLED:
+            _DB.executemany(
+                "INSERT INTO search_index (kind, ref, ts, title, body) VALUES ('message', ?, ?, '', ?)",
+                [(f"{r[0]}:{r[1]}", r[4], r[3]) for r in rows],
+            )
+        _DB.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (marker, _now_iso()))
+    return len(messages)
+
+migrate_tinydb_chat()
+
+def backfill_message_index() -> int:
+    """
+    One-shot: add messages saved before the search index existed to it.
+    Returns the number of messages indexed; a meta marker prevents re-runs.
+    """
+    marker = "search:messages:backfilled"
+    if not SEARCH_ENABLED:
+        return 0
+    with _tx("IMMEDIATE"):
+        if _DB.execute("SELECT 1 FROM meta WHERE key = ?", (marker,)).fetchone():
+            return 0
+        cur = _DB.execute(
+            "INSERT INTO search_index (kind, ref, ts, title, body)"
+            " SELECT 'message', thread_id || ':' || seq, ts, '', content FROM messages"
+            " WHERE thread_id || ':' || seq NOT IN (SELECT ref FROM search_index WHERE kind = 'message')"
+        )
+        _DB.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (marker, _now_iso()))
+    return cur.rowcount
+
+backfill_message_index()
+
+def get_meta(key: str):
+    with _LOCK:
+        row = _DB.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+    return row[0] if row else None
+
+def set_meta(key: str, value: str):
+    with _LOCK:
+        _DB.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value))
+
+def index_analysis(analysis_id: int, title: str, body: str, ts: str = ""):
+    """Add (or replace) one saved analysis in the search index."""
+    if not SEARCH_ENABLED:
+        return
+    with _tx():
+        _DB.execute("DELETE FROM search_index WHERE kind = 'analysis' AND ref = ?", (str(analysis_id),))
+        _DB.execute(
+            "INSERT INTO search_index (kind, ref, ts, title, body) VALUES ('analysis', ?, ?, ?, ?)",
+            (str(analysis_id), ts, title, body),
+        )
+
+def unindex_analysis(analysis_id: int):
+    if not SEARCH_ENABLED:
+        return
+    with _LOCK:
+        _DB.execute("DELETE FROM search_index WHERE kind = 'analysis' AND ref = ?", (str(analysis_id),))
+
+def clear_analysis_index():
+    if not SEARCH_ENABLED:
+        return
+    with _LOCK:
+        _DB.execute("DELETE FROM search_index WHERE kind = 'analysis'")
+
+def _match_expr(query: str) -> str:
+    """Free text → FTS5 OR-query of quoted terms (no syntax errors on user input)."""
+    terms = [t for t in "".join(c if c.isalnum() else " " for c in query.lower()).split() if len(t) > 1]
+    return " OR ".join(f'"{t}"' for t in terms[:16])
+
+def search(query: str, k: int = 10, kind: str = None) -> List[Dict[str, Any]]:
+    """
+    Top-k BM25 matches (title weighted 2x body), best first:
+    [{kind, ref, ts, title, snippet, score}]
+    """
+    expr = _match_expr(query)
+    if not SEARCH_ENABLED or not expr:
+        return []
+    sql = (
+        "SELECT kind, ref, ts, title, snippet(search_index, 4, '**', '**', '…', 24),"
+        " bm25(search_index, 0, 0, 0, 2.0, 1.0) AS score"
+        " FROM search_index WHERE search_index MATCH ?"
+    )
+    args: list = [expr]
+    if kind:
+        sql += " AND kind = ?"
+        args.append(kind)
+    sql += " ORDER BY score LIMIT ?"
+    args.append(k)
+    with _LOCK:
+        rows = _DB.execute(sql, args).fetchall()
+    return [
+        {"kind": r[0], "ref": r[1], "ts": r[2], "title": r[3], "snippet": r[4], "score": round(-r[5], 3)}
+        for r in rows
+    ]
+
 def upsert_user(user_id: str, display_name: str = ""):
-    users = _DB.table("users")
-    q = Query()
-    existing = users.get(q.user_id == user_id)
-    if existing:
-        return existing
-    doc = {"user_id": user_id, "display_name": display_name, "created_at": _now_iso()}
-    users.insert(doc)
+    with _LOCK:
+        row = _DB.execute(
+            "SELECT user_id, display_name, created_at FROM users WHERE user_id = ?", (user_id,)
+        ).fetchone()
+        if row:
+            return {"user_id": row[0], "display_name": row[1], "created_at": row[2]}
+        doc = {"user_id": user_id, "display_name": display_name, "created_at": _now_iso()}
+        _DB.execute(
+            "INSERT INTO users (user_id, display_name, created_at) VALUES (?, ?, ?)",
+            (doc["user_id"], doc["display_name"], doc["created_at"]),
+        )
     return doc
 
 def create_thread(user_id: str, title: str = "New Thread") -> str:
-    threads = _DB.table("threads")
     thread_id = str(uuid.uuid4())
-    doc = {
-        "thread_id": thread_id,
-        "user_id": user_id,
-        "title": title,
-        "created_at": _now_iso(),
-        "updated_at": _now_iso()
-    }
-    threads.insert(doc)
+    now = _now_iso()
+    with _LOCK:
+        _DB.execute(
+            "INSERT INTO threads (thread_id, user_id, title, created_at, updated_at) VALUES (?, ?, ?, ?, ?)",
+            (thread_id, user_id, title, now, now),
+        )
     return thread_id
 
 def list_threads(user_id: str) -> List[Dict[str, Any]]:
-    threads = _DB.table("threads")
-    q = Query()
-    items = threads.search(q.user_id == user_id)
-    # newest first
-    return sorted(items, key=lambda d: d.get("updated_at", ""), reverse=True)
+    with _LOCK:
+        rows = _DB.execute(
+            "SELECT thread_id, user_id, title, created_at, updated_at FROM threads"
+            " WHERE user_id = ? ORDER BY updated_at DESC",  # newest first
+            (user_id,),
+        ).fetchall()
+    return [_thread_doc(r) for r in rows]
 
 def rename_thread(thread_id: str, title: str):
-    threads = _DB.table("threads")
-    q = Query()
-    threads.update({"title": title, "updated_at": _now_iso()}, q.thread_id == thread_id)
+    with _LOCK:
+        _DB.execute("UPDATE threads SET title = ?, updated_at = ? WHERE thread_id = ?", (title, _now_iso(), thread_id))
 
 def save_messages(thread_id: str, messages: List[Dict[str, str]]):
     """
     messages = [{ "role": "user"|"assistant", "content": "..." , "ts": ISO }, ...]
+    Appends in one transaction: reserve a seq range from the thread counter,
+    then bulk-insert (messages + search index). Cost does not depend on the size of the database.
     """
-    msgs = _DB.table("messages")
-    # store with incremental order index
-    order = len(msgs.search(Query().thread_id == thread_id))
-    for m in messages:
-        msgs.insert({
-            "thread_id": thread_id,
-            "role": m["role"],
-            "content": m["content"],
-            "ts": m.get("ts", _now_iso()),
-            "order": order
-        })
-        order += 1
-    # bump thread updated time
-    threads = _DB.table("threads")
-    threads.update({"updated_at": _now_iso()}, Query().thread_id == thread_id)
+    if not messages:
+        return
+    now = _now_iso()
+    with _tx("IMMEDIATE"):
+        row = _DB.execute("SELECT next_seq FROM threads WHERE thread_id = ?", (thread_id,)).fetchone()
+        if row:
+            start = row[0]
+        else:
+            # unknown thread: continue after whatever is already stored for it
+            (start,) = _DB.execute(
+                "SELECT COALESCE(MAX(seq) + 1, 0) FROM messages WHERE thread_id = ?", (thread_id,)
+            ).fetchone()
+        _DB.executemany(
+            "INSERT INTO messages (thread_id, seq, role, content, ts) VALUES (?, ?, ?, ?, ?)",
+            [(thread_id, start + i, m["role"], m["content"], m.get("ts", now)) for i, m in enumerate(messages)],
+        )
+        if SEARCH_ENABLED:
+            _DB.executemany(
+                "INSERT INTO search_index (kind, ref, ts, title, body) VALUES ('message', ?, ?, '', ?)",
+                [(f"{thread_id}:{start + i}", m.get("ts", now), m["content"]) for i, m in enumerate(messages)],
+            )
+        # bump counter + thread updated time
+        _DB.execute(
+            "UPDATE threads SET next_seq = ?, updated_at = ? WHERE thread_id = ?",
+            (start + len(messages), now, thread_id),
+        )
 
 def load_messages(thread_id: str) -> List[Dict[str, str]]:
-    msgs = _DB.table("messages")
-    q = Query()
-    items = msgs.search(q.thread_id == thread_id)
-    items = sorted(items, key=lambda d: d.get("order", 0))
-    return [{"role": it["role"], "content": it["content"], "ts": it.get("ts", "")} for it in items]
+    with _LOCK:
+        rows = _DB.execute(
+            "SELECT role, content, ts FROM messages WHERE thread_id = ? ORDER BY seq", (thread_id,)
+        ).fetchall()
+    return [{"role": r[0], "content": r[1], "ts": r[2]} for r in rows]
@@ -0,0 +1,308 @@
+"""
+Job tests on the offline stub backend (no network): submit, cancel and fair
+admission of background analysis jobs. Run with `python -m pytest -q`.
+"""
+import hashlib
+import io
+import os
+import tempfile
+import threading
+import time
+
+import pytest
+from PIL import Image
+
+# tools builds its stores at import time; test_transport (collected after this
+# module) points its clients at a stub server first, so tools is imported lazily
+_TMP = tempfile.mkdtemp(prefix="chartify-jobs-test-")
+for _var, _file in (("HISTORY_DB_PATH", "history.sqlite3"), ("INSIGHT_CACHE_PATH", "cache.sqlite3"),
+                    ("CHAT_DB_PATH", "chat.sqlite3"), ("THUMBNAIL_DIR", "thumbnails"),
+                    ("PENDING_UPLOAD_DIR", "pending")):
+    os.environ.setdefault(_var, os.path.join(_TMP, _file))
+
+
+@pytest.fixture
+def tools(monkeypatch):
+    """tools with no quotas, a fast stub backend and a fresh job manager per test."""
+    import tools
+    monkeypatch.setattr(tools, "RATE_LIMITER", tools.RateLimiter({}, 1.0))
+    monkeypatch.setattr(tools, "STUB_LATENCY_S", 0.05)
+    monkeypatch.setattr(tools, "JOBS", tools.JobManager(2, 3600))
+    return tools
+
+
+def _recs(tools, n, seed=0):
+    """n distinct small PNG uploads (distinct per seed, so insights are not served from the cache)."""
+    out = []
+    for i in range(n):
+        buf = io.BytesIO()
+        Image.new("RGB", (40, 30), ((seed * 37 + i) % 256, (seed * 11) % 256, i % 256)).save(buf, "PNG")
+        data = buf.getvalue()
+        out.append(tools.UploadRecord(f"chart{i}.png", data, hashlib.sha256(data).hexdigest()))
+    return out
+
+
+def _wait(job, timeout_s=20.0):
+    deadline = time.monotonic() + timeout_s
+    while not job.done:
+        assert time.monotonic() < deadline, f"job still {job.status}"
+        time.sleep(0.02)
+    return job.snapshot()
+
+
+def test_submitted_job_is_saved_to_history(tools):
+    job_id = tools.JOBS.submit(_recs(tools, 3, seed=1), "Single Chart Analysis", tools.STUB_MODEL,
+                               "Business Professional", "Structured (bulleted)")
+    snap = _wait(tools.JOBS.get(job_id))
+    assert snap["status"] == "done"
+    assert snap["errors"] == ["", "", ""]
+    rec = tools.get_analysis(snap["analysis_id"])
+    assert [d["insight"] for d in rec["analysis_details"]] == snap["texts"]
+    assert rec.get("status") != "running"
+
+
+def test_cancelled_job_marks_unfinished_charts(tools, monkeypatch):
+    monkeypatch.setattr(tools, "STUB_LATENCY_S", 0.3)
+    job_id = tools.JOBS.submit(_recs(tools, 12, seed=2), "Single Chart Analysis", tools.STUB_MODEL,
+                               "Business Professional", "Structured (bulleted)")
+    job = tools.JOBS.get(job_id)
+    while not any(job.snapshot()["finished"]):
+        time.sleep(0.02)
+    assert tools.JOBS.cancel(job_id)
+    snap = _wait(job)
+    assert snap["status"] == "cancelled"
+    assert tools.INSIGHT_CANCELLED in snap["errors"]
+    assert not tools.JOBS.cancel(job_id)             # already over
+
+
+def test_free_slot_goes_to_the_session_waiting_longest(tools, monkeypatch):
+    started, gate = [], threading.Event()
+
+    def _fake_run(job):
+        started.append(job.owner)
+        gate.wait(5)
+        job._set(status="done", finished_at=time.time())
+
+    monkeypatch.setattr(tools, "_run_job", _fake_run)
+    jobs = tools.JobManager(1, 3600)
+    ids = [jobs.submit([], "Single Chart Analysis", tools.STUB_MODEL, "", "", owner="big") for _ in range(3)]
+    ids.append(jobs.submit([], "Single Chart Analysis", tools.STUB_MODEL, "", "", owner="small"))
+    gate.set()
+    for job_id in ids:
+        _wait(jobs.get(job_id))
+    assert started == ["big", "small", "big", "big"]
+
+
+def test_cancelling_a_queued_job_ends_it_at_once(tools, monkeypatch):
+    gate = threading.Event()
+    monkeypatch.setattr(tools, "_run_job", lambda job: (gate.wait(5), job._set(status="done")))
+    jobs = tools.JobManager(1, 3600)
+    running = jobs.submit([], "Single Chart Analysis", tools.STUB_MODEL, "", "", owner="a")
+    queued = jobs.submit([], "Single Chart Analysis", tools.STUB_MODEL, "", "", owner="b")
+    assert jobs.cancel(queued)
+    assert jobs.get(queued).status == "cancelled"
+    gate.set()
+    _wait(jobs.get(running))
+
+
+# =============================================================================
+# Request coalescing (SingleFlight)
+# =============================================================================
+PARTS = [{"text": "Describe the chart."}]
+
+
+def test_identical_concurrent_requests_share_one_backend_call(tools, monkeypatch):
+    calls, gate = [], threading.Event()
+
+    def _slow_generate(model_name, parts):
+        calls.append(model_name)
+        gate.wait(5)
+        return "Shared insight."
+
+    monkeypatch.setattr(tools, "FLIGHTS", tools.SingleFlight())
+    monkeypatch.setitem(tools._GENERATE, "stub", _slow_generate)
+    results, routes = [None] * 4, [{} for _ in range(4)]
+
+    def _call(i):
+        results[i] = tools._generate_cached("test:coalesce", tools.STUB_MODEL, PARTS, False, route=routes[i])
+
+    threads = [threading.Thread(target=_call, args=(i,)) for i in range(4)]
+    for t in threads:
+        t.start()
+    while tools.FLIGHTS.stats()["coalesced"] < 3:
+        time.sleep(0.01)
+    gate.set()
+    for t in threads:
+        t.join(5)
+    assert len(calls) == 1
+    assert [r.text for r in results] == ["Shared insight."] * 4
+    assert sum(bool(r.get("coalesced")) for r in routes) == 3
+    assert tools.FLIGHTS.stats()["in_flight"] == 0
+
+
+def test_failed_flight_fails_every_subscriber(tools, monkeypatch):
+    gate = threading.Event()
+
+    def _failing_generate(model_name, parts):
+        gate.wait(5)
+        raise ValueError("bad prompt")
+
+    monkeypatch.setattr(tools, "FLIGHTS", tools.SingleFlight())
+    monkeypatch.setitem(tools._GENERATE, "stub", _failing_generate)
+    results = [None] * 2
+
+    def _call(i):
+        results[i] = tools._generate_cached("test:coalesce-failed", tools.STUB_MODEL, PARTS, True)
+
+    threads = [threading.Thread(target=_call, args=(i,)) for i in range(2)]
+    for t in threads:
+        t.start()
+    while tools.FLIGHTS.stats()["coalesced"] < 1:
+        time.sleep(0.01)
+    gate.set()
+    for t in threads:
+        t.join(5)
+    assert all(r.failed and r.error.startswith("API Error:") for r in results)
+    assert tools.INSIGHT_CACHE.peek("test:coalesce-failed") is None
+
+
+def test_abandoned_stream_stops_its_backend_call_uncached(tools, monkeypatch):
+    produced = []
+
+    def _slow_stream(model_name, parts):
+        for i in range(50):
+            produced.append(i)
+            yield f"chunk {i} "
+            time.sleep(0.02)
+
+    monkeypatch.setattr(tools, "FLIGHTS", tools.SingleFlight())
+    monkeypatch.setitem(tools._STREAM, "stub", _slow_stream)
+    stream = tools._stream_cached("test:abandoned", tools.STUB_MODEL, PARTS, True)
+    assert next(stream) == "chunk 0 "
+    stream.close()                                   # the only subscriber leaves
+    deadline = time.monotonic() + 5
+    while tools.FLIGHTS.stats()["in_flight"]:
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+    time.sleep(0.1)
+    assert len(produced) < 50
+    assert tools.INSIGHT_CACHE.peek("test:abandoned") is None
+    # the next identical request starts a fresh flight
+    _, leader = tools.FLIGHTS.join("test:abandoned")
+    assert leader
+
+
+# =============================================================================
+# Rate limiting (RateLimiter)
+# =============================================================================
+def _drained_limiter(tools, rpm, max_wait_s):
+    """A limiter on the stub backend whose request bucket starts empty."""
+    limiter = tools.RateLimiter({"stub": (rpm, 0)}, max_wait_s)
+    limiter._bucket(tools.STUB_MODEL).requests = 0.0
+    return limiter
+
+
+def test_waiters_are_served_round_robin_across_owners(tools):
+    limiter = _drained_limiter(tools, 600, 5.0)        # one request every 0.1 s
+    granted, lock = [], threading.Lock()
+
+    def _call(owner):
+        with tools.rate_owner(owner):
+            limiter.acquire(tools.STUB_MODEL, 0)
+        with lock:
+            granted.append(owner)
+
+    threads = []
+    for n, owner in enumerate(["big", "big", "big", "small"], start=1):
+        threads.append(threading.Thread(target=_call, args=(owner,)))
+        threads[-1].start()
+        while limiter.snapshot()[tools.STUB_MODEL]["queued"] < n:
+            time.sleep(0.005)
+    for t in threads:
+        t.join(5)
+    assert granted == ["big", "small", "big", "big"]
+    assert limiter.granted == 4
+
+
+def test_wait_past_the_deadline_raises_rate_limited(tools):
+    limiter = _drained_limiter(tools, 60, 0.2)         # next slot in ~1 s
+    t0 = time.monotonic()
+    with pytest.raises(tools.RateLimited):
+        limiter.acquire(tools.STUB_MODEL, 0)
+    assert time.monotonic() - t0 < 0.5
+    assert limiter.snapshot()[tools.STUB_MODEL]["queued"] == 0
+
+
+def test_penalize_holds_new_calls(tools):
+    limiter = tools.RateLimiter({"stub": (600, 0)}, 2.0)
+    limiter.penalize(tools.STUB_MODEL, 0.3)
+    t0 = time.monotonic()
+    ticket = limiter.acquire(tools.STUB_MODEL, 0)
+    assert time.monotonic() - t0 >= 0.25
+    assert ticket["waited_s"] >= 0.25
+    assert limiter.throttled == 1
+    limiter.penalize(tools.STUB_MODEL, 5.0)            # longer than max_wait_s
+    with pytest.raises(tools.RateLimited):
+        limiter.acquire(tools.STUB_MODEL, 0)
+
+
+# =============================================================================
+# Resume and delete-while-running
+# =============================================================================
+def _interrupted_run(tools, recs):
+    """A single-chart run as a restarted server finds it: chart 0 saved, the rest never started."""
+    analysis_id = tools.begin_analysis(
+        {"analysis_mode": "Single Chart Analysis", "thumbnails": []}, recs,
+        {"mode": "Single Chart Analysis", "model": tools.STUB_MODEL,
+         "audience": "Business Professional", "style": "Structured (bulleted)"},
+    )
+    tools.append_analysis_progress(analysis_id, 0, {"name": recs[0].name, "sha": recs[0].sha,
+                                                    "route": {}, "insight": "Saved before the restart."})
+    return analysis_id
+
+
+def test_resume_keeps_saved_charts_and_reports_missing_uploads(tools):
+    recs = _recs(tools, 3, seed=5)
+    analysis_id = _interrupted_run(tools, recs)
+    plan = next(p for p in tools.HISTORY.pending() if p["id"] == analysis_id)
+    tools.PENDING_UPLOADS.delete(plan["charts"][2]["ref"])
+    assert analysis_id in {r["id"] for r in tools.interrupted_analyses()}
+
+    snap = _wait(tools.JOBS.get(tools.JOBS.resume(analysis_id)))
+    assert snap["status"] == "done"
+    assert snap["analysis_id"] == analysis_id
+    assert snap["texts"][0] == "Saved before the restart."
+    assert snap["texts"][1] and not snap["errors"][1]
+    assert "upload missing" in snap["errors"][2]
+    rec = tools.get_analysis(analysis_id)
+    assert rec.get("status") != "running"
+    assert "upload missing" in rec["analysis_details"][2]["error"]
+    assert analysis_id not in {r["id"] for r in tools.interrupted_analyses()}
+
+
+def test_resume_of_an_unknown_run_returns_none(tools):
+    assert tools.JOBS.resume(10 ** 9) is None
+
+
+@pytest.mark.parametrize("deleted_by_job_manager", [True, False])
+def test_deleting_a_running_run_stops_its_job(tools, monkeypatch, deleted_by_job_manager):
+    monkeypatch.setattr(tools, "STUB_LATENCY_S", 0.2)
+    job = tools.JOBS.get(tools.JOBS.submit(_recs(tools, 20, seed=6 + deleted_by_job_manager),
+                                           "Single Chart Analysis", tools.STUB_MODEL,
+                                           "Business Professional", "Structured (bulleted)"))
+    while job.analysis_id is None or not any(job.snapshot()["finished"]):
+        time.sleep(0.02)
+    analysis_id = job.analysis_id
+    if deleted_by_job_manager:
+        tools.delete_analysis(analysis_id)
+    else:
+        tools._delete_record(analysis_id)            # e.g. another process: the next write is refused
+    snap = _wait(job)
+    assert snap["status"] == "cancelled"
+    assert snap["analysis_id"] is None
+    assert "deleted" in snap["error"]
+    assert tools.get_analysis(analysis_id) == {}
+    assert tools.HISTORY.progress(analysis_id) == []
+    assert analysis_id not in {p["id"] for p in tools.HISTORY.pending()}
+    assert analysis_id not in {h["id"] for h in tools.search_analyses("Stub insight")}
+    assert set(tools.THUMBS.refs()) <= tools.HISTORY.thumbnail_refs()   # no orphaned thumbnail files
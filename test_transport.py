@@ -0,0 +1,153 @@
+"""
+Transport tests: the Groq backend pointed (GROQ_BASE_URL) at a local stub
+server, so retries, timeouts and error texts run through the real SDK + httpx.
+Run with `python -m pytest -q`.
+"""
+import json
+import os
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+
+class _StubHandler(BaseHTTPRequestHandler):
+    """OpenAI-style /chat/completions; replies come from the server's `script` (status, body, delay_s)."""
+
+    def do_POST(self):
+        server = self.server
+        payload = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        with server.lock:
+            server.requests.append(payload)
+            status, content, delay_s = server.script.pop(0) if server.script else (200, "ok", 0.0)
+        time.sleep(delay_s)
+        if status != 200:
+            self._send(status, "application/json", json.dumps({"error": {"message": content}}).encode())
+        elif payload.get("stream"):
+            events = [{"id": "s", "object": "chat.completion.chunk", "created": 0, "model": payload["model"],
+                       "choices": [{"index": 0, "delta": {"content": piece}, "finish_reason": None}]}
+                      for piece in content.split("|")]
+            body = "".join(f"data: {json.dumps(e)}\n\n" for e in events) + "data: [DONE]\n\n"
+            self._send(200, "text/event-stream", body.encode())
+        else:
+            self._send(200, "application/json", json.dumps({
+                "id": "c", "object": "chat.completion", "created": 0, "model": payload["model"],
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": content},
+                             "finish_reason": "stop"}],
+                "usage": {"prompt_tokens": 3, "completion_tokens": 4, "total_tokens": 7},
+            }).encode())
+
+    def _send(self, status, ctype, body):
+        self.send_response(status)
+        self.send_header("Content-Type", ctype)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+_SERVER = ThreadingHTTPServer(("127.0.0.1", 0), _StubHandler)
+_SERVER.daemon_threads = True
+_SERVER.lock = threading.Lock()
+_SERVER.requests, _SERVER.script = [], []
+threading.Thread(target=_SERVER.serve_forever, daemon=True).start()
+
+# tools builds its clients and stores at import time
+_TMP = tempfile.mkdtemp(prefix="chartify-test-")
+os.environ.update(
+    GROQ_API_KEY="test-key",
+    GROQ_BASE_URL=f"http://127.0.0.1:{_SERVER.server_address[1]}",
+    HISTORY_DB_PATH=os.path.join(_TMP, "history.sqlite3"),
+    INSIGHT_CACHE_PATH=os.path.join(_TMP, "cache.sqlite3"),
+    CHAT_DB_PATH=os.path.join(_TMP, "chat.sqlite3"),
+    THUMBNAIL_DIR=os.path.join(_TMP, "thumbnails"),
+    PENDING_UPLOAD_DIR=os.path.join(_TMP, "pending"),
+)
+import tools  # noqa: E402
+
+MODEL = "llama-3.1-8b-instant"
+PARTS = [{"text": "Describe the chart."}]
+
+
+@pytest.fixture(autouse=True)
+def stub(monkeypatch):
+    """Fresh script/request log, no quotas, a closed circuit and fast retries per test."""
+    with _SERVER.lock:
+        _SERVER.requests.clear()
+        _SERVER.script.clear()
+    monkeypatch.setattr(tools, "RATE_LIMITER", tools.RateLimiter({}, 1.0))
+    monkeypatch.setattr(tools, "ROUTER", tools.ModelRouter([MODEL]))
+    monkeypatch.setitem(tools._BREAKERS, "groq", tools.CircuitBreaker("groq", 5, 30.0))
+    monkeypatch.setattr(tools, "RETRY_BASE_DELAY_S", 0.01)
+    monkeypatch.setattr(tools, "RETRY_MAX_DELAY_S", 0.05)
+    return _SERVER
+
+
+def test_generate_returns_backend_text(stub):
+    stub.script.append((200, "Revenue rises in Q3.", 0.0))
+    assert tools._generate_on_model(MODEL, PARTS) == "Revenue rises in Q3."
+    assert stub.requests[0]["model"] == MODEL
+    assert tools.ROUTER.stats(MODEL)["n"] == 1
+
+
+def test_transient_error_is_retried(stub):
+    stub.script += [(503, "overloaded", 0.0), (200, "second try", 0.0)]
+    assert tools._generate_on_model(MODEL, PARTS) == "second try"
+    assert len(stub.requests) == 2
+
+
+def test_client_error_fails_fast_and_is_not_a_model_failure(stub):
+    stub.script.append((400, "bad request", 0.0))
+    with pytest.raises(tools.BackendError) as exc:
+        tools._generate_on_model(MODEL, PARTS)
+    assert exc.value.status == 400
+    assert len(stub.requests) == 1
+    assert tools.ROUTER.stats(MODEL)["n"] == 0
+
+
+def test_attempt_timeout_is_capped_by_the_deadline(stub, monkeypatch):
+    monkeypatch.setattr(tools, "MODEL_TIMEOUT_S", 30.0)
+    monkeypatch.setattr(tools, "MODEL_DEADLINE_S", 0.5)
+    stub.script += [(200, "too late", 3.0)] * 3
+    t0 = time.monotonic()
+    with pytest.raises(tools.BackendError):
+        tools._generate_on_model(MODEL, PARTS)
+    assert time.monotonic() - t0 < 2.0
+
+
+def test_stream_yields_chunks(stub):
+    stub.script.append((200, "Sales |peak |in June.", 0.0))
+    assert list(tools._stream_on_model(MODEL, PARTS)) == ["Sales ", "peak ", "in June."]
+
+
+def test_failed_call_returns_an_error_result(stub):
+    stub.script.append((400, "bad request", 0.0))
+    result = tools._generate_cached("test:failed", MODEL, PARTS, use_cache=False)
+    assert result.failed
+    assert result.error.startswith("API Error:")
+
+
+def test_insight_quoting_the_error_prefix_is_not_an_error(stub):
+    stub.script.append((200, "The log shows:\n\nAPI Error: 502 during the outage window.", 0.0))
+    result = tools._generate_cached("test:quoted", MODEL, PARTS, use_cache=False)
+    assert "\n\nAPI Error:" in result.text
+    assert not result.failed
+
+
+def test_failed_stream_raises_after_partial_chunks(monkeypatch):
+    def _broken(model_name, parts, route):
+        yield "Sales "
+        raise tools.BackendError("connection reset")
+
+    monkeypatch.setattr(tools, "stream_with_backend", _broken)
+    pieces = []
+    with pytest.raises(tools.InsightFailed) as exc:
+        for piece in tools._stream_cached("test:stream-failed", MODEL, PARTS, use_cache=True):
+            pieces.append(piece)
+    assert pieces == ["Sales "]
+    assert str(exc.value).startswith("API Error:")
+    assert tools.INSIGHT_CACHE.peek("test:stream-failed") is None
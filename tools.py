@@ -1,26 +1,46 @@
+import abc
 import os
 import io
+import json
+import logging
 import base64
+import contextvars
+import hashlib
+import sqlite3
+import queue
+import random
+import re
 import tempfile
+import threading
+import time
+import uuid
+import zipfile
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from dataclasses import dataclass
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
 from datetime import datetime
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Optional, Iterator, Tuple, Callable
 
 import streamlit as st
 from dotenv import load_dotenv
 from PIL import Image
 from tools import *
+import httpx
 from google import genai as google_genai           
-from groq import Groq                              
+from google.genai import errors as google_errors, types as google_types
+from groq import Groq, APIConnectionError as GroqConnectionError, APIStatusError as GroqStatusError
 from reportlab.platypus import (
-    SimpleDocTemplate, Paragraph, Spacer, Image as RLImage, PageBreak
+    SimpleDocTemplate, Paragraph, Spacer, Image as RLImage, PageBreak, Table
 )
 from reportlab.lib.pagesizes import A4
 from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
 from reportlab.lib.units import inch
 from reportlab.lib.utils import ImageReader
-from tinydb import TinyDB, where
 
-DB = TinyDB("analysis_history_db.json")
+import storage
+
 # =============================================================================
 # Environment & clients
 # =============================================================================
@@ -28,8 +48,144 @@ load_dotenv()
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY", "")
 GROQ_API_KEY   = os.getenv("GROQ_API_KEY", "")
 
-google_client: Optional[google_genai.Client] = google_genai.Client(api_key=GEMINI_API_KEY) if GEMINI_API_KEY else None
-groq_client: Optional[Groq] = Groq(api_key=GROQ_API_KEY) if GROQ_API_KEY else None
+# Supported models (one Google, one Groq multimodal) — also the failover set
+MODEL_CHOICES = [
+    "gemini-2.0-flash",
+    "meta-llama/llama-4-scout-17b-16e-instruct",
+]
+
+# Optional endpoint overrides (e.g. a local stub server for tests)
+GEMINI_BASE_URL = os.getenv("GEMINI_BASE_URL", "")
+GROQ_BASE_URL   = os.getenv("GROQ_BASE_URL", "")
+
+# Offline backend: model names starting with "stub" never leave the process
+# (canned, deterministic insights after STUB_LATENCY_S) — for batch dry runs.
+STUB_MODEL = "stub"
+STUB_LATENCY_S = float(os.getenv("STUB_LATENCY_S", "0.05"))
+
+# Concurrency: overall worker pool size per run + process-wide in-flight cap per backend
+ANALYSIS_MAX_WORKERS = int(os.getenv("ANALYSIS_MAX_WORKERS", "6"))
+BACKEND_CONCURRENCY = {
+    "google": int(os.getenv("GEMINI_MAX_CONCURRENCY", "4")),
+    "groq":   int(os.getenv("GROQ_MAX_CONCURRENCY", "2")),
+    "stub":   int(os.getenv("STUB_MAX_CONCURRENCY", "16")),
+}
+_BACKEND_SLOTS = {name: threading.BoundedSemaphore(max(1, n)) for name, n in BACKEND_CONCURRENCY.items()}
+
+# Rate limits per backend, shared by every session in this process (0 = unlimited):
+# requests/min + estimated tokens/min. Estimates (prompt ≈ chars/4, RATE_IMAGE_TOKENS
+# per image, RATE_OUTPUT_TOKENS per answer) are corrected by reported usage afterwards.
+RATE_LIMITS = {
+    "google": (int(os.getenv("GEMINI_RPM", "15")), int(os.getenv("GEMINI_TPM", "1000000"))),
+    "groq":   (int(os.getenv("GROQ_RPM", "30")), int(os.getenv("GROQ_TPM", "30000"))),
+    "stub":   (int(os.getenv("STUB_RPM", "0")), int(os.getenv("STUB_TPM", "0"))),
+}
+RATE_IMAGE_TOKENS = int(os.getenv("RATE_IMAGE_TOKENS", "1000"))
+RATE_OUTPUT_TOKENS = int(os.getenv("RATE_OUTPUT_TOKENS", "500"))
+RATE_MAX_WAIT_S = float(os.getenv("RATE_MAX_WAIT_S", "120"))    # longer queues fail over instead
+
+# Transport: per-attempt timeout, overall deadline (incl. retries), jittered retry, circuit breaker
+MODEL_TIMEOUT_S = float(os.getenv("MODEL_TIMEOUT_S", "60"))
+MODEL_DEADLINE_S = float(os.getenv("MODEL_DEADLINE_S", "120"))
+MODEL_MAX_RETRIES = int(os.getenv("MODEL_MAX_RETRIES", "3"))
+RETRY_BASE_DELAY_S = float(os.getenv("RETRY_BASE_DELAY_S", "0.5"))
+RETRY_MAX_DELAY_S = float(os.getenv("RETRY_MAX_DELAY_S", "8"))
+BREAKER_FAILURE_THRESHOLD = int(os.getenv("BREAKER_FAILURE_THRESHOLD", "5"))
+BREAKER_RESET_S = float(os.getenv("BREAKER_RESET_S", "30"))
+
+# Routing: rolling window per model; degraded models are tried last. HEDGE_AFTER_S > 0
+# races the next healthy model when the first has not answered within that many seconds.
+ROUTER_WINDOW = int(os.getenv("ROUTER_WINDOW", "50"))
+ROUTER_MIN_SAMPLES = int(os.getenv("ROUTER_MIN_SAMPLES", "5"))
+ROUTER_MAX_ERROR_RATE = float(os.getenv("ROUTER_MAX_ERROR_RATE", "0.5"))
+ROUTER_SLOW_P90_S = float(os.getenv("ROUTER_SLOW_P90_S", "45"))
+HEDGE_AFTER_S = float(os.getenv("HEDGE_AFTER_S", "0"))
+
+# Cross-chart map-reduce: above the threshold, charts are summarized in parallel
+# batches (map) and a text-only call combines the summaries (reduce)
+CROSS_MAP_REDUCE_THRESHOLD = int(os.getenv("CROSS_MAP_REDUCE_THRESHOLD", "8"))
+CROSS_MAP_BATCH_SIZE = int(os.getenv("CROSS_MAP_BATCH_SIZE", "4"))
+
+# Background analysis jobs: concurrent jobs per process (free slots are shared fairly
+# across sessions); finished jobs kept this long for polling
+JOB_MAX_WORKERS = int(os.getenv("JOB_MAX_WORKERS", "2"))
+JOB_RETENTION_S = int(os.getenv("JOB_RETENTION_S", "3600"))
+
+# Chat context budget (rough tokens ≈ chars / 4)
+CHAT_CONTEXT_TOKENS = int(os.getenv("CHAT_CONTEXT_TOKENS", "1500"))   # analysis sections
+CHAT_HISTORY_TOKENS = int(os.getenv("CHAT_HISTORY_TOKENS", "400"))    # summary of older turns
+CHAT_RECENT_TURNS = int(os.getenv("CHAT_RECENT_TURNS", "3"))          # turns kept verbatim
+
+# One long-lived client per backend: keep-alive pools sized to the concurrency caps.
+# SDK-level retries are off; _call_with_resilience owns retry policy.
+google_client: Optional[google_genai.Client] = google_genai.Client(
+    api_key=GEMINI_API_KEY,
+    http_options=google_types.HttpOptions(
+        base_url=GEMINI_BASE_URL or None,
+        timeout=int(MODEL_TIMEOUT_S * 1000),
+        client_args={"limits": httpx.Limits(
+            max_connections=BACKEND_CONCURRENCY["google"] * 2,
+            max_keepalive_connections=BACKEND_CONCURRENCY["google"],
+        )},
+    ),
+) if GEMINI_API_KEY else None
+groq_client: Optional[Groq] = Groq(
+    api_key=GROQ_API_KEY,
+    base_url=GROQ_BASE_URL or None,
+    timeout=MODEL_TIMEOUT_S,
+    max_retries=0,
+    http_client=httpx.Client(
+        timeout=MODEL_TIMEOUT_S,
+        limits=httpx.Limits(
+            max_connections=BACKEND_CONCURRENCY["groq"] * 2,
+            max_keepalive_connections=BACKEND_CONCURRENCY["groq"],
+        ),
+    ),
+) if GROQ_API_KEY else None
+
+# Insight cache: bump PROMPT_VERSION whenever the prompt templates below change
+PROMPT_VERSION = "1"
+INSIGHT_CACHE_PATH = os.getenv("INSIGHT_CACHE_PATH", "insight_cache.sqlite3")
+INSIGHT_CACHE_MAX_ENTRIES = int(os.getenv("INSIGHT_CACHE_MAX_ENTRIES", "5000"))
+INSIGHT_CACHE_TTL_S = int(os.getenv("INSIGHT_CACHE_TTL_S", str(7 * 24 * 3600)))
+
+# History storage (SQLite). The legacy TinyDB file is imported once on first start.
+HISTORY_DB_PATH = os.getenv("HISTORY_DB_PATH", "analysis_history.sqlite3")
+LEGACY_HISTORY_JSON = "analysis_history_db.json"
+THUMBNAIL_DIR = os.getenv("THUMBNAIL_DIR", "thumbnails")
+# Uploads of single-chart runs still in progress (content-addressed), so an interrupted run can resume
+PENDING_UPLOAD_DIR = os.getenv("PENDING_UPLOAD_DIR", "pending_uploads")
+
+# Model-side image preprocessing (MODEL_IMAGE_FORMAT=ORIGINAL sends uploads untouched)
+MODEL_IMAGE_MAX_SIDE = int(os.getenv("MODEL_IMAGE_MAX_SIDE", "1536"))
+MODEL_IMAGE_FORMAT = os.getenv("MODEL_IMAGE_FORMAT", "JPEG").upper()   # JPEG | WEBP | PNG | ORIGINAL
+MODEL_IMAGE_QUALITY = int(os.getenv("MODEL_IMAGE_QUALITY", "85"))
+_FORMAT_MIME = {"JPEG": "image/jpeg", "WEBP": "image/webp", "PNG": "image/png"}
+
+# History thumbnails: at most THUMBNAIL_MAX_W wide, encoded as THUMBNAIL_FORMAT (WEBP | JPEG | PNG)
+THUMBNAIL_MAX_W = int(os.getenv("THUMBNAIL_MAX_W", "320"))
+THUMBNAIL_FORMAT = os.getenv("THUMBNAIL_FORMAT", "WEBP").upper()
+THUMBNAIL_QUALITY = int(os.getenv("THUMBNAIL_QUALITY", "80"))
+THUMBNAIL_MAX_WORKERS = int(os.getenv("THUMBNAIL_MAX_WORKERS", "4"))
+_MIME_EXT = {"image/jpeg": "jpg", "image/webp": "webp", "image/png": "png"}
+
+# Process-wide budget for derived upload views (decoded images + model payloads)
+UPLOAD_VIEW_CACHE_MB = int(os.getenv("UPLOAD_VIEW_CACHE_MB", "256"))
+
+# PDF export: images are re-encoded at PDF_IMAGE_DPI for their printed size;
+# finished reports are kept (by uploads + summary) within PDF_CACHE_MB.
+PDF_IMAGE_DPI = int(os.getenv("PDF_IMAGE_DPI", "150"))
+PDF_IMAGE_QUALITY = int(os.getenv("PDF_IMAGE_QUALITY", "85"))
+PDF_CACHE_MB = int(os.getenv("PDF_CACHE_MB", "64"))
+PDF_MAX_WORKERS = int(os.getenv("PDF_MAX_WORKERS", "2"))
+
+# Instrumentation: PERF_LOG=1 logs one JSON line per stage span (logger "chartify.perf");
+# METRICS_PORT > 0 serves Prometheus text at http://<METRICS_HOST>:<port>/metrics
+# (loopback by default; set METRICS_HOST=0.0.0.0 to let a remote scraper in)
+PERF_LOG = os.getenv("PERF_LOG", "0") == "1"
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+
 def _now_iso() -> str:
     return datetime.utcnow().isoformat()
 
@@ -53,7 +209,9 @@ def _clear_current_run():
     st.session_state.combined_insight = ""
     st.session_state.analysis_done = False
     st.session_state.pdf_bytes = None
+    st.session_state.pdf_job = None
     st.session_state.latest_thumbs = []
+    st.session_state.job_error = ""
 
 
 def _make_history_title(payload: Dict[str, Any]) -> str:
@@ -62,7 +220,7 @@ def _make_history_title(payload: Dict[str, Any]) -> str:
     if mode.startswith("Cross"):
         base = _summarize_line(payload.get("combined_insight", "")) or "Cross-chart summary"
         return f"Cross • {base}"
-    details = payload.get("analysis_details", [])
+    details = [d for d in payload.get("analysis_details", []) if not d.get("error")]
     if details:
         first = details[0]
         name = first.get("name", "Chart")
@@ -72,28 +230,839 @@ def _make_history_title(payload: Dict[str, Any]) -> str:
     return f"Single • {base}"
 
 
-def save_analysis(payload: Dict[str, Any]) -> None:
-    analyses = DB.table("analyses")
+# =============================================================================
+# Instrumentation (stage spans → run trace, process metrics, logs)
+# =============================================================================
+_PERF_LOG = logging.getLogger("chartify.perf")
+_LATENCY_BUCKETS_S = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+_CURRENT_SPAN: "contextvars.ContextVar[Optional[Dict[str, Any]]]" = contextvars.ContextVar("span", default=None)
+_RUN_TRACE: "contextvars.ContextVar[Optional[List[Dict[str, Any]]]]" = contextvars.ContextVar("trace", default=None)
+_SPAN_FIELDS = ("bytes_in", "bytes_out", "tokens_in", "tokens_out")
+
+
+class StageMetrics:
+    """Process-wide totals + latency histogram per (stage, model)."""
+
+    def __init__(self, buckets=_LATENCY_BUCKETS_S):
+        self.buckets = buckets
+        self._rows: Dict[Tuple[str, str], Dict[str, Any]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, sp: Dict[str, Any]) -> None:
+        key = (sp["stage"], sp.get("model", ""))
+        secs = sp["ms"] / 1000.0
+        with self._lock:
+            row = self._rows.get(key)
+            if row is None:
+                row = self._rows[key] = {"count": 0, "errors": 0, "seconds": 0.0, "max_s": 0.0,
+                                         "hist": [0] * len(self.buckets), **{f: 0 for f in _SPAN_FIELDS}}
+            row["count"] += 1
+            row["errors"] += 0 if sp.get("ok", True) else 1
+            row["seconds"] += secs
+            row["max_s"] = max(row["max_s"], secs)
+            for i, le in enumerate(self.buckets):
+                if secs <= le:
+                    row["hist"][i] += 1
+            for f in _SPAN_FIELDS:
+                row[f] += int(sp.get(f, 0) or 0)
+
+    def snapshot(self) -> List[Dict[str, Any]]:
+        """One dict per (stage, model) for display."""
+        with self._lock:
+            items = [(k, dict(v)) for k, v in self._rows.items()]
+        return [
+            {"stage": stage, "model": model, "calls": r["count"], "errors": r["errors"],
+             "mean_ms": round(1000 * r["seconds"] / max(1, r["count"]), 1), "max_ms": round(1000 * r["max_s"], 1),
+             **{f: r[f] for f in _SPAN_FIELDS}}
+            for (stage, model), r in sorted(items)
+        ]
+
+    def prometheus_text(self) -> str:
+        with self._lock:
+            items = [(k, dict(v, hist=list(v["hist"]))) for k, v in sorted(self._rows.items())]
+        out = [
+            "# HELP chartify_stage_seconds Latency of instrumented stages.",
+            "# TYPE chartify_stage_seconds histogram",
+        ]
+        for (stage, model), r in items:
+            lbl = f'stage="{stage}",model="{model}"'
+            for le, n in zip(self.buckets, r["hist"]):
+                out.append(f'chartify_stage_seconds_bucket{{{lbl},le="{le}"}} {n}')
+            out.append(f'chartify_stage_seconds_bucket{{{lbl},le="+Inf"}} {r["count"]}')
+            out.append(f"chartify_stage_seconds_sum{{{lbl}}} {r['seconds']:.6f}")
+            out.append(f"chartify_stage_seconds_count{{{lbl}}} {r['count']}")
+        for name, field, help_text in [
+            ("chartify_stage_errors_total", "errors", "Failed stage calls."),
+            ("chartify_stage_bytes_in_total", "bytes_in", "Payload bytes into stages."),
+            ("chartify_stage_bytes_out_total", "bytes_out", "Payload bytes out of stages."),
+            ("chartify_model_tokens_in_total", "tokens_in", "Prompt tokens reported by model backends."),
+            ("chartify_model_tokens_out_total", "tokens_out", "Completion tokens reported by model backends."),
+        ]:
+            out += [f"# HELP {name} {help_text}", f"# TYPE {name} counter"]
+            out += [f'{name}{{stage="{stage}",model="{model}"}} {r[field]}' for (stage, model), r in items]
+        return "\n".join(out) + "\n"
+
+
+METRICS = StageMetrics()
+
+
+def _finish_span(sp: Dict[str, Any]) -> None:
+    METRICS.observe(sp)
+    trace = _RUN_TRACE.get()
+    if trace is not None:
+        trace.append(sp)
+    if PERF_LOG:
+        _PERF_LOG.info(json.dumps(sp, default=str))
+
+
+@contextmanager
+def span(stage: str, **attrs):
+    """Time a stage; the yielded dict takes extra fields (bytes_out, tokens_in, …)."""
+    sp: Dict[str, Any] = {"stage": stage, "ok": True, **attrs}
+    token = _CURRENT_SPAN.set(sp)
+    t0 = time.perf_counter()
+    try:
+        yield sp
+    except Exception:
+        sp["ok"] = False
+        raise
+    finally:
+        sp["ms"] = round((time.perf_counter() - t0) * 1000.0, 3)
+        _CURRENT_SPAN.reset(token)
+        _finish_span(sp)
+
+
+_USAGE_LOCK = threading.Lock()
+
+
+def record_usage(tokens_in: int, tokens_out: int) -> None:
+    """Add backend-reported token usage to the innermost open span (if any) and the rate-limit ticket."""
+    ticket = _RATE_TICKET.get()
+    if ticket is not None:
+        ticket["used"] += int(tokens_in or 0) + int(tokens_out or 0)
+    sp = _CURRENT_SPAN.get()
+    if sp is None:
+        return
+    with _USAGE_LOCK:                                # hedged calls may report concurrently
+        sp["tokens_in"] = sp.get("tokens_in", 0) + int(tokens_in or 0)
+        sp["tokens_out"] = sp.get("tokens_out", 0) + int(tokens_out or 0)
+
+
+@contextmanager
+def trace_run():
+    """Collect every span finished inside the block (including worker threads started via _submit)."""
+    trace: List[Dict[str, Any]] = []
+    token = _RUN_TRACE.set(trace)
+    try:
+        yield trace
+    finally:
+        _RUN_TRACE.reset(token)
+
+
+def _submit(pool: ThreadPoolExecutor, fn, *args):
+    """pool.submit that carries the caller's span/trace context into the worker."""
+    return pool.submit(contextvars.copy_context().run, fn, *args)
+
+
+def summarize_trace(trace: List[Dict[str, Any]], wall_ms: Optional[float] = None) -> Dict[str, Any]:
+    """
+    Per-stage totals for one run (stored with the history record as "perf").
+    Stage ms are summed across threads, so concurrent stages can exceed wall_ms.
+    """
+    stages: Dict[str, Dict[str, Any]] = {}
+    for sp in list(trace):
+        row = stages.setdefault(sp["stage"], {"calls": 0, "errors": 0, "ms": 0.0, **{f: 0 for f in _SPAN_FIELDS}})
+        row["calls"] += 1
+        row["errors"] += 0 if sp.get("ok", True) else 1
+        row["ms"] = round(row["ms"] + sp.get("ms", 0.0), 3)
+        for f in _SPAN_FIELDS:
+            row[f] += int(sp.get(f, 0) or 0)
+    out: Dict[str, Any] = {"stages": stages}
+    if wall_ms is not None:
+        out["wall_ms"] = round(wall_ms, 1)
+    return out
+
+
+def _parts_bytes(parts: list) -> int:
+    """Approximate request size: prompt text + decoded inline images."""
+    n = 0
+    for p in parts:
+        if "text" in p:
+            n += len(p["text"].encode("utf-8"))
+        elif "inline_data" in p:
+            n += len(p["inline_data"].get("data", "")) * 3 // 4
+    return n
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = METRICS.prometheus_text().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def start_metrics_server(port: int, host: str = METRICS_HOST) -> Optional[ThreadingHTTPServer]:
+    """Serve METRICS at /metrics on a daemon thread; None if the port is taken."""
+    try:
+        server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    except OSError:
+        return None
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    return server
+
+
+_METRICS_SERVER = start_metrics_server(METRICS_PORT) if METRICS_PORT else None
+
+
+# =============================================================================
+# History storage
+# =============================================================================
+class ThumbnailStore:
+    """
+    Content-addressed thumbnail files: <root>/<sha[:2]>/<sha>.<ext>.
+    The ref ("<sha>.<ext>") is what history records keep; identical charts
+    across runs share one file.
+    """
+
+    def __init__(self, root: str):
+        self.root = root
+
+    def path(self, ref: str) -> str:
+        return os.path.join(self.root, ref[:2], ref)
+
+    def put(self, data: bytes, ext: str = "png") -> str:
+        ref = f"{hashlib.sha256(data).hexdigest()}.{ext}"
+        dst = self.path(ref)
+        if not os.path.exists(dst):
+            os.makedirs(os.path.dirname(dst), exist_ok=True)
+            tmp = f"{dst}.{threading.get_ident()}.tmp"
+            with open(tmp, "wb") as f:
+                f.write(data)
+            os.replace(tmp, dst)
+        return ref
+
+    def read(self, ref: str) -> Optional[bytes]:
+        try:
+            with open(self.path(ref), "rb") as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def delete(self, ref: str) -> None:
+        try:
+            os.unlink(self.path(ref))
+        except OSError:
+            pass
+
+    def refs(self) -> List[str]:
+        if not os.path.isdir(self.root):
+            return []
+        return [
+            name
+            for sub in os.listdir(self.root) if os.path.isdir(os.path.join(self.root, sub))
+            for name in os.listdir(os.path.join(self.root, sub)) if not name.endswith(".tmp")
+        ]
+
+
+class HistoryStore(abc.ABC):
+    """Backend-agnostic interface for saved analyses (records carry their store id as "id")."""
+
+    @abc.abstractmethod
+    def insert(self, record: Dict[str, Any]) -> int:
+        ...
+
+    @abc.abstractmethod
+    def update(self, analysis_id: int, record: Dict[str, Any]) -> None:
+        ...
+
+    @abc.abstractmethod
+    def list(self, offset: int = 0, limit: Optional[int] = None) -> List[Dict[str, Any]]:
+        """Full records, newest first."""
+
+    @abc.abstractmethod
+    def list_summaries(self, offset: int = 0, limit: Optional[int] = None) -> List[Dict[str, Any]]:
+        """Index-only rows {id, ts, title, analysis_mode}, newest first (no payload decoding)."""
+
+    @abc.abstractmethod
+    def get(self, analysis_id: int) -> Optional[Dict[str, Any]]:
+        ...
+
+    @abc.abstractmethod
+    def delete(self, analysis_id: int) -> List[str]:
+        """Remove a run; returns thumbnail refs no other run still uses."""
+
+    @abc.abstractmethod
+    def clear(self) -> None:
+        ...
+
+    @abc.abstractmethod
+    def count(self) -> int:
+        ...
+
+    @abc.abstractmethod
+    def get_meta(self, key: str) -> Optional[str]:
+        ...
+
+    @abc.abstractmethod
+    def set_meta(self, key: str, value: str) -> None:
+        ...
+
+    @abc.abstractmethod
+    def import_records(self, records: List[Dict[str, Any]], marker: str) -> int:
+        """
+        Insert records and set meta `marker` in one transaction (all or nothing);
+        returns the count, or 0 if `marker` is already set.
+        """
+
+    @abc.abstractmethod
+    def thumbnail_refs(self) -> set:
+        """Every thumbnail ref referenced by at least one run."""
+
+    # Incremental runs: begin() → append_progress() per chart → finish(); a run that
+    # never finishes stays pending (its plan + progress rows) and can be resumed.
+    @abc.abstractmethod
+    def begin(self, record: Dict[str, Any], plan: Dict[str, Any]) -> int:
+        ...
+
+    @abc.abstractmethod
+    def append_progress(self, analysis_id: int, seq: int, entry: Dict[str, Any]) -> bool:
+        """Record one finished chart; False (nothing written) once the run is finished or deleted."""
+
+    @abc.abstractmethod
+    def progress(self, analysis_id: int) -> List[Dict[str, Any]]:
+        """Progress entries of a pending run, in chart order (each carries its "seq")."""
+
+    @abc.abstractmethod
+    def pending(self) -> List[Dict[str, Any]]:
+        """Plans of runs begun but not finished: [{id, started, **plan}], oldest first."""
+
+    @abc.abstractmethod
+    def finish(self, analysis_id: int, record: Dict[str, Any]) -> bool:
+        """Write the final record and drop the run's plan + progress rows; False if the run was deleted."""
+
+
+class SQLiteHistoryStore(HistoryStore):
+    """
+    One row per run. ts/mode/title live in indexed columns; the full payload
+    is a JSON document. WAL mode keeps readers from blocking the writer.
+    thumb_refs maps runs → thumbnail refs so unused files can be collected.
+    """
+
+    def __init__(self, path: str):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS analyses (
+                id    INTEGER PRIMARY KEY AUTOINCREMENT,
+                ts    TEXT NOT NULL,
+                mode  TEXT NOT NULL,
+                title TEXT NOT NULL,
+                doc   TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS ix_analyses_ts ON analyses(ts);
+            CREATE INDEX IF NOT EXISTS ix_analyses_mode_ts ON analyses(mode, ts);
+            CREATE TABLE IF NOT EXISTS thumb_refs (analysis_id INTEGER NOT NULL, ref TEXT NOT NULL);
+            CREATE INDEX IF NOT EXISTS ix_thumb_refs_id ON thumb_refs(analysis_id);
+            CREATE INDEX IF NOT EXISTS ix_thumb_refs_ref ON thumb_refs(ref);
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+            CREATE TABLE IF NOT EXISTS pending_runs (
+                analysis_id INTEGER PRIMARY KEY,
+                started     TEXT NOT NULL,
+                plan        TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS run_progress (
+                analysis_id INTEGER NOT NULL,
+                seq         INTEGER NOT NULL,
+                entry       TEXT NOT NULL,
+                PRIMARY KEY (analysis_id, seq)
+            ) WITHOUT ROWID;
+            """
+        )
+
+    @contextmanager
+    def _tx(self, mode: str = ""):
+        """Hold the lock for one transaction; an exception rolls it back so the connection stays usable."""
+        with self._lock:
+            self._conn.execute(f"BEGIN {mode}".strip())
+            try:
+                yield
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._conn.execute("COMMIT")
+
+    @staticmethod
+    def _row_to_record(row) -> Dict[str, Any]:
+        rec = json.loads(row[1])
+        rec["id"] = row[0]
+        return rec
+
+    @staticmethod
+    def _refs_of(doc: Dict[str, Any]) -> List[str]:
+        return sorted({th["ref"] for th in doc.get("thumbnails", []) if th.get("ref")})
+
+    def _insert_doc(self, record: Dict[str, Any]) -> int:
+        doc = {k: v for k, v in record.items() if k != "id"}
+        cur = self._conn.execute(
+            "INSERT INTO analyses (ts, mode, title, doc) VALUES (?, ?, ?, ?)",
+            (
+                doc.get("ts", ""),
+                doc.get("analysis_mode", "Single Chart Analysis"),
+                doc.get("title", ""),
+                json.dumps(doc, ensure_ascii=False),
+            ),
+        )
+        analysis_id = cur.lastrowid
+        self._conn.executemany(
+            "INSERT INTO thumb_refs (analysis_id, ref) VALUES (?, ?)",
+            [(analysis_id, ref) for ref in self._refs_of(doc)],
+        )
+        return analysis_id
+
+    def _update_doc(self, analysis_id: int, record: Dict[str, Any]) -> bool:
+        doc = {k: v for k, v in record.items() if k != "id"}
+        cur = self._conn.execute(
+            "UPDATE analyses SET ts = ?, mode = ?, title = ?, doc = ? WHERE id = ?",
+            (
+                doc.get("ts", ""),
+                doc.get("analysis_mode", "Single Chart Analysis"),
+                doc.get("title", ""),
+                json.dumps(doc, ensure_ascii=False),
+                analysis_id,
+            ),
+        )
+        if not cur.rowcount:
+            return False                         # deleted meanwhile: no refs for a run that is gone
+        self._conn.execute("DELETE FROM thumb_refs WHERE analysis_id = ?", (analysis_id,))
+        self._conn.executemany(
+            "INSERT INTO thumb_refs (analysis_id, ref) VALUES (?, ?)",
+            [(analysis_id, ref) for ref in self._refs_of(doc)],
+        )
+        return True
+
+    def insert(self, record: Dict[str, Any]) -> int:
+        with self._tx():
+            return self._insert_doc(record)
+
+    def update(self, analysis_id: int, record: Dict[str, Any]) -> None:
+        with self._tx():
+            self._update_doc(analysis_id, record)
+
+    def begin(self, record: Dict[str, Any], plan: Dict[str, Any]) -> int:
+        with self._tx():
+            analysis_id = self._insert_doc(record)
+            self._conn.execute(
+                "INSERT INTO pending_runs (analysis_id, started, plan) VALUES (?, ?, ?)",
+                (analysis_id, record.get("ts", ""), json.dumps(plan, ensure_ascii=False)),
+            )
+            return analysis_id
+
+    def append_progress(self, analysis_id: int, seq: int, entry: Dict[str, Any]) -> bool:
+        # one small row per chart; a retried chart (after resume) replaces its earlier row.
+        # Only while the run is pending: a deleted run must not collect orphan rows.
+        with self._lock:
+            cur = self._conn.execute(
+                "INSERT OR REPLACE INTO run_progress (analysis_id, seq, entry) "
+                "SELECT ?, ?, ? WHERE EXISTS (SELECT 1 FROM pending_runs WHERE analysis_id = ?)",
+                (analysis_id, seq, json.dumps(entry, ensure_ascii=False), analysis_id),
+            )
+        return cur.rowcount > 0
+
+    def progress(self, analysis_id: int) -> List[Dict[str, Any]]:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT seq, entry FROM run_progress WHERE analysis_id = ? ORDER BY seq", (analysis_id,)
+            ).fetchall()
+        return [{**json.loads(entry), "seq": seq} for seq, entry in rows]
+
+    def pending(self) -> List[Dict[str, Any]]:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT analysis_id, started, plan FROM pending_runs ORDER BY analysis_id"
+            ).fetchall()
+        return [{**json.loads(plan), "id": analysis_id, "started": started} for analysis_id, started, plan in rows]
+
+    def finish(self, analysis_id: int, record: Dict[str, Any]) -> bool:
+        with self._tx():
+            if not self._update_doc(analysis_id, record):
+                return False
+            self._conn.execute("DELETE FROM run_progress WHERE analysis_id = ?", (analysis_id,))
+            self._conn.execute("DELETE FROM pending_runs WHERE analysis_id = ?", (analysis_id,))
+            return True
+
+    def list(self, offset: int = 0, limit: Optional[int] = None) -> List[Dict[str, Any]]:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT id, doc FROM analyses ORDER BY ts DESC, id DESC LIMIT ? OFFSET ?",
+                (-1 if limit is None else limit, offset),
+            ).fetchall()
+        return [self._row_to_record(r) for r in rows]
+
+    def list_summaries(self, offset: int = 0, limit: Optional[int] = None) -> List[Dict[str, Any]]:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT id, ts, title, mode FROM analyses ORDER BY ts DESC, id DESC LIMIT ? OFFSET ?",
+                (-1 if limit is None else limit, offset),
+            ).fetchall()
+        return [{"id": r[0], "ts": r[1], "title": r[2], "analysis_mode": r[3]} for r in rows]
+
+    def get(self, analysis_id: int) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            row = self._conn.execute("SELECT id, doc FROM analyses WHERE id = ?", (analysis_id,)).fetchone()
+        return self._row_to_record(row) if row else None
+
+    def delete(self, analysis_id: int) -> List[str]:
+        with self._tx():
+            refs = [r for (r,) in self._conn.execute(
+                "SELECT DISTINCT ref FROM thumb_refs WHERE analysis_id = ?", (analysis_id,)
+            )]
+            self._conn.execute("DELETE FROM thumb_refs WHERE analysis_id = ?", (analysis_id,))
+            self._conn.execute("DELETE FROM run_progress WHERE analysis_id = ?", (analysis_id,))
+            self._conn.execute("DELETE FROM pending_runs WHERE analysis_id = ?", (analysis_id,))
+            self._conn.execute("DELETE FROM analyses WHERE id = ?", (analysis_id,))
+            orphans = [
+                ref for ref in refs
+                if not self._conn.execute("SELECT 1 FROM thumb_refs WHERE ref = ? LIMIT 1", (ref,)).fetchone()
+            ]
+        return orphans
+
+    def clear(self) -> None:
+        with self._tx():
+            self._conn.execute("DELETE FROM thumb_refs")
+            self._conn.execute("DELETE FROM run_progress")
+            self._conn.execute("DELETE FROM pending_runs")
+            self._conn.execute("DELETE FROM analyses")
+
+    def thumbnail_refs(self) -> set:
+        with self._lock:
+            return {r for (r,) in self._conn.execute("SELECT DISTINCT ref FROM thumb_refs")}
+
+    def count(self) -> int:
+        with self._lock:
+            (n,) = self._conn.execute("SELECT COUNT(*) FROM analyses").fetchone()
+        return n
+
+    def get_meta(self, key: str) -> Optional[str]:
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def set_meta(self, key: str, value: str) -> None:
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value))
+
+    def import_records(self, records: List[Dict[str, Any]], marker: str) -> int:
+        # IMMEDIATE takes the write lock before the marker check: of two processes
+        # importing at once, the second waits, then sees the marker and skips
+        with self._tx("IMMEDIATE"):
+            if self._conn.execute("SELECT 1 FROM meta WHERE key = ?", (marker,)).fetchone():
+                return 0
+            for record in records:
+                self._insert_doc(record)
+            self._conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (marker, _now_iso()))
+        return len(records)
+
+
+def migrate_tinydb_history(store: SQLiteHistoryStore, json_path: str = LEGACY_HISTORY_JSON) -> int:
+    """
+    One-shot import of a TinyDB history file ({"analyses": {"1": {...}, ...}}).
+    Records the import in the store's meta table, in the same transaction, so it never runs twice.
+    Returns the number of migrated records.
+    """
+    marker = f"migrated:{os.path.abspath(json_path)}"
+    if store.get_meta(marker) or not os.path.exists(json_path):
+        return 0
+    try:
+        with open(json_path, "r", encoding="utf-8") as f:
+            raw = json.load(f)
+    except (OSError, ValueError):
+        return 0
+    table = raw.get("analyses", {}) or {}
+    docs = []
+    for _, doc in sorted(table.items(), key=lambda kv: int(kv[0]) if str(kv[0]).isdigit() else 0):
+        doc.setdefault("ts", _now_iso())
+        doc.setdefault("title", _make_history_title(doc))
+        doc["thumbnails"] = _externalize_thumbnails(doc.get("thumbnails", []))
+        docs.append(doc)
+    # rows + marker commit together: a crash part-way leaves nothing to duplicate on the next start
+    return store.import_records(docs, marker)
+
+
+def migrate_inline_thumbnails(store: HistoryStore) -> int:
+    """One-shot: move base64 thumbnails still embedded in stored runs into THUMBS."""
+    marker = "thumbnails:externalized"
+    if store.get_meta(marker):
+        return 0
+    moved = 0
+    for rec in store.list():
+        if any("b64" in th for th in rec.get("thumbnails", [])):
+            rec["thumbnails"] = _externalize_thumbnails(rec["thumbnails"])
+            store.update(rec["id"], rec)
+            moved += 1
+    store.set_meta(marker, _now_iso())
+    return moved
+
+
+THUMBS = ThumbnailStore(THUMBNAIL_DIR)
+# Held while thumbnail files are written+referenced or dereferenced+unlinked,
+# so a save can never lose a shared file to a concurrent delete.
+_THUMB_GC_LOCK = threading.Lock()
+PENDING_UPLOADS = ThumbnailStore(PENDING_UPLOAD_DIR)
+# Same idea for parked uploads: held from writing the files until the run's plan references them
+_PENDING_LOCK = threading.Lock()
+
+
+def _externalize_thumbnails(thumbnails: List[Dict[str, str]]) -> List[Dict[str, str]]:
+    """[{name, b64, mime}] → [{name, ref}] (entries that already have a ref pass through)."""
+    out = []
+    for th in thumbnails or []:
+        if th.get("b64"):
+            try:
+                ref = THUMBS.put(base64.b64decode(th["b64"]), _MIME_EXT.get(th.get("mime", ""), "png"))
+            except (ValueError, OSError):
+                continue
+            out.append({"name": th.get("name", ""), "ref": ref})
+        elif th.get("ref"):
+            out.append({"name": th.get("name", ""), "ref": th["ref"]})
+    return out
+
+
+HISTORY: HistoryStore = SQLiteHistoryStore(HISTORY_DB_PATH)
+with _THUMB_GC_LOCK:
+    migrate_tinydb_history(HISTORY)
+    migrate_inline_thumbnails(HISTORY)
+
+
+def _search_text(rec: Dict[str, Any]) -> str:
+    """Text indexed for a saved run: summary, combined insight and per-chart insights."""
+    blocks = [rec.get("analysis_summary", ""), rec.get("combined_insight", "")]
+    blocks += [f"{d.get('name', '')}\n{d.get('insight', '')}" for d in rec.get("analysis_details", []) if d.get("insight")]
+    return "\n\n".join(b for b in blocks if b)
+
+
+def backfill_search_index(store: HistoryStore) -> int:
+    """One-shot: index runs saved before the search index existed."""
+    marker = f"search:backfilled:{HISTORY_DB_PATH}"
+    if storage.get_meta(marker):
+        return 0
+    n = 0
+    for rec in store.list():
+        storage.index_analysis(rec["id"], rec.get("title", ""), _search_text(rec), rec.get("ts", ""))
+        n += 1
+    storage.set_meta(marker, _now_iso())
+    return n
+
+
+backfill_search_index(HISTORY)
+
+
+def _with_defaults(it: Dict[str, Any]) -> Dict[str, Any]:
+    it.setdefault("title", "")
+    it.setdefault("analysis_mode", "Single Chart Analysis")
+    it.setdefault("analysis_summary", "")
+    it.setdefault("analysis_details", [])
+    it.setdefault("combined_insight", "")
+    it.setdefault("thumbnails", [])
+    return it
+
+
+def _store_final(payload: Dict[str, Any], analysis_id: Optional[int] = None) -> Optional[int]:
+    """
+    Insert a finished run, or finish a pending one in place; then (re)index it for search.
+    None if the pending run was deleted meanwhile (nothing is written or indexed).
+    """
     title = _make_history_title(payload)
-    analyses.insert({"ts": _now_iso(), "title": title, **payload})
+    record = {"ts": _now_iso(), "title": title, **payload}
+    with span("save_analysis") as sp:
+        with _THUMB_GC_LOCK:
+            record["thumbnails"] = _externalize_thumbnails(payload.get("thumbnails", []))
+            if analysis_id is None:
+                analysis_id = HISTORY.insert(record)
+            elif not HISTORY.finish(analysis_id, record):
+                gc_thumbnails()                  # the files just stored for it
+                return None
+        storage.index_analysis(analysis_id, title, _search_text(record), record["ts"])
+        sp["bytes_out"] = len(json.dumps(record, ensure_ascii=False).encode("utf-8"))
+    return analysis_id
+
+
+def save_analysis(payload: Dict[str, Any]) -> int:
+    """Persist a run; inline thumbnails are stored in THUMBS and kept as refs."""
+    return _store_final(payload)
+
+
+def begin_analysis(payload: Dict[str, Any], recs, settings: Dict[str, str]) -> int:
+    """
+    Create the history record of a single-chart run before its first insight
+    (status "running"). The uploads are parked in PENDING_UPLOADS and the plan
+    (settings + charts) is stored with it, so an interrupted run can be resumed.
+    """
+    record = {
+        "ts": _now_iso(), "title": f"Single • {len(recs)} chart(s) in progress",
+        "analysis_summary": "", "analysis_details": [], "combined_insight": "", **payload, "status": "running",
+    }
+    with span("save_analysis", incremental=True):
+        with _THUMB_GC_LOCK, _PENDING_LOCK:
+            record["thumbnails"] = _externalize_thumbnails(payload.get("thumbnails", []))
+            charts = [
+                {"name": r["name"], "sha": r["sha"],
+                 "ref": PENDING_UPLOADS.put(r["data"], os.path.splitext(r["name"])[1].lstrip(".").lower() or "bin")}
+                for r in recs
+            ]
+            return HISTORY.begin(record, {**settings, "charts": charts})
+
+
+def append_analysis_progress(analysis_id: int, seq: int, entry: Dict[str, Any]) -> bool:
+    """
+    Persist one finished chart of a running analysis ({name, sha, insight | error, route}).
+    False once the record is gone (deleted from History): the caller should stop.
+    """
+    return HISTORY.append_progress(analysis_id, seq, entry)
+
+
+def finish_analysis(analysis_id: int, payload: Dict[str, Any]) -> Optional[int]:
+    """
+    Replace a running record with the final run (same id) and release its parked
+    uploads. None if the record was deleted while the run was going.
+    """
+    analysis_id = _store_final(payload, analysis_id)
+    gc_pending_uploads()
+    return analysis_id
+
+
+def _with_progress(rec: Dict[str, Any]) -> Dict[str, Any]:
+    """A running/interrupted record shows the charts finished so far."""
+    if rec.get("status") != "running":
+        return rec
+    details, blocks = [], []
+    for e in HISTORY.progress(rec["id"]):
+        if e.get("error"):
+            details.append({"name": e["name"], "insight": "", "error": e["error"]})
+        else:
+            details.append({"name": e["name"], "insight": e["insight"]})
+            blocks.append(f"**{e['name']}**\n\n{e['insight']}")
+    rec["analysis_details"] = details
+    rec["analysis_summary"] = "\n\n---\n\n".join(blocks)
+    return rec
+
+
+def interrupted_analyses() -> List[Dict[str, Any]]:
+    """
+    Single-chart runs begun but never finished and not being worked on by a live
+    job (e.g. the server restarted mid-run): [{id, started, model, names, total, completed}].
+    """
+    active = JOBS.active_analysis_ids()
+    out = []
+    for plan in HISTORY.pending():
+        if plan["id"] in active:
+            continue
+        progress = HISTORY.progress(plan["id"])
+        out.append({
+            "id": plan["id"], "started": plan["started"], "model": plan.get("model", ""),
+            "names": [c["name"] for c in plan["charts"]], "total": len(plan["charts"]),
+            "completed": sum(1 for e in progress if not e.get("error")),
+        })
+    return out
+
+
+def gc_pending_uploads() -> int:
+    """Remove parked uploads no pending run references. Returns files removed."""
+    with _PENDING_LOCK:
+        live = {c["ref"] for plan in HISTORY.pending() for c in plan["charts"]}
+        dead = [ref for ref in PENDING_UPLOADS.refs() if ref not in live]
+        for ref in dead:
+            PENDING_UPLOADS.delete(ref)
+    return len(dead)
 
 
 def load_analyses() -> List[Dict[str, Any]]:
     """Return history entries newest→oldest with safe defaults."""
-    items = sorted(DB.table("analyses").all(), key=lambda d: d.get("ts", ""), reverse=True)
-    for it in items:
-        it.setdefault("title", "")
-        it.setdefault("analysis_mode", "Single Chart Analysis")
-        it.setdefault("analysis_summary", "")
-        it.setdefault("analysis_details", [])
-        it.setdefault("combined_insight", "")
-        it.setdefault("thumbnails", [])
-    return items
+    return [_with_defaults(_with_progress(it)) for it in HISTORY.list()]
 
 
 def load_latest_analysis() -> Dict[str, Any]:
-    items = load_analyses()
-    return items[0] if items else {}
+    """Newest finished run (runs still in progress are skipped), or {}."""
+    offset = 0
+    while True:
+        items = HISTORY.list(offset=offset, limit=5)
+        if not items:
+            return {}
+        for it in items:
+            if it.get("status") != "running":
+                return _with_defaults(it)
+        offset += len(items)
+
+
+def list_analyses(offset: int = 0, limit: int = 20) -> List[Dict[str, Any]]:
+    """One page of history as lightweight rows {id, ts, title, analysis_mode}, newest first."""
+    return HISTORY.list_summaries(offset=max(0, offset), limit=max(0, limit))
+
+
+def count_analyses() -> int:
+    return HISTORY.count()
+
+
+def get_analysis(analysis_id: int) -> Dict[str, Any]:
+    """Full record (summary, details, thumbnail refs) for one run, or {}."""
+    rec = HISTORY.get(analysis_id)
+    return _with_defaults(_with_progress(rec)) if rec else {}
+
+
+def delete_analysis(analysis_id: int) -> None:
+    JOBS.cancel_analysis(analysis_id)            # a live run stops writing to the record
+    _delete_record(analysis_id)
+
+
+def _delete_record(analysis_id: int) -> None:
+    with _THUMB_GC_LOCK:
+        for ref in HISTORY.delete(analysis_id):
+            THUMBS.delete(ref)
+    storage.unindex_analysis(analysis_id)
+    gc_pending_uploads()
+
+
+def clear_analyses() -> None:
+    JOBS.cancel_analysis()
+    with _THUMB_GC_LOCK:
+        HISTORY.clear()
+        gc_thumbnails()
+    storage.clear_analysis_index()
+    gc_pending_uploads()
+
+
+def search_analyses(query: str, k: int = 20) -> List[Dict[str, Any]]:
+    """BM25 search over saved runs → [{id, ts, title, snippet, score}], best first."""
+    return [
+        {"id": int(hit["ref"]), "ts": hit["ts"], "title": hit["title"], "snippet": hit["snippet"], "score": hit["score"]}
+        for hit in storage.search(query, k=k, kind="analysis")
+    ]
+
+
+def related_past_insights(query: str, exclude_id: Optional[int] = None, k: int = 3) -> List[str]:
+    """Snippets from other saved runs relevant to a chat question."""
+    hits = [h for h in search_analyses(query, k=k + 1) if h["id"] != exclude_id][:k]
+    return [f"[{h['ts'][:10]} — {h['title']}] {h['snippet']}" for h in hits]
+
+
+def gc_thumbnails() -> int:
+    """Remove thumbnail files no saved run references. Returns files removed."""
+    live = HISTORY.thumbnail_refs()
+    dead = [ref for ref in THUMBS.refs() if ref not in live]
+    for ref in dead:
+        THUMBS.delete(ref)
+    return len(dead)
 
 
 def guess_mime(name: str) -> str:
@@ -105,27 +1074,848 @@ def guess_mime(name: str) -> str:
     return "image/png"
 
 
-def decode_uploaded_files(files) -> List[Dict[str, Any]]:
-    """Read Streamlit uploaded files into [{name,data,img,b64,mime}] safe list."""
+def _flatten_rgb(img: Image.Image) -> Image.Image:
+    """RGB copy; transparent areas become white (charts are drawn on light backgrounds)."""
+    if img.mode in ("RGBA", "LA") or (img.mode == "P" and "transparency" in img.info):
+        rgba = img.convert("RGBA")
+        bg = Image.new("RGB", rgba.size, (255, 255, 255))
+        bg.paste(rgba, mask=rgba.getchannel("A"))
+        return bg
+    return img.convert("RGB")
+
+
+def preprocess_signature() -> str:
+    """Identifies the preprocessing settings (part of the insight cache key)."""
+    if MODEL_IMAGE_FORMAT == "ORIGINAL":
+        return "original"
+    return f"{MODEL_IMAGE_FORMAT}:{MODEL_IMAGE_MAX_SIDE}:{MODEL_IMAGE_QUALITY}"
+
+
+def preprocess_for_model(data: bytes, mime: str) -> Tuple[bytes, str]:
+    """
+    Shrink an upload before it is sent to a model:
+      • Downscale so the longest side is ≤ MODEL_IMAGE_MAX_SIDE (never upscales).
+      • Re-encode as MODEL_IMAGE_FORMAT at MODEL_IMAGE_QUALITY; re-encoding drops EXIF/ICC/text metadata.
+      • Keep the original bytes if the result would not be smaller.
+    """
+    if MODEL_IMAGE_FORMAT not in _FORMAT_MIME:
+        return data, mime
+    try:
+        img = Image.open(io.BytesIO(data))
+        img.draft("RGB", (MODEL_IMAGE_MAX_SIDE, MODEL_IMAGE_MAX_SIDE))  # JPEG: decode at reduced scale
+        img = _flatten_rgb(img)
+        resized = max(img.size) > MODEL_IMAGE_MAX_SIDE
+        if resized:
+            img.thumbnail((MODEL_IMAGE_MAX_SIDE, MODEL_IMAGE_MAX_SIDE), Image.LANCZOS)
+        buf = io.BytesIO()
+        if MODEL_IMAGE_FORMAT == "PNG":
+            img.save(buf, format="PNG", optimize=True)
+        else:
+            img.save(buf, format=MODEL_IMAGE_FORMAT, quality=MODEL_IMAGE_QUALITY, optimize=True)
+        out = buf.getvalue()
+    except Exception:
+        return data, mime
+    if len(out) >= len(data) and not resized:
+        return data, mime
+    return out, _FORMAT_MIME[MODEL_IMAGE_FORMAT]
+
+
+class _ViewCache:
+    """Thread-safe LRU bounded by total weight (bytes); shared by all sessions."""
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._items: "OrderedDict[Any, Tuple[Any, int]]" = OrderedDict()
+        self._total = 0
+        self._lock = threading.Lock()
+
+    def peek(self, key):
+        with self._lock:
+            hit = self._items.get(key)
+            if hit is None:
+                return None
+            self._items.move_to_end(key)
+            return hit[0]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._items.clear()
+            self._total = 0
+
+    def get_or_build(self, key, build, weigh):
+        with self._lock:
+            hit = self._items.get(key)
+            if hit is not None:
+                self._items.move_to_end(key)
+                return hit[0]
+        value = build()                      # built outside the lock; a rare duplicate build is harmless
+        size = weigh(value)
+        with self._lock:
+            if key not in self._items:
+                self._items[key] = (value, size)
+                self._total += size
+            while self._total > self.max_bytes and len(self._items) > 1:
+                _, (_, old) = self._items.popitem(last=False)
+                self._total -= old
+        return value
+
+
+_UPLOAD_VIEWS = _ViewCache(UPLOAD_VIEW_CACHE_MB * 1024 * 1024)
+
+
+class UploadRecord:
+    """
+    Compact upload: the raw bytes are the only buffer the record owns.
+    img (RGB) and the model payload (b64/mime/bytes_model) are derived on
+    demand and kept in the shared, size-bounded _UPLOAD_VIEWS cache keyed by
+    content hash, so identical uploads share them and idle ones get evicted.
+    Supports rec["key"] / rec.get("key") like the old dict records.
+    """
+
+    __slots__ = ("name", "data", "sha")
+    _FIELDS = frozenset(("name", "data", "sha", "bytes_in", "img", "b64", "mime", "bytes_model"))
+
+    def __init__(self, name: str, data: bytes, sha: Optional[str] = None):
+        self.name = name
+        self.data = data
+        self.sha = sha or hashlib.sha256(data).hexdigest()
+
+    @property
+    def bytes_in(self) -> int:
+        return len(self.data)
+
+    @property
+    def img(self) -> Image.Image:
+        return _UPLOAD_VIEWS.get_or_build(
+            ("img", self.sha),
+            lambda: _flatten_rgb(Image.open(io.BytesIO(self.data))),   # same pixels as the cold thumbnail path
+            lambda im: im.width * im.height * len(im.getbands()),
+        )
+
+    def _model_view(self) -> Tuple[str, str, int]:
+        def build():
+            with span("preprocess", bytes_in=len(self.data)) as sp:
+                model_bytes, mime = preprocess_for_model(self.data, guess_mime(self.name))
+                sp["bytes_out"] = len(model_bytes)
+            return base64.b64encode(model_bytes).decode("utf-8"), mime, len(model_bytes)
+        return _UPLOAD_VIEWS.get_or_build(("model", self.sha, preprocess_signature()), build, lambda v: len(v[0]))
+
+    @property
+    def b64(self) -> str:
+        return self._model_view()[0]
+
+    @property
+    def mime(self) -> str:
+        return self._model_view()[1]
+
+    @property
+    def bytes_model(self) -> int:
+        return self._model_view()[2]
+
+    def __getitem__(self, key: str):
+        if key not in self._FIELDS:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def get(self, key: str, default=None):
+        return getattr(self, key) if key in self._FIELDS else default
+
+
+def _is_image(data: bytes) -> bool:
+    try:
+        with Image.open(io.BytesIO(data)) as probe:  # header only; rejects non-images
+            probe.size
+        return True
+    except Exception:
+        return False
+
+
+def decode_uploaded_files(files, cache: Optional[Dict[str, UploadRecord]] = None) -> List[UploadRecord]:
+    """
+    Read Streamlit uploaded files into a safe list of UploadRecord.
+    data/img are the original upload; b64/mime are the preprocessed model payload.
+    Pass a dict (e.g. from st.session_state) as `cache` to reuse records across
+    reruns; it is keyed by file id + content hash and pruned to the current files.
+    """
     out = []
     if not files:
+        if cache is not None:
+            cache.clear()
         return out
-    for f in files:
-        data = f.getvalue()
-        if not data or len(data) < 10:
-            continue
+    with span("decode") as sp:
+        seen: Dict[str, UploadRecord] = {}
+        for f in files:
+            data = f.getvalue()
+            if not data or len(data) < 10:
+                continue
+            sha = hashlib.sha256(data).hexdigest()
+            key = f"{getattr(f, 'file_id', None) or f.name}:{sha}"
+            rec = cache.get(key) if cache is not None else None
+            if rec is None:
+                if not _is_image(data):
+                    continue
+                rec = UploadRecord(f.name, data, sha)
+            seen[key] = rec
+            out.append(rec)
+        if cache is not None:
+            cache.clear()
+            cache.update(seen)
+        sp["bytes_in"] = sum(r.bytes_in for r in out)
+        return out
+
+
+def decode_chart_files(paths: List[str], rejected: Optional[List[Tuple[str, str]]] = None) -> List[UploadRecord]:
+    """
+    decode_uploaded_files for files on disk. Unreadable / non-image files are
+    skipped; if `rejected` is given, each skipped file is appended as (path, reason).
+    """
+    out = []
+    for path in paths:
         try:
-            img = Image.open(io.BytesIO(data)).convert("RGB")
-        except Exception:
+            with open(path, "rb") as f:
+                data = f.read()
+        except OSError as e:
+            if rejected is not None:
+                rejected.append((path, f"unreadable: {e.strerror or e}"))
             continue
-        b64 = base64.b64encode(data).decode("utf-8")
-        out.append({"name": f.name, "data": data, "img": img, "b64": b64, "mime": guess_mime(f.name)})
+        if len(data) < 10 or not _is_image(data):
+            if rejected is not None:
+                rejected.append((path, "not a readable image"))
+            continue
+        out.append(UploadRecord(os.path.basename(path), data))
     return out
 
 
+def format_bytes(n: int) -> str:
+    if n < 1024:
+        return f"{n} B"
+    if n < 1024 * 1024:
+        return f"{n / 1024:.1f} KB"
+    return f"{n / (1024 * 1024):.1f} MB"
+
+
+def preprocessing_report(uploads) -> str:
+    """One-line summary of bytes saved by preprocess_for_model across uploads."""
+    before = sum(r.get("bytes_in", 0) for r in uploads)
+    after = sum(r.get("bytes_model", 0) for r in uploads)
+    if not before:
+        return ""
+    pct = 100.0 * (before - after) / before
+    return f"🗜️ Model payload: {format_bytes(before)} → {format_bytes(after)} ({pct:.0f}% smaller)"
+
+
+# =============================================================================
+# Insight cache (content-addressed, persistent)
+# =============================================================================
+class InsightCache:
+    """
+    SQLite-backed answer cache keyed by insight_cache_key().
+      • TTL: entries older than ttl_s are treated as misses and purged.
+      • Size: beyond max_entries, least-recently-used rows are evicted.
+      • Counters: hits / misses / evictions for this process (see stats()).
+    The TTL/size sweep runs every `evict_every` puts (and on the first one),
+    so the table may briefly hold up to evict_every - 1 extra rows.
+    """
+
+    def __init__(self, path: str, max_entries: int = 5000, ttl_s: int = 7 * 24 * 3600, evict_every: int = 32):
+        self.max_entries = max_entries
+        self.ttl_s = ttl_s
+        self.evict_every = max(1, evict_every)
+        self._puts = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS insights ("
+            " key TEXT PRIMARY KEY, value TEXT NOT NULL,"
+            " created REAL NOT NULL, last_used REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS ix_insights_last_used ON insights(last_used)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS ix_insights_created ON insights(created)")
+
+    def get(self, key: str) -> Optional[str]:
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute("SELECT value, created FROM insights WHERE key = ?", (key,)).fetchone()
+            if row and now - row[1] <= self.ttl_s:
+                self._conn.execute("UPDATE insights SET last_used = ? WHERE key = ?", (now, key))
+                self.hits += 1
+                return row[0]
+            if row:
+                self._conn.execute("DELETE FROM insights WHERE key = ?", (key,))
+                self.evictions += 1
+            self.misses += 1
+            return None
+
+    def peek(self, key: str) -> Optional[str]:
+        """A live entry, or None; unlike get() it leaves counters and recency alone (for probes)."""
+        with self._lock:
+            row = self._conn.execute("SELECT value, created FROM insights WHERE key = ?", (key,)).fetchone()
+        return row[0] if row and time.time() - row[1] <= self.ttl_s else None
+
+    def put(self, key: str, value: str) -> None:
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO insights (key, value, created, last_used) VALUES (?, ?, ?, ?)",
+                (key, value, now, now),
+            )
+            if self._puts % self.evict_every == 0:
+                self._evict(now)
+            self._puts += 1
+
+    def _evict(self, now: float) -> None:
+        cur = self._conn.execute("DELETE FROM insights WHERE created < ?", (now - self.ttl_s,))
+        self.evictions += max(cur.rowcount, 0)
+        (count,) = self._conn.execute("SELECT COUNT(*) FROM insights").fetchone()
+        if count > self.max_entries:
+            cur = self._conn.execute(
+                "DELETE FROM insights WHERE key IN ("
+                " SELECT key FROM insights ORDER BY last_used ASC LIMIT ?)",
+                (count - self.max_entries,),
+            )
+            self.evictions += max(cur.rowcount, 0)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM insights")
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            (size,) = self._conn.execute("SELECT COUNT(*) FROM insights").fetchone()
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions, "size": size}
+
+
+INSIGHT_CACHE = InsightCache(INSIGHT_CACHE_PATH, INSIGHT_CACHE_MAX_ENTRIES, INSIGHT_CACHE_TTL_S)
+
+
+def insight_cache_key(kind: str, recs, audience: str, model_name: str, output_style: str) -> str:
+    """sha256 over image bytes + model + prompt version + audience + style + preprocessing."""
+    h = hashlib.sha256()
+    for field in (kind, model_name, PROMPT_VERSION, audience, output_style, preprocess_signature()):
+        h.update(field.encode("utf-8"))
+        h.update(b"\0")
+    for r in recs:
+        h.update((r.get("sha") or hashlib.sha256(r["data"]).hexdigest()).encode("ascii"))
+    return h.hexdigest()
+
+
+@dataclass(frozen=True)
+class Insight:
+    """
+    Outcome of one insight request. `error` is set when the request failed (the
+    text may then hold partial output); failure is never inferred from the text.
+    """
+    text: str
+    error: str = ""
+
+    @property
+    def failed(self) -> bool:
+        return bool(self.error) or not self.text
+
+
+class InsightFailed(Exception):
+    """Raised by the stream helpers after a failed stream; chunks already yielded were partial output."""
+
+
+INSIGHT_CANCELLED = "Cancelled"          # error of a chart whose job was cancelled before it finished
+
+
+def _api_error(e: Exception) -> str:
+    return f"API Error: {e}"
+
+
+def _is_cacheable(text: str) -> bool:
+    return bool(text) and text != "No insights generated."
+
+
+# =============================================================================
+# Request coalescing (single-flight across sessions)
+# =============================================================================
+class Flight:
+    """
+    One in-flight model call shared by every caller with the same insight key.
+    The producer appends chunks; subscribers replay them from the start, so a
+    late joiner still sees the whole answer. Joined chunks = the final text.
+    """
+
+    def __init__(self, key: str):
+        self.key = key
+        self.chunks: List[str] = []
+        self.route: Dict[str, Any] = {}
+        self.error = ""                           # set by the producer when the backend call failed
+        self.subscribers = 0
+        self.done = False
+        self.aborted = False
+        self._cond = threading.Condition()
+
+    def push(self, piece: str) -> None:
+        with self._cond:
+            self.chunks.append(piece)
+            self._cond.notify_all()
+
+    def fail(self, error: str) -> None:
+        with self._cond:
+            self.error = error
+            self._cond.notify_all()
+
+    def finish(self, aborted: bool = False) -> None:
+        with self._cond:
+            self.done = True
+            self.aborted = aborted
+            self._cond.notify_all()
+
+    def follow(self) -> Iterator[str]:
+        """Yield chunks as they arrive until the producer finishes."""
+        i = 0
+        while True:
+            with self._cond:
+                while i >= len(self.chunks) and not self.done:
+                    self._cond.wait()
+                pending = self.chunks[i:]
+                finished = self.done
+            for piece in pending:
+                yield piece
+            i += len(pending)
+            if finished and i >= len(self.chunks):
+                return
+
+    def result(self) -> Insight:
+        """Block until finished; the joined answer plus the producer's error (if any)."""
+        with self._cond:
+            while not self.done:
+                self._cond.wait()
+            return Insight("".join(self.chunks).strip(), self.error)
+
+
+class SingleFlight:
+    """
+    Process-wide registry of Flights keyed by insight_cache_key(), which already
+    covers image hashes + model + prompt version/settings. Identical concurrent
+    requests from any session share one backend call; the flight leaves the
+    registry when it finishes, so later requests go to INSIGHT_CACHE instead.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._flights: Dict[str, Flight] = {}
+        self.leaders = 0
+        self.coalesced = 0
+
+    def join(self, key: str) -> Tuple[Flight, bool]:
+        """(flight, is_leader) — the leader must produce; either way the caller is subscribed."""
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = Flight(key)
+                self.leaders += 1
+            else:
+                self.coalesced += 1
+            flight.subscribers += 1
+        return flight, leader
+
+    def leave(self, flight: Flight) -> None:
+        with self._lock:
+            flight.subscribers -= 1
+
+    def abandoned(self, flight: Flight) -> bool:
+        """True (and unregistered) once nobody is listening; joiners then start a new flight."""
+        with self._lock:
+            if flight.subscribers > 0:
+                return False
+            self._flights.pop(flight.key, None)
+            return True
+
+    def release(self, flight: Flight) -> None:
+        with self._lock:
+            if self._flights.get(flight.key) is flight:
+                del self._flights[flight.key]
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {"in_flight": len(self._flights), "leaders": self.leaders, "coalesced": self.coalesced}
+
+
+FLIGHTS = SingleFlight()
+
+
+# =============================================================================
+# Resilient transport (retry + deadline + circuit breaker)
+# =============================================================================
+class BackendError(RuntimeError):
+    """A model call failed after retries (or was rejected by an open circuit)."""
+
+    def __init__(self, backend: str, message: str, status: Optional[int] = None):
+        super().__init__(f"{backend}: {message}")
+        self.backend = backend
+        self.status = status
+
+
+class BackendUnavailable(BackendError):
+    """Raised without calling the backend while its circuit is open."""
+
+
+class RateLimited(BackendError):
+    """Raised without calling the backend when its quota queue is longer than RATE_MAX_WAIT_S."""
+
+
+class CircuitBreaker:
+    """
+    closed → open after `failure_threshold` consecutive transient failures.
+    While open, calls fail fast; after `reset_s` one probe call is let through
+    (half-open) and its outcome closes or re-opens the circuit.
+    """
+
+    def __init__(self, name: str, failure_threshold: int = 5, reset_s: float = 30.0):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_s = reset_s
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self._probing = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            if self.opened_at is None:
+                return "closed"
+            return "half-open" if time.monotonic() - self.opened_at >= self.reset_s else "open"
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if time.monotonic() - self.opened_at >= self.reset_s and not self._probing:
+                self._probing = True
+                return True
+            return False
+
+    def record_success(self) -> None:
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._probing = False
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self.failures += 1
+            if self._probing or self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+            self._probing = False
+
+
+_BREAKERS = {name: CircuitBreaker(name, BREAKER_FAILURE_THRESHOLD, BREAKER_RESET_S) for name in BACKEND_CONCURRENCY}
+
+
+def _status_of(exc: Exception) -> Optional[int]:
+    if isinstance(exc, GroqStatusError):
+        return exc.status_code
+    if isinstance(exc, google_errors.APIError):
+        return exc.code
+    return None
+
+
+def _is_transient(exc: Exception) -> bool:
+    """429 / 408 / 5xx, timeouts and connection errors are worth retrying."""
+    status = _status_of(exc)
+    if status is not None:
+        return status in (408, 429) or status >= 500
+    return isinstance(exc, (httpx.TimeoutException, httpx.TransportError, GroqConnectionError, TimeoutError))
+
+
+def _is_model_failure(exc: Exception) -> bool:
+    """
+    Whether a failed call says something about the model's health (ROUTER samples).
+    Bad requests (4xx) are the caller's fault, and an open circuit made no call at all.
+    """
+    if isinstance(exc, BackendUnavailable):
+        return False
+    return _is_transient(exc.__cause__ if isinstance(exc, BackendError) and exc.__cause__ else exc)
+
+
+def _retry_after_s(exc: Exception) -> Optional[float]:
+    response = getattr(exc, "response", None)
+    value = getattr(response, "headers", {}).get("retry-after") if response is not None else None
+    try:
+        return float(value) if value is not None else None
+    except ValueError:
+        return None
+
+
+def _backoff_s(attempt: int, exc: Exception) -> float:
+    """Full-jitter exponential backoff, never shorter than a server Retry-After."""
+    delay = random.uniform(0, min(RETRY_MAX_DELAY_S, RETRY_BASE_DELAY_S * (2 ** attempt)))
+    return max(delay, _retry_after_s(exc) or 0.0)
+
+
+_ATTEMPT_TIMEOUT_S: "contextvars.ContextVar[float]" = contextvars.ContextVar("attempt_timeout_s", default=MODEL_TIMEOUT_S)
+
+
+def _attempt_timeout_s() -> float:
+    """HTTP timeout for the backend request being made now (see _call_with_resilience)."""
+    return _ATTEMPT_TIMEOUT_S.get()
+
+
+def _call_with_resilience(backend: str, fn, *args):
+    """
+    Run fn(*args) under the backend's circuit breaker with jittered retries
+    on transient errors, bounded by MODEL_DEADLINE_S: each attempt's timeout is
+    capped at what is left of the deadline. Raises BackendError.
+    """
+    breaker = _BREAKERS[backend]
+    deadline = time.monotonic() + MODEL_DEADLINE_S
+    for attempt in range(MODEL_MAX_RETRIES + 1):
+        if not breaker.allow():
+            raise BackendUnavailable(backend, "temporarily unavailable (circuit open), try again shortly")
+        token = _ATTEMPT_TIMEOUT_S.set(max(0.1, min(MODEL_TIMEOUT_S, deadline - time.monotonic())))
+        try:
+            result = fn(*args)
+        except Exception as e:
+            transient = _is_transient(e)
+            if transient:
+                breaker.record_failure()
+            else:
+                breaker.record_success()   # the backend answered; the request itself was bad
+            delay = _backoff_s(attempt, e)
+            ticket = _RATE_TICKET.get()
+            if _status_of(e) == 429 and ticket is not None:
+                RATE_LIMITER.penalize(ticket["model"], delay)
+            if not transient or attempt == MODEL_MAX_RETRIES or time.monotonic() + delay > deadline:
+                raise BackendError(backend, str(e), _status_of(e)) from e
+            time.sleep(delay)
+            continue
+        finally:
+            _ATTEMPT_TIMEOUT_S.reset(token)
+        breaker.record_success()
+        return result
+
+
+def _stream_with_resilience(backend: str, fn, *args) -> Iterator[str]:
+    """
+    Streaming variant: retries only until the first chunk arrives; after that
+    a failure is surfaced to the caller (partial text cannot be replayed).
+    """
+    def _open():
+        it = iter(fn(*args))
+        first = next(it, None)
+        return first, it
+
+    first, it = _call_with_resilience(backend, _open)
+    if first is None:
+        return
+    yield first
+    try:
+        yield from it
+    except Exception as e:
+        if _is_transient(e):
+            _BREAKERS[backend].record_failure()
+        raise BackendError(backend, str(e), _status_of(e)) from e
+
+
+def backend_health() -> Dict[str, str]:
+    """Circuit state per backend, for display."""
+    return {name: br.state for name, br in _BREAKERS.items()}
+
+
+# =============================================================================
+# Rate limiting (shared quotas, fair per-session queueing)
+# =============================================================================
+_RATE_OWNER: "contextvars.ContextVar[str]" = contextvars.ContextVar("rate_owner", default="")
+_RATE_TICKET: "contextvars.ContextVar[Optional[Dict[str, Any]]]" = contextvars.ContextVar("rate_ticket", default=None)
+
+
+class TokenBucket:
+    """Requests/min + tokens/min buckets for one model; each holds at most one minute of quota."""
+
+    def __init__(self, rpm: int, tpm: int):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.requests = float(rpm)
+        self.tokens = float(tpm)
+        self.paused_until = 0.0                   # set after a 429 so nobody piles on
+        self._updated = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        dt = max(0.0, now - self._updated)
+        self._updated = now
+        if self.rpm:
+            self.requests = min(float(self.rpm), self.requests + dt * self.rpm / 60.0)
+        if self.tpm:
+            self.tokens = min(float(self.tpm), self.tokens + dt * self.tpm / 60.0)
+
+    def wait_s(self, now: float, requests: int = 1, tokens: int = 0) -> float:
+        """Seconds until `requests` calls costing `tokens` in total would fit."""
+        self._refill(now)
+        wait = self.paused_until - now
+        if self.rpm:
+            wait = max(wait, (requests - self.requests) * 60.0 / self.rpm)
+        if self.tpm:
+            wait = max(wait, (tokens - self.tokens) * 60.0 / self.tpm)
+        return max(0.0, wait)
+
+    def take(self, tokens: int) -> None:
+        if self.rpm:
+            self.requests -= 1
+        if self.tpm:
+            self.tokens -= tokens
+
+
+class RateLimiter:
+    """
+    Process-wide quota gate in front of every backend call (see RATE_LIMITS).
+    Waiters queue per model and per owner (a Streamlit session, or "" for CLI/batch);
+    the head of the queue rotates round-robin across owners, so one session's big
+    batch cannot starve another session's single chart or chat answer.
+    """
+
+    def __init__(self, limits: Dict[str, Tuple[int, int]], max_wait_s: float):
+        self.limits = limits
+        self.max_wait_s = max_wait_s
+        self.granted = 0
+        self.waited_s = 0.0
+        self.throttled = 0                        # 429s reported by backends
+        self._buckets: Dict[str, TokenBucket] = {}
+        self._queues: Dict[str, "OrderedDict[str, deque]"] = {}
+        self._cond = threading.Condition()
+
+    def _bucket(self, model_name: str) -> Optional[TokenBucket]:
+        bucket = self._buckets.get(model_name)
+        if bucket is None:
+            rpm, tpm = self.limits.get(_backend_of(model_name), (0, 0))
+            if not rpm and not tpm:
+                return None
+            bucket = self._buckets[model_name] = TokenBucket(rpm, tpm)
+        return bucket
+
+    def acquire(self, model_name: str, tokens: int) -> Dict[str, Any]:
+        """Block until this call may go out; returns the ticket to settle() afterwards."""
+        owner = _RATE_OWNER.get()
+        ticket = {"model": model_name, "estimate": tokens, "taken": 0, "used": 0, "waited_s": 0.0}
+        t0 = time.monotonic()
+        with self._cond:
+            bucket = self._bucket(model_name)
+            if bucket is None:
+                return ticket
+            cost = min(tokens, bucket.tpm) if bucket.tpm else tokens   # an oversize call still gets a turn
+            queue_ = self._queues.setdefault(model_name, OrderedDict())
+            queue_.setdefault(owner, deque()).append(ticket)
+            deadline = t0 + self.max_wait_s
+            try:
+                while True:
+                    now = time.monotonic()
+                    head = queue_[next(iter(queue_))][0]
+                    if head is ticket:
+                        wait = bucket.wait_s(now, 1, cost)
+                        if wait <= 0:
+                            bucket.take(cost)
+                            ticket["taken"] = cost
+                            break
+                        if now + wait > deadline:
+                            raise RateLimited(_backend_of(model_name), f"rate limit for {model_name}: "
+                                              f"~{wait:.0f}s until the next free slot, try again shortly")
+                        self._cond.wait(wait)
+                    else:
+                        if now >= deadline:
+                            raise RateLimited(_backend_of(model_name), f"rate limit queue for {model_name} "
+                                              f"is full, try again shortly")
+                        self._cond.wait(deadline - now)
+            finally:
+                waiting = queue_[owner]
+                waiting.remove(ticket)
+                if waiting:
+                    queue_.move_to_end(owner)          # round-robin: this owner goes to the back
+                else:
+                    del queue_[owner]
+                self._cond.notify_all()
+            ticket["waited_s"] = time.monotonic() - t0
+            self.granted += 1
+            self.waited_s += ticket["waited_s"]
+        return ticket
+
+    def settle(self, ticket: Dict[str, Any]) -> None:
+        """Replace the tokens taken at acquire() with the usage the backend reported (if any)."""
+        if not ticket["used"]:
+            return
+        with self._cond:
+            bucket = self._buckets.get(ticket["model"])
+            if bucket is not None and bucket.tpm:
+                bucket.tokens = min(float(bucket.tpm), bucket.tokens + ticket["taken"] - ticket["used"])
+                self._cond.notify_all()
+
+    def penalize(self, model_name: str, delay_s: float) -> None:
+        """A 429 came back: hold every new call to this model for delay_s."""
+        with self._cond:
+            self.throttled += 1
+            bucket = self._bucket(model_name)
+            if bucket is not None:
+                bucket.paused_until = max(bucket.paused_until, time.monotonic() + delay_s)
+
+    def expected_wait(self, model_name: str, requests: int = 1, tokens: Optional[int] = None) -> float:
+        """Rough seconds before `requests` new calls would all have gone out, given the current queue."""
+        with self._cond:
+            bucket = self._bucket(model_name)
+            if bucket is None:
+                return 0.0
+            queued = [t for waiting in self._queues.get(model_name, {}).values() for t in waiting]
+            per_call = tokens if tokens is not None else RATE_IMAGE_TOKENS + RATE_OUTPUT_TOKENS
+            return bucket.wait_s(time.monotonic(), len(queued) + requests,
+                                 sum(t["estimate"] for t in queued) + requests * per_call)
+
+    def snapshot(self) -> Dict[str, Dict[str, Any]]:
+        """Per limited model: quota, what is left, queue length and expected wait, for display."""
+        out: Dict[str, Dict[str, Any]] = {}
+        with self._cond:
+            models = list(dict.fromkeys(MODEL_CHOICES + list(self._buckets)))
+        for model_name in models:
+            with self._cond:
+                bucket = self._bucket(model_name)
+                if bucket is None:
+                    continue
+                waiting = self._queues.get(model_name, {})
+                bucket.wait_s(time.monotonic())
+                out[model_name] = {
+                    "rpm": bucket.rpm, "tpm": bucket.tpm,
+                    "requests_left": int(bucket.requests), "tokens_left": int(bucket.tokens),
+                    "queued": sum(len(w) for w in waiting.values()), "sessions": len(waiting),
+                }
+            out[model_name]["wait_s"] = round(self.expected_wait(model_name), 1)
+        return out
+
+    def stats(self) -> Dict[str, Any]:
+        with self._cond:
+            return {"granted": self.granted, "waited_s": round(self.waited_s, 1), "throttled": self.throttled}
+
+
+RATE_LIMITER = RateLimiter(RATE_LIMITS, RATE_MAX_WAIT_S)
+
+
+@contextmanager
+def rate_owner(owner: str):
+    """Queue model calls made inside the block (and worker threads started via _submit) under `owner`."""
+    token = _RATE_OWNER.set(owner or "")
+    try:
+        yield
+    finally:
+        _RATE_OWNER.reset(token)
+
+
+def estimate_request_tokens(parts: list) -> int:
+    """Prompt text ≈ chars/4, a flat RATE_IMAGE_TOKENS per image, plus RATE_OUTPUT_TOKENS for the answer."""
+    text = sum(estimate_tokens(p["text"]) for p in parts if "text" in p)
+    images = sum(1 for p in parts if "inline_data" in p)
+    return text + images * RATE_IMAGE_TOKENS + RATE_OUTPUT_TOKENS
+
 
 def _ensure_backend(model_name: str) -> str:
-    """Return 'google' or 'groq'; raise helpful errors if not configured."""
+    """Return 'google', 'groq' or 'stub'; raise helpful errors if not configured."""
+    if model_name.startswith(STUB_MODEL):
+        return "stub"
     if model_name.startswith("gemini"):
         if not google_client:
             raise RuntimeError("GEMINI_API_KEY missing. Put it in .env")
@@ -136,16 +1926,49 @@ def _ensure_backend(model_name: str) -> str:
         return "groq"
 
 
+def _google_request_config() -> google_types.GenerateContentConfig:
+    return google_types.GenerateContentConfig(
+        http_options=google_types.HttpOptions(timeout=int(_attempt_timeout_s() * 1000)),
+    )
+
+
 def _call_google_generate(model_name: str, parts: list) -> str:
     """Google GenAI: send multimodal parts (text + inline_data images)."""
     res = google_client.models.generate_content(
         model=model_name,
-        contents=[{"role": "user", "parts": parts}]
+        contents=[{"role": "user", "parts": parts}],
+        config=_google_request_config(),
     )
+    _record_google_usage(getattr(res, "usage_metadata", None))
     return (getattr(res, "text", "") or "").strip()
 
 
-def _call_groq_generate(model_name: str, parts: list) -> str:
+def _stream_google_generate(model_name: str, parts: list) -> Iterator[str]:
+    """Google GenAI streaming variant: yields text chunks as they arrive."""
+    usage = None
+    for chunk in google_client.models.generate_content_stream(
+        model=model_name,
+        contents=[{"role": "user", "parts": parts}],
+        config=_google_request_config(),
+    ):
+        usage = getattr(chunk, "usage_metadata", None) or usage   # cumulative; last one wins
+        text = getattr(chunk, "text", "") or ""
+        if text:
+            yield text
+    _record_google_usage(usage)
+
+
+def _record_google_usage(usage) -> None:
+    if usage is not None:
+        record_usage(getattr(usage, "prompt_token_count", 0) or 0, getattr(usage, "candidates_token_count", 0) or 0)
+
+
+def _record_groq_usage(usage) -> None:
+    if usage is not None:
+        record_usage(getattr(usage, "prompt_tokens", 0) or 0, getattr(usage, "completion_tokens", 0) or 0)
+
+
+def _groq_content(parts: list) -> list:
     """
     Groq: build messages content supporting text & images via data URLs.
     Each item is {"type":"text","text":...} or {"type":"image_url","image_url":{"url":...}}
@@ -158,24 +1981,319 @@ def _call_groq_generate(model_name: str, parts: list) -> str:
             mime = p["inline_data"].get("mime_type", "image/png")
             b64  = p["inline_data"].get("data", "")
             groq_content.append({"type": "image_url", "image_url": {"url": f"data:{mime};base64,{b64}"}})
+    return groq_content
+
 
+def _call_groq_generate(model_name: str, parts: list) -> str:
+    groq_content = _groq_content(parts)
     resp = groq_client.chat.completions.create(
         model=model_name,
         messages=[{"role": "user", "content": groq_content if groq_content else ""}],
         temperature=0.2,
         max_tokens=1200,
+        timeout=_attempt_timeout_s(),
     )
+    _record_groq_usage(getattr(resp, "usage", None))
     return (resp.choices[0].message.content or "").strip()
 
 
-def _generate_with_backend(model_name: str, parts: list) -> str:
-    """Route generation to Google or Groq."""
+def _stream_groq_generate(model_name: str, parts: list) -> Iterator[str]:
+    """Groq streaming variant (OpenAI-style deltas)."""
+    groq_content = _groq_content(parts)
+    stream = groq_client.chat.completions.create(
+        model=model_name,
+        messages=[{"role": "user", "content": groq_content if groq_content else ""}],
+        temperature=0.2,
+        max_tokens=1200,
+        stream=True,
+        timeout=_attempt_timeout_s(),
+    )
+    usage = None
+    for chunk in stream:
+        # Groq reports usage on the final chunk (x_groq.usage)
+        usage = getattr(getattr(chunk, "x_groq", None), "usage", None) or getattr(chunk, "usage", None) or usage
+        delta = chunk.choices[0].delta.content if chunk.choices else None
+        if delta:
+            yield delta
+    _record_groq_usage(usage)
+
+
+def _call_stub_generate(model_name: str, parts: list) -> str:
+    """Offline backend: a canned insight derived from the prompt and images (no network)."""
+    time.sleep(STUB_LATENCY_S)
+    images = [p["inline_data"].get("data", "") for p in parts if "inline_data" in p]
+    prompt = " ".join(p["text"] for p in parts if "text" in p)
+    digest = hashlib.sha256("".join(images).encode() + prompt.encode()).hexdigest()[:12]
+    text = "\n".join([
+        f"- Stub insight {digest} ({model_name}).",
+        f"- {len(images)} image(s), {len(prompt)} prompt characters.",
+        "- Replace --model stub with a real model for actual analysis.",
+    ])
+    record_usage(estimate_tokens(prompt), estimate_tokens(text))
+    return text
+
+
+def _stream_stub_generate(model_name: str, parts: list) -> Iterator[str]:
+    yield from _call_stub_generate(model_name, parts).splitlines(keepends=True)
+
+
+_GENERATE = {"google": _call_google_generate, "groq": _call_groq_generate, "stub": _call_stub_generate}
+_STREAM = {"google": _stream_google_generate, "groq": _stream_groq_generate, "stub": _stream_stub_generate}
+
+
+def _generate_on_model(model_name: str, parts: list) -> str:
+    """
+    One model, no routing (waits for its rate-limit turn, then a free per-backend slot).
+    ROUTER samples only the backend call itself, so queueing never reads as a slow model.
+    """
+    backend = _ensure_backend(model_name)
+    ticket = RATE_LIMITER.acquire(model_name, estimate_request_tokens(parts))
+    token = _RATE_TICKET.set(ticket)
+    try:
+        with _BACKEND_SLOTS[backend]:
+            t0 = time.monotonic()
+            try:
+                text = _call_with_resilience(backend, _GENERATE[backend], model_name, parts)
+            except Exception as e:
+                if _is_model_failure(e):
+                    ROUTER.record(model_name, time.monotonic() - t0, ok=False)
+                raise
+            ROUTER.record(model_name, time.monotonic() - t0, ok=True)
+            return text
+    finally:
+        _RATE_TICKET.reset(token)
+        RATE_LIMITER.settle(ticket)
+
+
+def _stream_on_model(model_name: str, parts: list) -> Iterator[str]:
     backend = _ensure_backend(model_name)
-    return _call_google_generate(model_name, parts) if backend == "google" else _call_groq_generate(model_name, parts)
+    stream = _STREAM[backend]
+    ticket = RATE_LIMITER.acquire(model_name, estimate_request_tokens(parts))
+    try:
+        with _BACKEND_SLOTS[backend]:
+            chunks = _stream_with_resilience(backend, stream, model_name, parts)
+            busy = 0.0                        # backend time only, not the consumer's between chunks
+            while True:
+                # the ticket is current only while the backend runs, never across a yield
+                token = _RATE_TICKET.set(ticket)
+                t0 = time.monotonic()
+                try:
+                    chunk = next(chunks, None)
+                except Exception as e:
+                    if _is_model_failure(e):
+                        ROUTER.record(model_name, busy + time.monotonic() - t0, ok=False)
+                    raise
+                finally:
+                    _RATE_TICKET.reset(token)
+                busy += time.monotonic() - t0
+                if chunk is None:
+                    ROUTER.record(model_name, busy, ok=True)
+                    return
+                yield chunk
+    finally:
+        RATE_LIMITER.settle(ticket)
+
+
+# =============================================================================
+# Model routing (failover + hedging)
+# =============================================================================
+def _backend_of(model_name: str) -> str:
+    if model_name.startswith(STUB_MODEL):
+        return "stub"
+    return "google" if model_name.startswith("gemini") else "groq"
+
+
+def _is_configured(model_name: str) -> bool:
+    backend = _backend_of(model_name)
+    if backend == "stub":
+        return True
+    return bool(google_client) if backend == "google" else bool(groq_client)
+
+
+class ModelRouter:
+    """
+    Tracks rolling latency/error samples of backend calls per model (rate-limit
+    and slot waits excluded) and orders candidates:
+    the requested model first unless it is degraded (open circuit, error rate
+    above max_error_rate, or p90 latency above slow_p90_s), in which case the
+    healthy alternatives from MODEL_CHOICES go first.
+    """
+
+    def __init__(self, models: List[str], window: int = 50, min_samples: int = 5,
+                 max_error_rate: float = 0.5, slow_p90_s: float = 45.0):
+        self.models = list(models)
+        self.window = window
+        self.min_samples = min_samples
+        self.max_error_rate = max_error_rate
+        self.slow_p90_s = slow_p90_s
+        self._samples: Dict[str, deque] = {m: deque(maxlen=window) for m in self.models}
+        self._lock = threading.Lock()
+
+    def record(self, model_name: str, latency_s: float, ok: bool) -> None:
+        with self._lock:
+            self._samples.setdefault(model_name, deque(maxlen=self.window)).append((latency_s, ok))
+
+    def stats(self, model_name: str) -> Dict[str, Any]:
+        with self._lock:
+            samples = list(self._samples.get(model_name, ()))
+        lat = sorted(l for l, ok in samples if ok)
+        pick = lambda q: round(lat[min(len(lat) - 1, int(q * len(lat)))], 3) if lat else None
+        errors = sum(1 for _, ok in samples if not ok)
+        return {
+            "n": len(samples),
+            "error_rate": round(errors / len(samples), 3) if samples else 0.0,
+            "p50_s": pick(0.5),
+            "p90_s": pick(0.9),
+        }
+
+    def is_degraded(self, model_name: str) -> bool:
+        if _BREAKERS[_backend_of(model_name)].state == "open":
+            return True
+        st_ = self.stats(model_name)
+        if st_["n"] < self.min_samples:
+            return False
+        return st_["error_rate"] > self.max_error_rate or (st_["p90_s"] or 0.0) > self.slow_p90_s
+
+    def plan(self, model_name: str) -> Tuple[List[str], str]:
+        """(ordered candidates, reason) for a request on model_name; the offline stub never fails over to a real model."""
+        offline = _backend_of(model_name) == "stub"
+        alts = [m for m in self.models if m != model_name and _is_configured(m) and not self.is_degraded(m)
+                and (_backend_of(m) == "stub") == offline]
+        if alts and self.is_degraded(model_name):
+            return alts + [model_name], f"failover: {model_name} degraded"
+        return [model_name] + alts, "primary"
+
+
+ROUTER = ModelRouter(MODEL_CHOICES, ROUTER_WINDOW, ROUTER_MIN_SAMPLES, ROUTER_MAX_ERROR_RATE, ROUTER_SLOW_P90_S)
+_HEDGE_POOL = ThreadPoolExecutor(max_workers=2 * sum(BACKEND_CONCURRENCY.values()) + 2, thread_name_prefix="hedge")
+
+
+def _note_attempt(route: Dict[str, Any], model_name: str, t0: float, error: Optional[Exception] = None) -> None:
+    entry = {"model": model_name, "ok": error is None, "latency_s": round(time.monotonic() - t0, 3)}
+    if error is not None:
+        entry["error"] = str(error)[:200]
+    route["attempts"].append(entry)
+    if error is None:
+        route["served_by"] = model_name
+        route["failover"] = model_name != route["requested"]
+
+
+def _generate_with_backend(model_name: str, parts: list, route: Optional[Dict[str, Any]] = None) -> str:
+    """
+    Route generation through ROUTER: try candidates in plan order, failing over
+    on errors; with HEDGE_AFTER_S > 0 a slow call is raced against the next
+    candidate and the first success wins. `route` (if given) receives the decision.
+    Timed as the "generate" stage, with payload bytes and reported token usage.
+    """
+    with span("generate", model=model_name, bytes_in=_parts_bytes(parts)) as sp:
+        text = _route_generate(model_name, parts, route)
+        sp["bytes_out"] = len(text.encode("utf-8"))
+    return text
+
+
+def _route_generate(model_name: str, parts: list, route: Optional[Dict[str, Any]] = None) -> str:
+    order, reason = ROUTER.plan(model_name)
+    route = route if route is not None else {}
+    route.update(requested=model_name, reason=reason, hedged=False, attempts=[])
+    last_exc: Optional[Exception] = None
+
+    if HEDGE_AFTER_S <= 0 or len(order) == 1:
+        for m in order:
+            t0 = time.monotonic()
+            try:
+                text = _generate_on_model(m, parts)
+            except Exception as e:
+                _note_attempt(route, m, t0, e)
+                last_exc = e
+                continue
+            _note_attempt(route, m, t0)
+            return text
+        raise last_exc
+
+    backups = list(order[1:])
+    # future → (model, its own start time), so each attempt's latency is measured from its launch
+    futures = {_submit(_HEDGE_POOL, _generate_on_model, order[0], parts): (order[0], time.monotonic())}
+    while futures:
+        timeout = HEDGE_AFTER_S if backups and not route["hedged"] else None
+        done, _ = wait(list(futures), timeout=timeout, return_when=FIRST_COMPLETED)
+        if not done:                      # first candidate is slow → race the next one
+            route["hedged"] = True
+            m = backups.pop(0)
+            futures[_submit(_HEDGE_POOL, _generate_on_model, m, parts)] = (m, time.monotonic())
+            continue
+        for f in done:
+            m, t0 = futures.pop(f)
+            try:
+                text = f.result()
+            except Exception as e:
+                _note_attempt(route, m, t0, e)
+                last_exc = e
+                continue
+            _note_attempt(route, m, t0)
+            return text
+        if not futures and backups:       # everything in flight failed → fail over
+            m = backups.pop(0)
+            futures[_submit(_HEDGE_POOL, _generate_on_model, m, parts)] = (m, time.monotonic())
+    raise last_exc
+
+
+def stream_with_backend(model_name: str, parts: list, route: Optional[Dict[str, Any]] = None) -> Iterator[str]:
+    """
+    Streaming counterpart of _generate_with_backend: yields text chunks.
+    Fails over between candidates until a first chunk arrives (no hedging).
+    """
+    sp: Dict[str, Any] = {"stage": "generate", "model": model_name, "ok": True, "streamed": True,
+                          "bytes_in": _parts_bytes(parts), "bytes_out": 0}
+    t0 = time.perf_counter()
+    chunks = _route_stream(model_name, parts, route)
+    try:
+        while True:
+            # the span is current only while the backend runs, never across a yield
+            token = _CURRENT_SPAN.set(sp)
+            try:
+                chunk = next(chunks, None)
+            finally:
+                _CURRENT_SPAN.reset(token)
+            if chunk is None:
+                break
+            sp["bytes_out"] += len(chunk.encode("utf-8"))
+            yield chunk
+    except Exception:
+        sp["ok"] = False
+        raise
+    finally:
+        sp["ms"] = round((time.perf_counter() - t0) * 1000.0, 3)
+        _finish_span(sp)
+
+
+def _route_stream(model_name: str, parts: list, route: Optional[Dict[str, Any]] = None) -> Iterator[str]:
+    order, reason = ROUTER.plan(model_name)
+    route = route if route is not None else {}
+    route.update(requested=model_name, reason=reason, hedged=False, attempts=[])
+    last_exc: Optional[Exception] = None
+    for m in order:
+        t0 = time.monotonic()
+        chunks = _stream_on_model(m, parts)
+        try:
+            first = next(chunks, None)
+        except Exception as e:
+            _note_attempt(route, m, t0, e)
+            last_exc = e
+            continue
+        _note_attempt(route, m, t0)
+        if first is not None:
+            yield first
+        yield from chunks
+        return
+    raise last_exc
+
 
+def router_snapshot() -> Dict[str, Dict[str, Any]]:
+    """Per-model rolling stats + degraded flag, for display."""
+    return {m: {**ROUTER.stats(m), "degraded": ROUTER.is_degraded(m)} for m in ROUTER.models}
 
-def generate_individual_insight_from_rec(rec, audience, model_name, output_style):
-    """Generate simple, audience-specific insights for one chart."""
+
+def _individual_prompt(audience: str, output_style: str) -> str:
     if audience == "Business Professional":
         prompt = f"""
 You are a business analyst explaining this chart to non-technical managers.
@@ -202,16 +2320,10 @@ Focus on:
 Keep it brief and factual.
 Style: {"bullet points" if output_style.startswith("Structured") else "compact technical paragraph"}.
 """
-
-    parts = [{"text": prompt}, {"inline_data": {"mime_type": rec["mime"], "data": rec["b64"]}}]
-    try:
-        return _generate_with_backend(model_name, parts) or "No insights generated."
-    except Exception as e:
-        return f"API Error: {e}"
+    return prompt
 
 
-def generate_cross_chart_insight(recs, audience, model_name, output_style):
-    """Generate overall summary across several charts, tailored by audience."""
+def _cross_prompt(audience: str, output_style: str) -> str:
     if audience == "Business Professional":
         prompt = f"""
 You are explaining the combined message from all charts to business leaders.
@@ -238,27 +2350,679 @@ Focus on:
 Keep the answer tight and technical.
 Style: {"bullet list" if output_style.startswith("Structured") else "compact paragraph"}.
 """
+    return prompt
+
+
+def _cache_hit_route(model_name: str) -> Dict[str, Any]:
+    return {"requested": model_name, "served_by": model_name, "reason": "cache", "cached": True,
+            "failover": False, "hedged": False, "attempts": []}
 
-    parts = [{"text": prompt}] + [
+
+def _generate_cached(key: str, model_name: str, parts, use_cache: bool,
+                     route: Optional[Dict[str, Any]] = None) -> Insight:
+    """
+    `parts` is a list, or a zero-arg callable that builds it only on a cache miss.
+    Answers served by a failover model are returned but not cached under the requested model.
+    A miss joins any identical call already in flight (FLIGHTS) instead of starting another.
+    """
+    route = route if route is not None else {}
+    if use_cache:
+        cached = INSIGHT_CACHE.get(key)
+        if cached is not None:
+            route.update(_cache_hit_route(model_name))
+            return Insight(cached)
+    flight, leader = FLIGHTS.join(key)
+    try:
+        if leader:
+            _produce(flight, key, model_name, parts, use_cache, route, stream=False)
+            return flight.result()
+        result = flight.result()
+        route.update(flight.route, coalesced=True)
+        return result
+    finally:
+        FLIGHTS.leave(flight)
+
+
+def _produce(flight: Flight, key: str, model_name: str, parts, use_cache: bool,
+             route: Dict[str, Any], stream: bool) -> None:
+    """
+    Run the backend call for a flight, pushing exactly what _generate_cached /
+    _stream_cached would return or yield; a failure is recorded with flight.fail().
+    A streamed flight stops early (uncached) once every subscriber has left,
+    e.g. after a cancelled job.
+    """
+    flight.route = route
+    chunks: List[str] = []
+    aborted = False
+    try:
+        parts = parts() if callable(parts) else parts
+        if stream:
+            for piece in stream_with_backend(model_name, parts, route):
+                chunks.append(piece)
+                flight.push(piece)
+                if FLIGHTS.abandoned(flight):
+                    aborted = True
+                    return
+        else:
+            text = _generate_with_backend(model_name, parts, route) or "No insights generated."
+            chunks.append(text)
+            flight.push(text)
+    except Exception as e:
+        flight.fail(_api_error(e))
+    else:
+        text = "".join(chunks).strip()
+        if stream and not text:
+            flight.push("No insights generated.")
+        elif use_cache and _is_cacheable(text) and not route.get("failover") and not route.get("degraded"):
+            INSIGHT_CACHE.put(key, text)      # before release, so the next caller hits the cache
+    finally:
+        FLIGHTS.release(flight)
+        flight.finish(aborted)
+
+
+def _stream_cached(key: str, model_name: str, parts, use_cache: bool,
+                   route: Optional[Dict[str, Any]] = None) -> Iterator[str]:
+    """
+    Yield chunks; a cache hit arrives as one chunk. Joined output matches _generate_cached;
+    a failure raises InsightFailed after the chunks that did arrive.
+    The backend stream runs on its own thread (the flight's producer) so identical
+    requests from other sessions can replay it; this generator only follows the flight.
+    """
+    route = route if route is not None else {}
+    if use_cache:
+        cached = INSIGHT_CACHE.get(key)
+        if cached is not None:
+            route.update(_cache_hit_route(model_name))
+            yield cached
+            return
+    flight, leader = FLIGHTS.join(key)
+    try:
+        if leader:
+            # a plain thread, not a pool: map-reduce parts may start further flights
+            threading.Thread(
+                target=contextvars.copy_context().run,
+                args=(_produce, flight, key, model_name, parts, use_cache, route, True),
+                name="flight", daemon=True,
+            ).start()
+        yield from flight.follow()
+        if not leader:
+            route.update(flight.route, coalesced=True)
+        if flight.error:
+            raise InsightFailed(flight.error)
+    finally:
+        FLIGHTS.leave(flight)
+
+
+def _individual_parts(rec, audience, output_style) -> list:
+    return [{"text": _individual_prompt(audience, output_style)}, {"inline_data": {"mime_type": rec["mime"], "data": rec["b64"]}}]
+
+
+def _cross_parts(recs, audience, output_style) -> list:
+    return [{"text": _cross_prompt(audience, output_style)}] + [
         {"inline_data": {"mime_type": r["mime"], "data": r["b64"]}} for r in recs
     ]
+
+
+def generate_individual_insight_from_rec(rec, audience, model_name, output_style, use_cache: bool = True,
+                                         route: Optional[Dict[str, Any]] = None) -> Insight:
+    """Generate simple, audience-specific insights for one chart (served from INSIGHT_CACHE when possible)."""
+    key = insight_cache_key("single", [rec], audience, model_name, output_style)
+    return _generate_cached(key, model_name, _individual_parts(rec, audience, output_style), use_cache, route)
+
+
+def stream_individual_insight_from_rec(rec, audience, model_name, output_style, use_cache: bool = True,
+                                       route: Optional[Dict[str, Any]] = None) -> Iterator[str]:
+    """Streaming version of generate_individual_insight_from_rec (raises InsightFailed on failure)."""
+    key = insight_cache_key("single", [rec], audience, model_name, output_style)
+    yield from _stream_cached(key, model_name, _individual_parts(rec, audience, output_style), use_cache, route)
+
+
+def _map_prompt(names: List[str]) -> str:
+    listing = "\n".join(f"- {n}" for n in names)
+    return f"""
+You will see {len(names)} chart image(s), in this order:
+{listing}
+
+For EACH chart write a heading "### <chart name>" followed by 2-4 short factual lines:
+what it measures, the main trend or comparison, and notable values or anomalies.
+No recommendations; another step will combine these notes.
+"""
+
+
+def summarize_chart_batches(recs, audience, model_name, output_style,
+                            existing: Optional[Dict[str, str]] = None,
+                            batch_size: Optional[int] = None,
+                            route: Optional[Dict[str, Any]] = None) -> Tuple[List[str], bool]:
+    """
+    Map step of hierarchical cross analysis → (sections, degraded): one text section
+    per chart/batch in upload order.
+      • Reuses per-chart insights: `existing` (sha → text) first, then cached single insights.
+      • Remaining charts go in batches of `batch_size` images, run in parallel.
+    Failed batches become a short "(summary unavailable)" section instead of aborting
+    the run; `degraded` is then True so the combined answer is not cached.
+    """
+    existing = existing or {}
+    size = max(1, batch_size or CROSS_MAP_BATCH_SIZE)
+    sections: List[Optional[str]] = [None] * len(recs)
+    todo: List[int] = []
+    reused = 0
+    for i, rec in enumerate(recs):
+        text = existing.get(rec.get("sha", "")) or INSIGHT_CACHE.peek(
+            insight_cache_key("single", [rec], audience, model_name, output_style)
+        )
+        if text:
+            sections[i] = f"### {rec['name']}\n{text}"
+            reused += 1
+        else:
+            todo.append(i)
+
+    batches = [todo[j:j + size] for j in range(0, len(todo), size)]
+
+    def _summarize(batch: List[int]) -> Tuple[str, bool]:
+        batch_recs = [recs[i] for i in batch]
+        key = insight_cache_key("cross-map", batch_recs, audience, model_name, output_style)
+        parts = [{"text": _map_prompt([r["name"] for r in batch_recs])}] + [
+            {"inline_data": {"mime_type": r["mime"], "data": r["b64"]}} for r in batch_recs
+        ]
+        result = _generate_cached(key, model_name, parts, True)
+        if result.failed:
+            return "\n\n".join(f"### {r['name']}\n(summary unavailable)" for r in batch_recs), True
+        return result.text, False
+
+    degraded = False
+    if batches:
+        workers = max(1, min(ANALYSIS_MAX_WORKERS, len(batches)))
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="cross-map") as pool:
+            futures = [_submit(pool, _summarize, batch) for batch in batches]
+            for batch, fut in zip(batches, futures):
+                sections[batch[0]], failed = fut.result()
+                degraded = degraded or failed
+    if route is not None:
+        route.update(map_reduce=True, map_batches=len(batches), map_reused=reused, degraded=degraded)
+    return [sec for sec in sections if sec], degraded
+
+
+def _reduce_parts(sections: List[str], audience: str, output_style: str) -> list:
+    prompt = _cross_prompt(audience, output_style) + f"""
+You are given written notes on {len(sections)} chart section(s) instead of the images.
+Base the answer only on these notes.
+
+""" + "\n\n".join(sections)
+    return [{"text": prompt}]
+
+
+def _cross_parts_for(recs, audience, model_name, output_style, existing, route):
+    """Direct multimodal request, or map-reduce above CROSS_MAP_REDUCE_THRESHOLD charts."""
+    if len(recs) <= CROSS_MAP_REDUCE_THRESHOLD:
+        return lambda: _cross_parts(recs, audience, output_style)
+    # summarize_chart_batches flags route["degraded"], which keeps the reduce answer out of the cache
+    return lambda: _reduce_parts(
+        summarize_chart_batches(recs, audience, model_name, output_style, existing=existing, route=route)[0],
+        audience, output_style,
+    )
+
+
+def generate_cross_chart_insight(recs, audience, model_name, output_style, use_cache: bool = True,
+                                 route: Optional[Dict[str, Any]] = None,
+                                 existing: Optional[Dict[str, str]] = None) -> Insight:
+    """
+    Generate overall summary across several charts, tailored by audience (cached like single insights).
+    Large batches switch to map-reduce; `existing` (sha → insight) lets the map step skip charts.
+    """
+    key = insight_cache_key("cross", recs, audience, model_name, output_style)
+    route = route if route is not None else {}
+    parts = _cross_parts_for(recs, audience, model_name, output_style, existing, route)
+    return _generate_cached(key, model_name, parts, use_cache, route)
+
+
+def stream_cross_chart_insight(recs, audience, model_name, output_style, use_cache: bool = True,
+                               route: Optional[Dict[str, Any]] = None,
+                               existing: Optional[Dict[str, str]] = None) -> Iterator[str]:
+    """
+    Streaming version of generate_cross_chart_insight (map step runs first, the
+    reduce step streams); raises InsightFailed on failure.
+    """
+    key = insight_cache_key("cross", recs, audience, model_name, output_style)
+    route = route if route is not None else {}
+    parts = _cross_parts_for(recs, audience, model_name, output_style, existing, route)
+    yield from _stream_cached(key, model_name, parts, use_cache, route)
+
+
+def iter_individual_insights(
+    recs, audience, model_name, output_style, max_workers: Optional[int] = None,
+    routes: Optional[List[Dict[str, Any]]] = None,
+) -> Iterator[Tuple[int, Insight]]:
+    """
+    Run per-chart insights on a bounded thread pool.
+    Yields (index_in_recs, Insight) in completion order, so callers can fill
+    placeholders as soon as each chart finishes and re-order by index afterwards.
+    If `routes` (one dict per rec) is given, each receives that chart's routing decision.
+    """
+    if not recs:
+        return
+    workers = max(1, min(max_workers or ANALYSIS_MAX_WORKERS, len(recs)))
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="insight") as pool:
+        futures = {
+            _submit(pool, generate_individual_insight_from_rec, rec, audience, model_name, output_style,
+                    True, routes[i] if routes is not None else None): i
+            for i, rec in enumerate(recs)
+        }
+        for fut in as_completed(futures):
+            yield futures[fut], fut.result()
+
+
+def iter_individual_insight_streams(
+    recs, audience, model_name, output_style, max_workers: Optional[int] = None,
+    routes: Optional[List[Dict[str, Any]]] = None, cancel: Optional[threading.Event] = None,
+) -> Iterator[Tuple[int, str, bool, str]]:
+    """
+    Streaming flavour of iter_individual_insights (same `routes` contract).
+    Yields (index_in_recs, text_so_far, done, error) on the caller's thread;
+    error is "" until a chart ends in failure. Workers push chunks through a
+    queue so Streamlit widgets are only touched here.
+    Once `cancel` is set, charts not yet started are skipped and running
+    streams stop at their next chunk; either way the chart ends with error
+    INSIGHT_CANCELLED and nothing partial is cached.
+    """
+    if not recs:
+        return
+    events: "queue.Queue[Tuple[int, Optional[str], str]]" = queue.Queue()
+
+    def _work(i, rec):
+        error = ""
+        try:
+            if cancel is not None and cancel.is_set():
+                error = INSIGHT_CANCELLED
+                return
+            route = routes[i] if routes is not None else None
+            for piece in stream_individual_insight_from_rec(rec, audience, model_name, output_style, route=route):
+                events.put((i, piece, ""))
+                if cancel is not None and cancel.is_set():
+                    error = INSIGHT_CANCELLED         # the partial text is unusable
+                    break
+        except InsightFailed as e:
+            error = str(e)
+        finally:
+            events.put((i, None, error))
+
+    workers = max(1, min(max_workers or ANALYSIS_MAX_WORKERS, len(recs)))
+    texts = [""] * len(recs)
+    remaining = len(recs)
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="insight") as pool:
+        for i, rec in enumerate(recs):
+            _submit(pool, _work, i, rec)
+        while remaining:
+            i, piece, error = events.get()
+            if piece is None:
+                remaining -= 1
+                texts[i] = texts[i].strip()
+                yield i, texts[i], True, error
+            else:
+                texts[i] += piece
+                yield i, texts[i], False, ""
+
+
+# =============================================================================
+# Background analysis jobs (outlive reruns; partial results; cancellation)
+# =============================================================================
+class AnalysisJob:
+    """
+    One Run Analysis request. Workers update it under its lock; the UI only
+    reads snapshot(). status: queued → running → done | failed | cancelled.
+    """
+
+    def __init__(self, recs, mode: str, model_name: str, audience: str, output_style: str, owner: str = ""):
+        self.id = uuid.uuid4().hex[:12]
+        self.owner = owner                        # submitting session (fair rate-limit queueing)
+        self.recs = list(recs)
+        self.mode = mode
+        self.model_name = model_name
+        self.audience = audience
+        self.output_style = output_style
+        self.status = "queued"
+        self.created = time.time()
+        self.finished_at = 0.0
+        self.texts = [""] * len(self.recs)        # per chart, grows while streaming
+        self.errors = [""] * len(self.recs)       # per chart, set when it failed or was cancelled
+        self.finished = [False] * len(self.recs)
+        self.combined = ""                        # cross mode
+        self.details: List[Dict[str, Any]] = []
+        self.summary = ""
+        self.thumbnails: List[Dict[str, str]] = []
+        self.analysis_id: Optional[int] = None    # history id (single mode: created when the run starts)
+        self.routes: List[Dict[str, Any]] = [{} for _ in self.recs] if mode.startswith("Single") else [{}]
+        self.perf: Optional[Dict[str, Any]] = None
+        self.error = ""
+        self.cancel_event = threading.Event()
+        self._lock = threading.Lock()
+
+    @property
+    def done(self) -> bool:
+        return self.status in ("done", "failed", "cancelled")
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "id": self.id, "status": self.status, "mode": self.mode, "model": self.model_name,
+                "names": [r["name"] for r in self.recs], "texts": list(self.texts), "errors": list(self.errors),
+                "finished": list(self.finished),
+                "completed": sum(self.finished), "total": len(self.recs), "combined": self.combined,
+                "details": list(self.details), "summary": self.summary, "thumbnails": self.thumbnails,
+                "analysis_id": self.analysis_id, "error": self.error, "perf": self.perf,
+                "shas": [r["sha"] for r in self.recs if r["data"]],   # a resumed run may miss uploads
+            }
+
+    def _set(self, **fields) -> None:
+        with self._lock:
+            for k, v in fields.items():
+                setattr(self, k, v)
+
+
+def _run_single_job(job: AnalysisJob, routes: List[Dict[str, Any]]) -> None:
+    # charts already finished (a resumed run) are kept; each new one is persisted as it completes
+    todo = [i for i, done in enumerate(job.finished) if not done]
+    for j, text, done, error in iter_individual_insight_streams(
+        [job.recs[i] for i in todo], job.audience, job.model_name, job.output_style,
+        routes=[routes[i] for i in todo], cancel=job.cancel_event,
+    ):
+        i = todo[j]
+        with job._lock:
+            job.texts[i] = text
+            job.errors[i] = error
+            job.finished[i] = done
+        if done and job.analysis_id is not None and (text or error) and error != INSIGHT_CANCELLED:
+            rec = job.recs[i]
+            entry = {"name": rec["name"], "sha": rec["sha"], "route": routes[i]}
+            entry.update({"error": error or "No insights generated."} if error or not text else {"insight": text})
+            if not append_analysis_progress(job.analysis_id, i, entry):
+                job.cancel_event.set()           # the record was deleted: stop the remaining charts
+    # upload order; failed or cancelled charts are errors, never saved as insights
+    details, blocks = [], []
+    for rec, text, error in zip(job.recs, job.texts, job.errors):
+        if error or not text:
+            details.append({"name": rec["name"], "insight": "", "error": error or "No insights generated."})
+            continue
+        details.append({"name": rec["name"], "insight": text})
+        blocks.append(f"**{rec['name']}**\n\n{text}")
+    job._set(details=details, summary="\n\n---\n\n".join(blocks))
+
+
+def _run_cross_job(job: AnalysisJob, route: Dict[str, Any]) -> None:
+    combined = ""
+    try:
+        for piece in stream_cross_chart_insight(job.recs, job.audience, job.model_name, job.output_style,
+                                                route=route):
+            combined += piece
+            job._set(combined=combined)
+            if job.cancel_event.is_set():
+                return                           # a partial combined insight is not a result
+    except InsightFailed as e:
+        job._set(error=str(e))
+        return
+    combined = combined.strip()
+    if not combined:
+        job._set(error="No insights generated.")
+        return
+    job._set(combined=combined, summary=combined, finished=[True] * len(job.recs))
+
+
+def _run_job(job: AnalysisJob) -> None:
+    if job.cancel_event.is_set():
+        job._set(status="cancelled", finished_at=time.time())
+        return
+    job._set(status="running")
+    t0 = time.perf_counter()
     try:
-        return _generate_with_backend(model_name, parts) or "No insights generated."
+        with trace_run() as trace, rate_owner(job.owner):
+            job._set(thumbnails=make_thumbnails([r for r in job.recs if r["data"]]))
+            single = job.mode.startswith("Single")
+            routes = job.routes
+            if single:
+                if job.analysis_id is None:
+                    job._set(analysis_id=begin_analysis(
+                        {"analysis_mode": job.mode, "thumbnails": job.thumbnails}, job.recs,
+                        {"mode": job.mode, "model": job.model_name, "audience": job.audience,
+                         "style": job.output_style},
+                    ))
+                _run_single_job(job, routes)
+            else:
+                _run_cross_job(job, routes[0])
+            job._set(perf=summarize_trace(trace, (time.perf_counter() - t0) * 1000.0))
+            # whatever finished is kept, even when the job was cancelled midway
+            if job.summary:
+                payload = {
+                    "analysis_mode": job.mode,
+                    "analysis_summary": job.summary,
+                    "analysis_details": job.details,
+                    "combined_insight": job.combined if not single else "",
+                    "thumbnails": job.thumbnails,
+                    "routing": ([{"name": r["name"], **rt} for r, rt in zip(job.recs, routes)] if single else routes),
+                    "perf": job.perf,
+                }
+                if single:
+                    job._set(analysis_id=finish_analysis(job.analysis_id, payload))
+                else:
+                    job._set(analysis_id=save_analysis(payload))
+            elif job.analysis_id is not None:
+                _delete_record(job.analysis_id)      # nothing usable came back: no empty run in History
+                job._set(analysis_id=None)
+        if job.cancel_event.is_set():
+            status = "cancelled"
+            if single and job.analysis_id is None and job.summary:
+                job._set(error="The run was deleted from History while it was going; nothing was saved.")
+        elif job.summary:
+            status = "done"
+        else:
+            status = "failed"
+            if not job.error:
+                job._set(error="Analysis failed for every chart — nothing was saved.")
+        job._set(status=status, finished_at=time.time())
     except Exception as e:
-        return f"API Error: {e}"
+        # a single-chart run keeps its progress and stays resumable (interrupted_analyses)
+        job._set(status="failed", error=f"{type(e).__name__}: {e}", finished_at=time.time())
 
-def make_thumbnails(uploads: List[Dict[str, Any]], max_w=320) -> List[Dict[str, str]]:
-    """Small PNG previews for the History expander."""
-    thumbs = []
-    for rec in uploads:
-        img: Image.Image = rec["img"].copy()
-        w, h = img.size
-        if w > max_w:
-            img = img.resize((max_w, int(h * (max_w / float(w)))))
-        buf = io.BytesIO()
-        img.save(buf, format="PNG")
-        b64 = base64.b64encode(buf.getvalue()).decode("utf-8")
-        thumbs.append({"name": rec["name"], "b64": b64})
+
+class JobManager:
+    """
+    In-process job queue shared by all sessions; jobs outlive the script run that
+    submitted them. Queued jobs wait per owner (a Streamlit session); a free slot
+    goes to the queued owner with the fewest running jobs, the one served longest
+    ago among ties, so one session's pile of batches cannot keep another
+    session's job queued.
+    """
+
+    def __init__(self, max_workers: int, retention_s: int):
+        self.retention_s = retention_s
+        self.max_workers = max(1, max_workers)
+        self._pool = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="job")
+        self._jobs: Dict[str, AnalysisJob] = {}
+        self._queues: "OrderedDict[str, deque]" = OrderedDict()   # owner → queued jobs
+        self._running: Dict[str, int] = {}                         # owner → running jobs
+        self._served: Dict[str, int] = {}                          # owner → turn of its latest start
+        self._turns = 0
+        self._lock = threading.Lock()
+
+    def _enqueue(self, job: AnalysisJob) -> None:
+        """Queue a registered job under its owner and start it if a slot is free (caller holds _lock)."""
+        self._queues.setdefault(job.owner, deque()).append(job)
+        self._dispatch()
+
+    def _dispatch(self) -> None:
+        # caller holds _lock
+        while sum(self._running.values()) < self.max_workers and self._queues:
+            owner = min(self._queues, key=lambda o: (self._running.get(o, 0), self._served.get(o, -1)))
+            waiting = self._queues[owner]
+            job = waiting.popleft()
+            if not waiting:
+                del self._queues[owner]
+            self._running[owner] = self._running.get(owner, 0) + 1
+            self._turns += 1
+            self._served[owner] = self._turns
+            self._pool.submit(self._run, job)
+
+    def _forget_idle(self, owner: str) -> None:
+        # caller holds _lock; an owner with nothing queued or running starts fresh next time
+        if owner not in self._queues and owner not in self._running:
+            self._served.pop(owner, None)
+
+    def _run(self, job: AnalysisJob) -> None:
+        try:
+            _run_job(job)
+        finally:
+            with self._lock:
+                self._running[job.owner] -= 1
+                if not self._running[job.owner]:
+                    del self._running[job.owner]
+                self._dispatch()
+                self._forget_idle(job.owner)
+
+    def submit(self, recs, mode: str, model_name: str, audience: str, output_style: str, owner: str = "") -> str:
+        job = AnalysisJob(recs, mode, model_name, audience, output_style, owner)
+        with self._lock:
+            self._prune()
+            self._jobs[job.id] = job
+            self._enqueue(job)
+        return job.id
+
+    def resume(self, analysis_id: int, owner: str = "") -> Optional[str]:
+        """
+        Continue an interrupted single-chart run: charts already persisted are kept,
+        the rest (and earlier failures) are analyzed and appended to the same record.
+        Returns the job id (the live one if the run is already being worked on), or None.
+        """
+        plan = next((p for p in HISTORY.pending() if p["id"] == analysis_id), None)
+        if plan is None:
+            return None
+        recs = [UploadRecord(c["name"], PENDING_UPLOADS.read(c["ref"]) or b"", c["sha"]) for c in plan["charts"]]
+        job = AnalysisJob(recs, plan["mode"], plan["model"], plan["audience"], plan["style"], owner)
+        job.analysis_id = analysis_id
+        for i, rec in enumerate(recs):
+            if not rec.data:
+                job.errors[i], job.finished[i] = "upload missing, cannot resume this chart", True
+        for e in HISTORY.progress(analysis_id):
+            if not e.get("error") and e["seq"] < len(recs):
+                job.texts[e["seq"]], job.finished[e["seq"]] = e["insight"], True
+                job.routes[e["seq"]] = e.get("route") or {}
+        with self._lock:
+            live = next((j for j in self._jobs.values() if j.analysis_id == analysis_id and not j.done), None)
+            if live is not None:
+                return live.id
+            self._prune()
+            self._jobs[job.id] = job
+            self._enqueue(job)
+        return job.id
+
+    def active_analysis_ids(self) -> set:
+        """History ids of runs a live job is still writing to."""
+        with self._lock:
+            return {j.analysis_id for j in self._jobs.values() if not j.done and j.analysis_id is not None}
+
+    def get(self, job_id: Optional[str]) -> Optional[AnalysisJob]:
+        with self._lock:
+            return self._jobs.get(job_id) if job_id else None
+
+    def cancel(self, job_id: str) -> bool:
+        job = self.get(job_id)
+        if job is None or job.done:
+            return False
+        job.cancel_event.set()
+        self._drop_queued(job)
+        return True
+
+    def _drop_queued(self, job: AnalysisJob) -> None:
+        """A cancelled job that never started ends now instead of waiting for a slot."""
+        with self._lock:
+            waiting = self._queues.get(job.owner)
+            if waiting is None or job not in waiting:
+                return
+            waiting.remove(job)
+            if not waiting:
+                del self._queues[job.owner]
+                self._forget_idle(job.owner)
+        job._set(status="cancelled", finished_at=time.time())
+
+    def cancel_analysis(self, analysis_id: Optional[int] = None) -> int:
+        """Cancel live jobs writing to a history record (every record when None); returns how many."""
+        with self._lock:
+            jobs = [j for j in self._jobs.values()
+                    if not j.done and j.analysis_id is not None and analysis_id in (None, j.analysis_id)]
+        for job in jobs:
+            job.cancel_event.set()
+            self._drop_queued(job)
+        return len(jobs)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            jobs = list(self._jobs.values())
+        out = {"queued": 0, "running": 0, "done": 0, "failed": 0, "cancelled": 0}
+        for j in jobs:
+            out[j.status] += 1
+        return out
+
+    def _prune(self) -> None:
+        cutoff = time.time() - self.retention_s
+        for job_id in [k for k, j in self._jobs.items() if j.done and j.finished_at < cutoff]:
+            del self._jobs[job_id]
+
+
+JOBS = JobManager(JOB_MAX_WORKERS, JOB_RETENTION_S)
+
+
+_THUMB_POOL = ThreadPoolExecutor(max_workers=max(1, THUMBNAIL_MAX_WORKERS), thread_name_prefix="thumb")
+
+
+def _thumbnail_format() -> str:
+    return THUMBNAIL_FORMAT if THUMBNAIL_FORMAT in _FORMAT_MIME else "WEBP"
+
+
+def _thumbnail_bytes(data: bytes, max_w: int, decoded: Optional[Image.Image] = None) -> bytes:
+    """
+    One preview. Reuses an already-decoded RGB view when there is one; otherwise
+    decodes the upload bytes (JPEGs at reduced scale via draft).
+    """
+    img = decoded
+    if img is None:
+        img = Image.open(io.BytesIO(data))
+        if img.width > max_w:
+            img.draft("RGB", (max_w, max(1, img.height * max_w // img.width)))
+        img = _flatten_rgb(img)
+    if img.width > max_w:
+        img = img.resize((max_w, max(1, round(img.height * max_w / img.width))), Image.LANCZOS, reducing_gap=2.0)
+    buf = io.BytesIO()
+    fmt = _thumbnail_format()
+    if fmt == "PNG":
+        img.save(buf, format="PNG", optimize=True)
+    elif fmt == "WEBP":
+        img.save(buf, format="WEBP", quality=THUMBNAIL_QUALITY, method=2)   # ~15x faster than the default, ~10% larger
+    else:
+        img.save(buf, format=fmt, quality=THUMBNAIL_QUALITY)
+    return buf.getvalue()
+
+
+def make_thumbnails(uploads: List[Dict[str, Any]], max_w: Optional[int] = None) -> List[Dict[str, str]]:
+    """
+    Small previews for the History expander: [{name, b64, mime}], upload order.
+    Built on _THUMB_POOL and kept in _UPLOAD_VIEWS by content hash, so re-runs
+    and identical charts across sessions reuse them.
+    """
+    max_w = max_w or THUMBNAIL_MAX_W
+    fmt = _thumbnail_format()
+    mime = _FORMAT_MIME[fmt]
+
+    def _one(rec) -> Dict[str, str]:
+        sha = rec.get("sha") or hashlib.sha256(rec["data"]).hexdigest()
+        b64 = _UPLOAD_VIEWS.get_or_build(
+            ("thumb", sha, max_w, fmt, THUMBNAIL_QUALITY),
+            lambda: base64.b64encode(
+                _thumbnail_bytes(rec["data"], max_w, _UPLOAD_VIEWS.peek(("img", sha)))
+            ).decode("utf-8"),
+            len,
+        )
+        return {"name": rec["name"], "b64": b64, "mime": mime}
+
+    with span("thumbnails", bytes_in=sum(rec["bytes_in"] for rec in uploads)) as sp:
+        thumbs = list(_THUMB_POOL.map(_one, uploads)) if len(uploads) > 1 else [_one(r) for r in uploads]
+        sp["bytes_out"] = sum(len(t["b64"]) * 3 // 4 for t in thumbs)
     return thumbs
 
 
@@ -268,7 +3032,133 @@ def thumbnails_gallery(thumbnails: List[Dict[str, str]]):
     cols = st.columns(min(4, max(1, len(thumbnails))))
     for i, th in enumerate(thumbnails):
         with cols[i % len(cols)]:
-            st.image(f"data:image/png;base64,{th['b64']}", caption=th["name"], use_container_width=True)
+            if th.get("ref"):
+                path = THUMBS.path(th["ref"])
+                if os.path.exists(path):
+                    st.image(path, caption=th["name"], use_container_width=True)
+                else:
+                    st.caption(f"{th['name']} (thumbnail missing)")
+            elif th.get("b64"):
+                st.image(f"data:{th.get('mime', 'image/png')};base64,{th['b64']}", caption=th["name"],
+                         use_container_width=True)
+
+
+# =============================================================================
+# Chat context (token-budgeted)
+# =============================================================================
+_STOPWORDS = frozenset(
+    "the and for are was were what which with this that from have has how why when where who "
+    "does did can could would should about into over than then them they their there these "
+    "those chart charts show shows tell me please".split()
+)
+
+
+def estimate_tokens(text: str) -> int:
+    return (len(text) + 3) // 4 if text else 0
+
+
+def _terms(text: str) -> set:
+    return {w for w in re.findall(r"[a-z0-9]+", (text or "").lower()) if len(w) > 2 and w not in _STOPWORDS}
+
+
+def _clip_to_tokens(text: str, tokens: int) -> str:
+    limit = max(0, tokens) * 4
+    return text if len(text) <= limit else text[:limit].rsplit(" ", 1)[0] + "…"
+
+
+def _analysis_sections(analysis: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """Split a saved run into per-chart sections (+ the combined insight)."""
+    sections = [
+        {"name": d.get("name", "Chart"), "text": f"**{d.get('name', 'Chart')}**\n{d['insight']}"}
+        for d in analysis.get("analysis_details", []) if d.get("insight") and not d.get("error")
+    ]
+    if analysis.get("combined_insight"):
+        sections.append({"name": "Combined", "text": analysis["combined_insight"]})
+    if not sections and analysis.get("analysis_summary"):
+        sections = [{"name": "", "text": blk} for blk in analysis["analysis_summary"].split("\n\n---\n\n") if blk.strip()]
+    for sec in sections:
+        sec["terms"] = _terms(sec["text"])
+        sec["name_terms"] = _terms(os.path.splitext(sec["name"])[0])
+        sec["tokens"] = estimate_tokens(sec["text"])
+    return sections
+
+
+def select_analysis_sections(sections: List[Dict[str, Any]], question: str, budget_tokens: int) -> List[str]:
+    """Most relevant sections for the question that fit the budget, returned in original order."""
+    q = _terms(question)
+    ranked = sorted(
+        range(len(sections)),
+        key=lambda i: (-(len(q & sections[i]["terms"]) + 3 * len(q & sections[i]["name_terms"])), i),
+    )
+    chosen, used = [], 0
+    for i in ranked:
+        sec = sections[i]
+        if used + sec["tokens"] <= budget_tokens:
+            chosen.append((i, sec["text"]))
+            used += sec["tokens"]
+        elif not chosen:
+            chosen.append((i, _clip_to_tokens(sec["text"], budget_tokens)))
+            used = budget_tokens
+        if used >= budget_tokens:
+            break
+    return [text for _, text in sorted(chosen)]
+
+
+def _compress_turn(turn: Dict[str, str]) -> str:
+    q = " ".join((turn.get("user") or "").split()[:20])
+    a = (turn.get("assistant") or "").strip()
+    a = re.split(r"(?<=[.!?])\s", a, maxsplit=1)[0]
+    return f"- Q: {q} → A: {' '.join(a.split()[:40])}"
+
+
+def build_chat_prompt(analysis: Dict[str, Any], conversation: List[Dict[str, str]], question: str,
+                      cache: Optional[Dict[str, Any]] = None, related: Optional[List[str]] = None) -> str:
+    """
+    Prompt for a follow-up question with bounded size:
+      • analysis: only the sections most relevant to the question, ≤ CHAT_CONTEXT_TOKENS;
+      • related: optional snippets from other saved runs (see related_past_insights);
+      • older turns: rolling extractive summary, ≤ CHAT_HISTORY_TOKENS;
+      • the last CHAT_RECENT_TURNS turns verbatim.
+    `cache` (e.g. a dict in st.session_state) keeps the parsed sections per run and
+    the rolling summary, so each question only processes what is new.
+    """
+    cache = cache if cache is not None else {}
+    run_key = f"{analysis.get('id', '')}:{analysis.get('ts', '')}"
+    if cache.get("run") != run_key:
+        cache.clear()
+        cache.update(run=run_key, sections=_analysis_sections(analysis), summarized=0, summary_lines=[])
+
+    older = conversation[:-CHAT_RECENT_TURNS] if CHAT_RECENT_TURNS else conversation
+    recent = conversation[len(older):]
+    if len(older) < cache["summarized"]:          # chat was cleared / shortened
+        cache.update(summarized=0, summary_lines=[])
+    for turn in older[cache["summarized"]:]:
+        cache["summary_lines"].append(_compress_turn(turn))
+    cache["summarized"] = len(older)
+    lines, used = [], 0
+    for line in reversed(cache["summary_lines"]):  # keep the most recent lines that fit
+        used += estimate_tokens(line)
+        if used > CHAT_HISTORY_TOKENS:
+            break
+        lines.append(line)
+    cache["summary_lines"] = cache["summary_lines"][-len(lines):] if lines else []
+
+    sections = select_analysis_sections(cache["sections"], question, CHAT_CONTEXT_TOKENS)
+    lead = "Answer based on the analysis below."
+    if related:
+        lead += (" You may also use the related past analyses as secondary context, e.g. for comparisons;"
+                 " if they disagree with the current analysis, the current analysis wins.")
+    prompt = [lead, "", "Analysis (relevant sections):", "\n\n".join(sections)]
+    if related:
+        prompt += ["", "Related past analyses (secondary context):", "\n".join(_clip_to_tokens(r, 120) for r in related)]
+    if lines:
+        prompt += ["", "Earlier conversation (summary):", "\n".join(reversed(lines))]
+    if recent:
+        prompt += ["", "Recent conversation:"]
+        for turn in recent:
+            prompt += [f"User: {turn.get('user', '')}", f"Assistant: {_clip_to_tokens(turn.get('assistant', ''), 300)}"]
+    prompt += ["", f"Question: {question}"]
+    return "\n".join(prompt)
 
 
 def build_chat_markdown(convo: List[Dict[str, str]]) -> str:
@@ -287,79 +3177,404 @@ def build_chat_markdown(convo: List[Dict[str, str]]) -> str:
     return "\n".join(lines)
 
 
-def build_pdf_bytes(uploads, summary_text) -> bytes:
+# =============================================================================
+# PDF report (in memory, downscaled images, cached background jobs)
+# =============================================================================
+def _pdf_image(data: bytes, max_w: float, max_h: float) -> Tuple[io.BytesIO, float, float]:
+    """
+    Image sized for the A4 content box → (JPEG buffer, width pt, height pt).
+    The display size is the original (1 px = 1 pt, never enlarged); the pixels
+    are only what PDF_IMAGE_DPI needs at that size.
+    """
+    img = Image.open(io.BytesIO(data))
+    iw, ih = img.size
+    scale = min(max_w / float(iw), max_h / float(ih), 1.0)
+    w_pt, h_pt = iw * scale, ih * scale
+    px = (max(1, round(w_pt * PDF_IMAGE_DPI / 72.0)), max(1, round(h_pt * PDF_IMAGE_DPI / 72.0)))
+    img.draft("RGB", px)                     # JPEG: decode at reduced scale
+    img = _flatten_rgb(img)
+    if img.width > px[0] or img.height > px[1]:
+        img.thumbnail(px, Image.LANCZOS)
+    buf = io.BytesIO()
+    img.save(buf, format="JPEG", quality=PDF_IMAGE_QUALITY, optimize=True)
+    buf.seek(0)
+    return buf, w_pt, h_pt
+
+
+def build_pdf_bytes(uploads, summary_text, progress: Optional[Callable[[float], None]] = None) -> bytes:
     """
     Build a tidy PDF:
-      • Scales each image to fit A4 content box (keeps aspect).
+      • Scales each image to fit A4 content box (keeps aspect), embedded downscaled.
       • Lets long text wrap across pages (Paragraph).
+      • Renders into memory; progress(fraction) is called as images are prepared.
       • Never clears UI state — caller stores result in session.
     """
     if not uploads or not summary_text:
         return b""
 
+    with span("pdf", bytes_in=sum(len(rec["data"]) for rec in uploads)) as sp:
+        styles = getSampleStyleSheet()
+        body = ParagraphStyle(
+            "Body", parent=styles["Normal"], fontName="Helvetica",
+            fontSize=10, leading=14, spaceAfter=8, allowWidowsOrphans=True, splitLongWords=True,
+        )
+        h2 = styles["Heading2"]
+
+        # Page margins
+        left = right = top = bottom = 0.75 * inch
+        page_w, page_h = A4
+        max_img_w = page_w - left - right
+        max_img_h = page_h - top - bottom
+
+        story = [
+            Paragraph("📊 Gemini Chart Analysis Report", styles["Title"]),
+            Spacer(1, 12),
+            Paragraph(f"Generated on: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}", body),
+            Paragraph("Generated by: Chartify", body),
+            Spacer(1, 18),
+        ]
+
+        # Images (most of the work; layout below is the last step)
+        for i, rec in enumerate(uploads, 1):
+            try:
+                story.append(Paragraph(rec.get("name", "Chart"), h2))
+                img_buf, w, h = _pdf_image(rec["data"], max_img_w, max_img_h)
+                story.append(RLImage(img_buf, width=w, height=h))
+                story.append(Spacer(1, 10))
+            except Exception as e:
+                story.append(Paragraph(f"<i>Image error: {e}</i>", body))
+                story.append(Spacer(1, 6))
+            if progress:
+                progress(0.9 * i / len(uploads))
+
+        story.append(PageBreak())
+
+        # Analysis summary (convert newlines for Paragraph)
+        story.append(Paragraph("Analysis Summary", h2))
+        safe_html = (
+            summary_text.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;").replace("\n", "<br/>")
+        )
+        story.append(Paragraph(safe_html, body))
+
+        # Build → return bytes
+        out = io.BytesIO()
+        doc = SimpleDocTemplate(
+            out, pagesize=A4,
+            leftMargin=left, rightMargin=right, topMargin=top, bottomMargin=bottom,
+            title="Gemini Chart Analysis Report", author="Chartify"
+        )
+        doc.build(story)
+        if progress:
+            progress(1.0)
+        sp["bytes_out"] = len(out.getvalue())
+    return out.getvalue()
+
+
+def pdf_cache_key(uploads, summary_text) -> str:
+    """Same charts (by content) + same summary + same image settings → same report."""
+    h = hashlib.sha256(f"pdf:{PDF_IMAGE_DPI}:{PDF_IMAGE_QUALITY}".encode())
+    for rec in uploads:
+        h.update(f"|{rec.get('name', '')}:{rec.get('sha') or hashlib.sha256(rec['data']).hexdigest()}".encode())
+    h.update(b"|")
+    h.update(summary_text.encode("utf-8"))
+    return h.hexdigest()
+
+
+class PdfJob:
+    """
+    A report being built on _PDF_POOL. status: running | done | error.
+    Reports land in `result`; history exports are written to the temp file `path`.
+    """
+
+    def __init__(self, key: str):
+        self.key = key
+        self.status = "running"
+        self.progress = 0.0
+        self.result: bytes = b""
+        self.path = ""
+        self.error = ""
+
+    @property
+    def done(self) -> bool:
+        return self.status != "running"
+
+
+_PDF_CACHE = _ViewCache(PDF_CACHE_MB * 1024 * 1024)
+_PDF_POOL = ThreadPoolExecutor(max_workers=PDF_MAX_WORKERS, thread_name_prefix="pdf")
+_PDF_JOBS: Dict[str, PdfJob] = {}
+_PDF_JOBS_LOCK = threading.Lock()
+
+
+def _run_pdf_job(job: PdfJob, uploads, summary_text) -> None:
+    def _progress(p: float) -> None:
+        job.progress = p
+
+    try:
+        job.result = _PDF_CACHE.get_or_build(
+            job.key, lambda: build_pdf_bytes(uploads, summary_text, progress=_progress), len
+        )
+        job.progress = 1.0
+        job.status = "done"
+    except Exception as e:
+        job.error = str(e)
+        job.status = "error"
+    finally:
+        with _PDF_JOBS_LOCK:
+            _PDF_JOBS.pop(job.key, None)
+
+
+def submit_pdf_report(uploads, summary_text) -> PdfJob:
+    """
+    Start (or join) building the report in the background; poll job.progress/done.
+    A report already built for the same uploads + summary comes back finished.
+    """
+    key = pdf_cache_key(uploads, summary_text)
+    cached = _PDF_CACHE.peek(key)
+    if cached is not None:
+        job = PdfJob(key)
+        job.result, job.progress, job.status = cached, 1.0, "done"
+        return job
+    with _PDF_JOBS_LOCK:
+        job = _PDF_JOBS.get(key)
+        if job is None:
+            job = _PDF_JOBS[key] = PdfJob(key)
+            _PDF_POOL.submit(_run_pdf_job, job, list(uploads), summary_text)
+    return job
+
+# =============================================================================
+# History export (streamed: one record + its thumbnails in memory at a time)
+# =============================================================================
+def iter_history_records(ids: Optional[List[int]] = None, page_size: int = 50) -> Iterator[Dict[str, Any]]:
+    """Full saved runs, newest first (or in `ids` order), fetched one by one."""
+    if ids is not None:
+        for analysis_id in ids:
+            rec = get_analysis(analysis_id)
+            if rec:
+                yield rec
+        return
+    offset = 0
+    while True:
+        page = list_analyses(offset=offset, limit=page_size)
+        if not page:
+            return
+        for row in page:
+            rec = get_analysis(row["id"])
+            if rec:
+                yield rec
+        offset += len(page)
+
+
+def _export_slug(rec: Dict[str, Any]) -> str:
+    words = re.sub(r"[^A-Za-z0-9]+", "-", rec.get("title", "")).strip("-").lower()
+    return f"{rec['id']:05d}-{words[:48].rstrip('-') or 'run'}"
+
+
+def _thumb_source(th: Dict[str, str]) -> Tuple[Optional[str], Optional[bytes], str]:
+    """(file path or None, inline bytes or None, archive name) for a stored or legacy thumbnail."""
+    if th.get("ref"):
+        path = THUMBS.path(th["ref"])
+        return (path if os.path.exists(path) else None), None, th["ref"]
+    if th.get("b64"):
+        data = base64.b64decode(th["b64"])
+        return None, data, f"{hashlib.sha256(data).hexdigest()}.{_MIME_EXT.get(th.get('mime', ''), 'png')}"
+    return None, None, ""
+
+
+def history_record_markdown(rec: Dict[str, Any], thumb_prefix: str = "thumbnails/") -> str:
+    """One saved run as a Markdown document (thumbnails linked under thumb_prefix)."""
+    rec = _with_defaults(rec)
+    lines = [
+        f"# {rec['title'] or 'Untitled run'}",
+        "",
+        f"_{rec.get('ts', '')[:19].replace('T', ' ')} • {rec['analysis_mode']}_",
+        "",
+    ]
+    if rec["combined_insight"]:
+        lines += ["## Combined insight", "", rec["combined_insight"].strip(), ""]
+    for d in rec["analysis_details"]:
+        lines += [f"## {d.get('name', 'Chart')}", ""]
+        lines += [f"> Failed: {d['error']}" if d.get("error") else (d.get("insight") or "").strip(), ""]
+    thumbs = [(th.get("name", ""), _thumb_source(th)[2]) for th in rec["thumbnails"]]
+    if any(name for _, name in thumbs):
+        lines += ["## Charts", ""]
+        lines += [f"![{label}]({thumb_prefix}{name})" for label, name in thumbs if name]
+        lines.append("")
+    return "\n".join(lines)
+
+
+def export_history_markdown_zip(out, ids: Optional[List[int]] = None,
+                                progress: Optional[Callable[[int], None]] = None) -> int:
+    """
+    Write saved runs to `out` (path or binary file) as a zip: one .md per run
+    plus a shared thumbnails/ folder. Returns the number of runs written.
+    """
+    n = 0
+    written = set()
+    with zipfile.ZipFile(out, "w", compression=zipfile.ZIP_DEFLATED) as zf:
+        for rec in iter_history_records(ids):
+            zf.writestr(f"{_export_slug(rec)}.md", history_record_markdown(rec))
+            for th in rec.get("thumbnails", []):
+                path, data, name = _thumb_source(th)
+                if not name or name in written:
+                    continue
+                if path:
+                    zf.write(path, f"thumbnails/{name}", compress_type=zipfile.ZIP_STORED)  # already compressed
+                elif data:
+                    zf.writestr(f"thumbnails/{name}", data, compress_type=zipfile.ZIP_STORED)
+                else:
+                    continue
+                written.add(name)
+            n += 1
+            if progress:
+                progress(n)
+    return n
+
+
+class _LazyFlowables(list):
+    """
+    Flowable list for doc.build() fed from an iterator of chunks: the next chunk
+    is pulled only when the list runs empty, so only one run's flowables are
+    materialized at a time.
+    """
+
+    def __init__(self, chunks: Iterator[List[Any]]):
+        super().__init__()
+        self._chunks = iter(chunks)
+
+    def _fill(self) -> None:
+        while not super().__len__():
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                return
+            self.extend(chunk)
+
+    def __len__(self) -> int:
+        self._fill()
+        return super().__len__()
+
+    def __getitem__(self, i):
+        self._fill()
+        return super().__getitem__(i)
+
+
+def export_history_pdf(out, ids: Optional[List[int]] = None,
+                       progress: Optional[Callable[[int], None]] = None) -> int:
+    """
+    Write saved runs to `out` (path or binary file) as one PDF, a section per run
+    with its thumbnails and insights. Returns the number of runs written.
+    Runs are laid out one at a time, but ReportLab keeps every finished page
+    and embedded thumbnail in memory until the file is saved: peak memory is
+    about 3x the size of the finished PDF (measured: 16 MB for a 5 MB file,
+    158 MB for 52 MB). Use the markdown zip for very large histories.
+    """
     styles = getSampleStyleSheet()
     body = ParagraphStyle(
         "Body", parent=styles["Normal"], fontName="Helvetica",
         fontSize=10, leading=14, spaceAfter=8, allowWidowsOrphans=True, splitLongWords=True,
     )
-    h2 = styles["Heading2"]
-
-    # Page margins
+    h1, h2 = styles["Heading1"], styles["Heading2"]
     left = right = top = bottom = 0.75 * inch
-    page_w, page_h = A4
-    max_img_w = page_w - left - right
-    max_img_h = page_h - top - bottom
-
-    story = [
-        Paragraph("📊 Gemini Chart Analysis Report", styles["Title"]),
-        Spacer(1, 12),
-        Paragraph(f"Generated on: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}", body),
-        Paragraph("Generated by: Chartify", body),
-        Spacer(1, 18),
-    ]
+    cell_w = (A4[0] - left - right) / 3.0
+    count = [0]
+
+    def _para(text: str, style) -> Paragraph:
+        return Paragraph(text.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;").replace("\n", "<br/>"), style)
+
+    def _thumb_cell(th: Dict[str, str]):
+        path, data, _ = _thumb_source(th)
+        src = path or (io.BytesIO(data) if data else None)
+        if src is None:
+            return _para(f"{th.get('name', '')} (thumbnail missing)", body)
+        iw, ih = ImageReader(src).getSize()
+        if not path:
+            src.seek(0)
+        scale = min((cell_w - 8) / float(iw), 120.0 / float(ih), 1.0)
+        return RLImage(src, width=iw * scale, height=ih * scale, lazy=2)   # file opened only while drawn
+
+    def _sections() -> Iterator[List[Any]]:
+        for rec in iter_history_records(ids):
+            rec = _with_defaults(rec)
+            flow: List[Any] = [] if count[0] == 0 else [PageBreak()]
+            flow += [
+                _para(rec["title"] or "Untitled run", h1),
+                _para(f"{rec.get('ts', '')[:19].replace('T', ' ')} • {rec['analysis_mode']}", body),
+            ]
+            cells = [_thumb_cell(th) for th in rec["thumbnails"]]
+            if cells:
+                rows = [cells[i:i + 3] + [""] * (3 - len(cells[i:i + 3])) for i in range(0, len(cells), 3)]
+                flow += [Table(rows, colWidths=[cell_w] * 3), Spacer(1, 10)]
+            if rec["combined_insight"]:
+                flow += [_para("Combined insight", h2), _para(rec["combined_insight"], body)]
+            for d in rec["analysis_details"]:
+                text = f"Failed: {d['error']}" if d.get("error") else d.get("insight", "")
+                flow += [_para(d.get("name", "Chart"), h2), _para(text, body)]
+            count[0] += 1
+            if progress:
+                progress(count[0])
+            yield flow
+
+    def _chunks() -> Iterator[List[Any]]:
+        yield from _sections()
+        if count[0] == 0:
+            yield [_para("No saved analyses.", body)]
+
+    doc = SimpleDocTemplate(
+        out, pagesize=A4, pageCompression=1,
+        leftMargin=left, rightMargin=right, topMargin=top, bottomMargin=bottom,
+        title="Chart Analysis History", author="Chartify"
+    )
+    doc.build(_LazyFlowables(_chunks()))
+    return count[0]
 
-    # Images
-    for rec in uploads:
-        try:
-            story.append(Paragraph(rec.get("name", "Chart"), h2))
-            img_bytes = io.BytesIO(rec["data"])
-            iw, ih = ImageReader(img_bytes).getSize()
-            scale = min(max_img_w / float(iw), max_img_h / float(ih), 1.0)
-            img_bytes.seek(0)
-            story.append(RLImage(img_bytes, width=iw * scale, height=ih * scale))
-            story.append(Spacer(1, 10))
-        except Exception as e:
-            story.append(Paragraph(f"<i>Image error: {e}</i>", body))
-            story.append(Spacer(1, 6))
 
-    story.append(PageBreak())
+_EXPORT_PREFIX = "chartify-export-"
 
-    # Analysis summary (convert newlines for Paragraph)
-    story.append(Paragraph("Analysis Summary", h2))
-    safe_html = (
-        summary_text.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;").replace("\n", "<br/>")
-    )
-    story.append(Paragraph(safe_html, body))
 
-    # Build → return bytes
-    tmp = tempfile.NamedTemporaryFile(delete=False, suffix=".pdf")
-    tmp_path = tmp.name
-    tmp.close()
+def _run_export_job(job: PdfJob, fmt: str, ids: Optional[List[int]]) -> None:
+    total = len(ids) if ids is not None else count_analyses()
+
+    def _progress(n: int) -> None:
+        job.progress = min(1.0, n / max(1, total))
+
+    fd, path = tempfile.mkstemp(prefix=_EXPORT_PREFIX, suffix=f".{fmt}")
+    os.close(fd)
     try:
-        doc = SimpleDocTemplate(
-            tmp_path, pagesize=A4,
-            leftMargin=left, rightMargin=right, topMargin=top, bottomMargin=bottom,
-            title="Gemini Chart Analysis Report", author="Chartify"
-        )
-        doc.build(story)
-        with open(tmp_path, "rb") as f:
-            return f.read()
-    finally:
+        export = export_history_pdf if fmt == "pdf" else export_history_markdown_zip
+        export(path, ids=ids, progress=_progress)
+        job.path = path
+        job.progress = 1.0
+        job.status = "done"
+    except Exception as e:
+        os.remove(path)
+        job.error = str(e)
+        job.status = "error"
+
+
+def _sweep_exports() -> None:
+    """Drop export files older than JOB_RETENTION_S (sessions that never downloaded theirs)."""
+    cutoff = time.time() - JOB_RETENTION_S
+    tmp = tempfile.gettempdir()
+    for name in os.listdir(tmp):
+        path = os.path.join(tmp, name)
         try:
-            os.unlink(tmp_path)
-        except Exception:
+            if name.startswith(_EXPORT_PREFIX) and os.path.getmtime(path) < cutoff:
+                os.remove(path)
+        except OSError:
             pass
 
+
+def submit_history_export(fmt: str, ids: Optional[List[int]] = None) -> PdfJob:
+    """
+    Build a bulk history export ("pdf" or "zip") on _PDF_POOL into a temp file
+    (job.path, removed after JOB_RETENTION_S); poll it like a submit_pdf_report()
+    job. Never cached: the history changes between exports.
+    """
+    _sweep_exports()
+    job = PdfJob(f"export:{fmt}:{uuid.uuid4().hex[:12]}")
+    _PDF_POOL.submit(_run_export_job, job, fmt, list(ids) if ids is not None else None)
+    return job
+
+
 def blue_theme_css():
     st.markdown("""
     <style>
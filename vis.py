@@ -1,7 +1,7 @@
 # app.py — Chartify: Minimal 3-tab app with hidden preview + chat download
 # -----------------------------------------------------------------------
 # Quick Start:
-#   1) pip install streamlit python-dotenv pillow tinydb reportlab google-genai groq
+#   1) pip install streamlit python-dotenv pillow reportlab google-genai groq
 #   2) put GEMINI_API_KEY=... and GROQ_API_KEY=... in a .env file
 #   3) streamlit run app.py
 #
@@ -12,24 +12,26 @@
 # -----------------------------------------------------------------------
 
 import os
-from typing import List, Dict, Any
+import base64
+import uuid
 
 import streamlit as st
 from dotenv import load_dotenv
 from PIL import Image
-from tinydb import TinyDB, where
 
 # Import only what we actually use from tools.py
 from tools import (
-    blue_theme_css, decode_uploaded_files, build_pdf_bytes,
-    generate_individual_insight_from_rec, generate_cross_chart_insight,
-    save_analysis, load_latest_analysis, load_analyses,
-    make_thumbnails, thumbnails_gallery, build_chat_markdown, _clear_current_run
+    blue_theme_css, decode_uploaded_files, submit_pdf_report, stream_with_backend,
+    load_latest_analysis, delete_analysis, clear_analyses,
+    list_analyses, count_analyses, get_analysis,
+    thumbnails_gallery, build_chat_markdown, _clear_current_run,
+    INSIGHT_CACHE, preprocessing_report, format_bytes, backend_health,
+    MODEL_CHOICES, router_snapshot, CROSS_MAP_REDUCE_THRESHOLD, CROSS_MAP_BATCH_SIZE,
+    build_chat_prompt, search_analyses, related_past_insights,
+    submit_history_export,
+    METRICS, JOBS, FLIGHTS, RATE_LIMITER, rate_owner, interrupted_analyses,
 )
 
-# Local DB handle (same filename as tools.py uses)
-DB = TinyDB("analysis_history_db.json")
-
 # =============================================================================
 # Streamlit page + theme
 # =============================================================================
@@ -42,14 +44,25 @@ blue_theme_css()
 # Session State (what we keep between reruns)
 # =============================================================================
 def _init_state():
-    st.session_state.setdefault("uploads", [])                 # [{name, data, img, b64, mime}]
+    st.session_state.setdefault("uploads", [])                 # [UploadRecord(name, data, sha) → img/b64/mime derived]
+    st.session_state.setdefault("upload_cache", {})            # file_id:sha → UploadRecord, reused across reruns
     st.session_state.setdefault("analysis_summary", "")
     st.session_state.setdefault("analysis_details", [])        # [{name, insight}]
     st.session_state.setdefault("combined_insight", "")
     st.session_state.setdefault("analysis_done", False)
     st.session_state.setdefault("pdf_bytes", None)
+    st.session_state.setdefault("pdf_job", None)                # PdfJob while a report is being built
+    st.session_state.setdefault("pdf_polling", False)
+    st.session_state.setdefault("history_export", None)         # (temp file path, file name, mime) of the last bulk export
+    st.session_state.setdefault("history_export_job", None)     # (PdfJob, file name, mime) while an export is built
+    st.session_state.setdefault("history_export_polling", False)
+    st.session_state.setdefault("last_perf", None)               # summarize_trace() of the latest run
+    st.session_state.setdefault("active_job", None)              # id of this session's latest analysis job
+    st.session_state.setdefault("job_adopted", None)             # job id whose results are in the session
+    st.session_state.setdefault("job_error", "")                 # failure message of the adopted job
     st.session_state.setdefault("latest_thumbs", [])
-    st.session_state.setdefault("rendered_inline", False)      # prevents double-render after progressive flow
+    st.session_state.setdefault("current_mode", "Single Chart Analysis")  # mode of the run shown under Home
+    st.session_state.setdefault("session_key", uuid.uuid4().hex)  # fair-share identity for the model rate limiter
 
     # settings
     st.session_state.setdefault("model_name", "gemini-2.0-flash")  # default
@@ -65,14 +78,13 @@ def _init_state():
 
     # Ask tab chat (not persisted)
     st.session_state.setdefault("conversation", [])            # [{user, assistant}]
+    st.session_state.setdefault("chat_context_cache", {})      # parsed sections + rolling chat summary
 
 _init_state()
 
-# Supported models (one Google, one Groq multimodal)
-MODEL_CHOICES = [
-    "gemini-2.0-flash",
-    "meta-llama/llama-4-scout-17b-16e-instruct",
-]
+# History tab page size (rows rendered per rerun)
+HISTORY_PAGE_SIZE = 20
+
 
 # =============================================================================
 # Sidebar (Settings, Exports, Chat download)
@@ -108,8 +120,9 @@ with st.sidebar:
     # Audience tone
     st.session_state.audience = st.selectbox(
         "Select that suits you : ",
-        ["Business Person", "Tech Person"],
+        ["Business Professional", "Data Scientist"],    # the values the prompts branch on
         index=0 if st.session_state.audience == "Business Professional" else 1,
+        format_func={"Business Professional": "Business Person", "Data Scientist": "Tech Person"}.get,
         help="Tunes wording and emphasis in the insights."
     )
 
@@ -132,20 +145,42 @@ with st.sidebar:
         if not st.session_state.uploads or not st.session_state.analysis_summary:
             st.warning("No analysis to export yet. Upload and run analysis first.")
             st.session_state.pdf_bytes = None
+            st.session_state.pdf_job = None
         else:
-            st.session_state.pdf_bytes = build_pdf_bytes(
+            # Built off the script thread; an unchanged report comes straight from cache
+            st.session_state.pdf_bytes = None
+            st.session_state.pdf_job = submit_pdf_report(
                 st.session_state.uploads, st.session_state.analysis_summary
             )
-            st.toast("📄 PDF is ready — click Download.", icon="✅")
 
-    if st.session_state.get("pdf_bytes"):
-        st.download_button(
-            "Download PDF Report",
-            data=st.session_state.pdf_bytes,
-            file_name="Chart_Analysis_Report.pdf",
-            mime="application/pdf",
-            key="pdf_dl_btn"
-        )
+    def _pdf_export_panel():
+        job = st.session_state.get("pdf_job")
+        if job is not None and job.done:
+            st.session_state.pdf_job = None
+            if job.status == "done":
+                st.session_state.pdf_bytes = job.result
+                st.toast("📄 PDF is ready — click Download.", icon="✅")
+            else:
+                st.error(f"PDF export failed: {job.error}")
+            if st.session_state.pdf_polling:
+                st.session_state.pdf_polling = False
+                st.rerun()                    # full rerun drops the polling fragment
+        elif job is not None:
+            st.progress(job.progress, text=f"Building PDF… {int(job.progress * 100)}%")
+
+        if st.session_state.get("pdf_bytes"):
+            st.download_button(
+                "Download PDF Report",
+                data=st.session_state.pdf_bytes,
+                file_name="Chart_Analysis_Report.pdf",
+                mime="application/pdf",
+                key="pdf_dl_btn"
+            )
+
+    # Poll only while a job is running
+    running = st.session_state.get("pdf_job") is not None and not st.session_state.pdf_job.done
+    st.session_state.pdf_polling = running
+    st.fragment(_pdf_export_panel, run_every=0.5 if running else None)()
 
     st.divider()
     st.subheader("💬 Conversation")
@@ -161,6 +196,37 @@ with st.sidebar:
     else:
         st.caption("No chat yet — ask a follow-up on the **Chat Bot** tab to enable download.")
 
+    st.divider()
+    cache_stats = INSIGHT_CACHE.stats()
+    st.caption(
+        f"⚡ Insight cache: {cache_stats['hits']} hits · {cache_stats['misses']} misses · "
+        f"{cache_stats['size']} stored"
+    )
+    flight_stats = FLIGHTS.stats()
+    if flight_stats["coalesced"]:
+        st.caption(
+            f"🔗 Shared model calls: {flight_stats['coalesced']} request(s) joined an identical call in flight"
+        )
+    st.caption("🩺 Backends: " + " · ".join(f"{name} {state}" for name, state in backend_health().items()))
+    job_stats = JOBS.stats()
+    if job_stats["running"] or job_stats["queued"]:
+        st.caption(f"🧵 Analysis jobs: {job_stats['running']} running · {job_stats['queued']} queued")
+    for model, quota in RATE_LIMITER.snapshot().items():
+        if quota["queued"] or quota["wait_s"]:
+            st.caption(
+                f"⏳ {model.split('/')[-1]} quota: {quota['queued']} call(s) queued from "
+                f"{quota['sessions']} session(s) · ~{quota['wait_s']:.0f}s wait"
+            )
+    for model, stats in router_snapshot().items():
+        if stats["n"]:
+            st.caption(
+                f"{'⚠️' if stats['degraded'] else '🟢'} {model.split('/')[-1]}: "
+                f"p90 {stats['p90_s'] or '–'}s · {stats['error_rate']:.0%} errors (last {stats['n']})"
+            )
+
+    show_perf = st.toggle("⏱️ Performance panel", key="show_perf")
+    perf_slot = st.container()          # filled at the end of the script, after any run
+
 # =============================================================================
 # Tabs
 # =============================================================================
@@ -178,9 +244,19 @@ with home_tab:
         help="Accepted: PNG, JPG/JPEG, WEBP, BMP."
     )
     if files:
-        decoded = decode_uploaded_files(files)
+        decoded = decode_uploaded_files(files, cache=st.session_state.upload_cache)
         if decoded:
             st.session_state.uploads = decoded
+    if st.session_state.uploads:
+        report = preprocessing_report(st.session_state.uploads)
+        if report:
+            with st.expander(report, expanded=False):
+                for rec in st.session_state.uploads:
+                    saved = rec.get("bytes_in", 0) - rec.get("bytes_model", 0)
+                    st.caption(
+                        f"{rec['name']}: {format_bytes(rec.get('bytes_in', 0))} → "
+                        f"{format_bytes(rec.get('bytes_model', 0))} (saved {format_bytes(saved)})"
+                    )
 
     analyze = st.button("🔍 Run Analysis", type="primary")
 
@@ -197,91 +273,143 @@ with home_tab:
         if not st.session_state.uploads:
             st.error("Please upload charts to analyze.")
         else:
-            model_name   = st.session_state.model_name
-            audience     = st.session_state.audience
-            output_style = st.session_state.output_style
-            mode         = st.session_state.analysis_mode
-
-            # Reset current outputs
+            # Reset current outputs; the run itself happens on a background job
+            # (survives reruns and setting changes, and is saved to History when done)
             st.session_state.analysis_details = []
             st.session_state.combined_insight = ""
             st.session_state.analysis_summary = ""
+            st.session_state.analysis_done = False
             st.session_state.pdf_bytes = None
-            st.session_state.latest_thumbs = make_thumbnails(st.session_state.uploads)
-            st.session_state.rendered_inline = False
-
-            summary_blocks: List[str] = []
-
-            if mode == "Single Chart Analysis":
-                # Progressive rendering area
-                st.markdown("### 📈 Current Result")
-                results_area = st.container()
-
-                for rec in st.session_state.uploads:
-                    with results_area:
-                        st.markdown(f"#### {rec['name']}")
-                        col1, col2 = st.columns([1, 2])
-
-                        with col1:
-                            st.image(rec["img"], caption="Chart", use_container_width=True)
-
-                        with col2:
-                            insight_placeholder = st.empty()
-                            with st.spinner(f"Analyzing {rec['name']}…"):
-                                insight = generate_individual_insight_from_rec(
-                                    rec, audience, model_name, output_style
-                                )
-                            # show immediately
-                            insight_placeholder.markdown(insight)
-
-                    # update session + summary as we go (immediate persistence)
-                    st.session_state.analysis_details.append({"name": rec["name"], "insight": insight})
-                    summary_blocks.append(f"**{rec['name']}**\n\n{insight}")
-
-                # finalize shared summary for PDF/Chat
-                st.session_state.analysis_summary = "\n\n---\n\n".join(summary_blocks)
-                st.session_state.analysis_done = True
-                st.session_state.rendered_inline = True
-                st.toast("✅ Analysis complete.", icon="✅")
-
-                # Save to history with thumbnails + auto title
-                save_analysis({
-                    "analysis_mode": st.session_state.analysis_mode,
-                    "analysis_summary": st.session_state.analysis_summary,
-                    "analysis_details": st.session_state.analysis_details,
-                    "combined_insight": st.session_state.combined_insight,
-                    "thumbnails": st.session_state.latest_thumbs,
-                })
+            st.session_state.pdf_job = None
+            st.session_state.latest_thumbs = []
+            st.session_state.job_error = ""
+            st.session_state.active_job = JOBS.submit(
+                st.session_state.uploads, st.session_state.analysis_mode, st.session_state.model_name,
+                st.session_state.audience, st.session_state.output_style,
+                owner=st.session_state.session_key,
+            )
 
-            else:
-                # Cross mode stays as a single combined call (cannot stream parts easily)
-                with st.spinner("Aggregating cross-chart insights…"):
-                    combined = generate_cross_chart_insight(
-                        st.session_state.uploads, audience, model_name, output_style
-                    )
-                st.session_state.combined_insight = combined
-                st.session_state.analysis_summary = combined
-                st.session_state.analysis_done = True
-                st.toast("✅ Analysis complete.", icon="✅")
-
-                save_analysis({
-                    "analysis_mode": st.session_state.analysis_mode,
-                    "analysis_summary": st.session_state.analysis_summary,
-                    "analysis_details": st.session_state.analysis_details,
-                    "combined_insight": st.session_state.combined_insight,
-                    "thumbnails": st.session_state.latest_thumbs,
-                })
-
-    # Render the CURRENT run (no history here) — skip if we already rendered inline
+    def _adopt_job(snap):
+        """Copy a finished job into the session's current run (once)."""
+        st.session_state.job_adopted = snap["id"]
+        st.session_state.last_perf = snap["perf"]
+        if snap["status"] == "failed":
+            st.session_state.job_error = snap["error"] or "Analysis failed."
+            st.session_state.analysis_details = snap["details"]
+        same_uploads = snap["shas"] == [r["sha"] for r in st.session_state.uploads]
+        if snap["summary"] and same_uploads:
+            st.session_state.analysis_details = snap["details"]
+            st.session_state.analysis_summary = snap["summary"]
+            st.session_state.combined_insight = snap["combined"] if snap["mode"].startswith("Cross") else ""
+            st.session_state.latest_thumbs = snap["thumbnails"]
+            st.session_state.current_mode = snap["mode"]
+            st.session_state.analysis_done = True
+        failed = sum(1 for d in snap["details"] if d.get("error"))
+        if snap["status"] == "done":
+            st.toast(f"⚠️ {failed} chart(s) failed; saved the rest." if failed else "✅ Analysis complete.", icon="✅")
+        elif snap["status"] == "cancelled":
+            st.toast("⏹️ Analysis cancelled — finished charts were saved to History." if snap["summary"]
+                     else "⏹️ Analysis cancelled.", icon="⏹️")
+
+    def _job_panel():
+        job = JOBS.get(st.session_state.active_job)
+        if job is None or st.session_state.job_adopted == job.id:
+            return
+        snap = job.snapshot()
+        if job.done:
+            _adopt_job(snap)
+            st.rerun()                        # full rerun: the regular current-run view takes over
+        total, completed = snap["total"], snap["completed"]
+
+        col_p, col_c = st.columns([0.8, 0.2])
+        with col_p:
+            label = {"queued": "⏳ Queued…", "running": f"Analyzing {completed}/{total} chart(s)…"}.get(
+                snap["status"], snap["status"].capitalize())
+            st.progress(completed / max(1, total), text=label)
+            if not job.done:
+                wait_s = RATE_LIMITER.expected_wait(snap["model"], requests=max(1, total - completed))
+                if wait_s >= 1:
+                    st.caption(f"⏳ Shared rate limit for {snap['model'].split('/')[-1]}: ~{wait_s:.0f}s expected wait")
+        with col_c:
+            if not job.done and st.button("⏹️ Cancel", key=f"cancel_{job.id}", use_container_width=True):
+                JOBS.cancel(job.id)
+
+        if snap["mode"].startswith("Single"):
+            st.markdown("### 📈 Current Result")
+            thumbs = {th["name"]: th["b64"] for th in snap["thumbnails"]}
+            for i, name in enumerate(snap["names"]):
+                st.markdown(f"#### {name}")
+                col1, col2 = st.columns([1, 2])
+                with col1:
+                    if name in thumbs:
+                        st.image(base64.b64decode(thumbs[name]), caption="Chart", use_container_width=True)
+                with col2:
+                    text = snap["texts"][i]
+                    if snap["finished"][i] and snap["errors"][i]:
+                        st.error(snap["errors"][i])
+                    elif snap["finished"][i]:
+                        st.markdown(text or "_Skipped._")
+                    elif text:
+                        st.markdown(text + " ▌")
+                    else:
+                        st.caption(f"⏳ Analyzing {name}…")
+        else:
+            if total > CROSS_MAP_REDUCE_THRESHOLD and not snap["combined"]:
+                st.caption(
+                    f"Large batch ({total} charts): summarizing in parallel "
+                    f"batches of {CROSS_MAP_BATCH_SIZE}, then combining the summaries."
+                )
+            if snap["combined"]:
+                st.subheader("🧠 Combined Cross-Chart Insights")
+                st.markdown(snap["combined"] + ("" if job.done else " ▌"))
+
+
+    # Poll only while the session's job is still going
+    active = JOBS.get(st.session_state.active_job)
+    polling = active is not None and not active.done
+    st.fragment(_job_panel, run_every=0.5 if polling else None)()
+
+    # Single-chart runs cut off midway (e.g. a server restart) keep their finished charts
+    if not polling:
+        for run in interrupted_analyses():
+            col_i, col_r, col_d = st.columns([0.6, 0.2, 0.2])
+            with col_i:
+                st.warning(
+                    f"⏸️ Interrupted run ({run['started'][:16].replace('T', ' ')}): "
+                    f"{run['completed']}/{run['total']} chart(s) saved · {run['model'].split('/')[-1]}"
+                )
+            with col_r:
+                if st.button("▶️ Resume", key=f"resume_{run['id']}", use_container_width=True):
+                    job_id = JOBS.resume(run["id"], owner=st.session_state.session_key)
+                    if job_id:
+                        # charts whose parked upload is gone stay in History as errors only
+                        st.session_state.uploads = [r for r in JOBS.get(job_id).recs if r.data]
+                        st.session_state.analysis_done = False
+                        st.session_state.pdf_bytes = None
+                        st.session_state.pdf_job = None
+                        st.session_state.job_error = ""
+                        st.session_state.active_job = job_id
+                    st.rerun()
+            with col_d:
+                if st.button("🗑️ Discard", key=f"discard_{run['id']}", use_container_width=True):
+                    delete_analysis(run["id"])
+                    st.rerun()
+
+    if st.session_state.job_error:
+        st.error(st.session_state.job_error)
+        for d in st.session_state.analysis_details:
+            if d.get("error"):
+                st.caption(f"{d['name']}: {d['error']}")
+
+    # Render the CURRENT run (no history here); a run in progress is shown by the job panel
     if (
         st.session_state.analysis_done
         and st.session_state.analysis_summary
         and st.session_state.uploads
-        and not st.session_state.get("rendered_inline")
     ):
-        if st.session_state.analysis_mode == "Single Chart Analysis":
+        if st.session_state.current_mode == "Single Chart Analysis":
             st.markdown("### 📈 Current Result")
-            name_to_insight = {d["name"]: d["insight"] for d in st.session_state.analysis_details}
+            name_to_insight = {d["name"]: d["insight"] or d.get("error", "") for d in st.session_state.analysis_details}
             for rec in st.session_state.uploads:
                 st.markdown(f"#### {rec['name']}")
                 col1, col2 = st.columns([1, 2])
@@ -319,16 +447,24 @@ with ask_tab:
                 st.rerun()
 
         if user_input:
-            # IMPORTANT: We answer strictly from the analysis summary (no images here)
-            context = latest.get("analysis_summary", "")
-            prompt = f"Answer based only on the analysis below.\n\n{context}\n\nQuestion: {user_input}"
+            # IMPORTANT: We answer strictly from the analysis (no images here); the
+            # prompt carries only the relevant sections + a bounded chat summary
+            prompt = build_chat_prompt(
+                latest, st.session_state.conversation, user_input, cache=st.session_state.chat_context_cache,
+                related=related_past_insights(user_input, exclude_id=latest.get("id")),
+            )
             parts = [{"text": prompt}]
-            with st.spinner("Thinking…"):
-                from tools import _generate_with_backend  # import here to keep top clean
-                try:
-                    answer = _generate_with_backend(st.session_state.model_name, parts)
-                except Exception as e:
-                    answer = f"API Error: {e}"
+            st.chat_message("user").markdown(user_input)
+            answer_box = st.chat_message("assistant").empty()
+            answer = ""
+            try:
+                with rate_owner(st.session_state.session_key):
+                    for piece in stream_with_backend(st.session_state.model_name, parts):
+                        answer += piece
+                        answer_box.markdown(answer + " ▌")
+            except Exception as e:
+                answer += ("\n\n" if answer else "") + f"API Error: {e}"
+            answer = answer.strip()
             st.session_state.conversation.append({"user": user_input, "assistant": answer})
             st.toast("💬 Answer added to chat.", icon="✅")
             st.rerun()
@@ -347,23 +483,85 @@ with ask_tab:
 with history_tab:
     st.header("📚 Past Runs")
 
-    analyses_tbl = DB.table("analyses")
-    items = load_analyses()
+    total = count_analyses()
 
     # Clear All
-    if items:
+    if total:
         col1, col2 = st.columns([0.85, 0.15])
         with col1:
-            st.caption(f"Showing {len(items)} saved analyses.")
+            st.caption(f"{total} saved analyses.")
         with col2:
             if st.button("🧹 Clear All History", use_container_width=True):
-                analyses_tbl.truncate()
+                clear_analyses()
                 st.toast("🧽 All history cleared from database.", icon="✅")
                 st.rerun()
     else:
         st.info("No saved analyses yet.")
 
-    # Cards
+    query = st.text_input("🔎 Search past runs", placeholder="e.g. revenue drop, churn, Q3…") if total else ""
+    if query.strip():
+        # BM25 hits from the local index (best first)
+        items = search_analyses(query, k=HISTORY_PAGE_SIZE)
+        st.caption(f"{len(items)} match(es) for “{query.strip()}”.")
+    else:
+        # One page of lightweight rows (id/ts/title/mode) — full records load on demand
+        n_pages = max(1, -(-total // HISTORY_PAGE_SIZE))
+        page = 1
+        if n_pages > 1:
+            page = int(st.number_input(f"Page (of {n_pages})", min_value=1, max_value=n_pages, value=1, step=1))
+        items = list_analyses(offset=(page - 1) * HISTORY_PAGE_SIZE, limit=HISTORY_PAGE_SIZE)
+
+    # Bulk export (records + thumbnails are streamed from storage one run at a time)
+    if total:
+        with st.expander("📦 Export runs", expanded=False):
+            fmt = st.radio("Format", ["PDF (one file)", "Markdown (zip)"], horizontal=True, key="hist_export_fmt")
+            scope = st.radio("Runs", [f"All {total} runs", f"The {len(items)} listed below"],
+                             horizontal=True, key="hist_export_scope")
+            if st.button("Build export", key="hist_export_btn"):
+                # Built on the PDF worker pool, off the script thread, like the sidebar report
+                ids = None if scope.startswith("All") else [h["id"] for h in items]
+                if st.session_state.history_export and os.path.exists(st.session_state.history_export[0]):
+                    os.remove(st.session_state.history_export[0])
+                st.session_state.history_export = None
+                if fmt.startswith("PDF"):
+                    st.session_state.history_export_job = (
+                        submit_history_export("pdf", ids), "Chart_Analysis_History.pdf", "application/pdf")
+                else:
+                    st.session_state.history_export_job = (
+                        submit_history_export("zip", ids), "Chart_Analysis_History.zip", "application/zip")
+
+            def _history_export_panel():
+                pending = st.session_state.get("history_export_job")
+                if pending is not None and pending[0].done:
+                    job, fname, mime = pending
+                    st.session_state.history_export_job = None
+                    if job.status == "done":
+                        st.session_state.history_export = (job.path, fname, mime)
+                    else:
+                        st.error(f"Export failed: {job.error}")
+                    if st.session_state.history_export_polling:
+                        st.session_state.history_export_polling = False
+                        st.rerun()                # full rerun drops the polling fragment
+                elif pending is not None:
+                    st.progress(pending[0].progress, text=f"Exporting… {int(pending[0].progress * 100)}%")
+
+                if st.session_state.get("history_export"):
+                    path, fname, mime = st.session_state.history_export
+                    if os.path.exists(path):
+                        with open(path, "rb") as f:
+                            st.download_button(f"Download {fname}", data=f, file_name=fname, mime=mime,
+                                               key="hist_export_dl")
+                    else:
+                        st.session_state.history_export = None     # swept after JOB_RETENTION_S
+
+            # Poll only while an export is running
+            pending = st.session_state.get("history_export_job")
+            running = pending is not None and not pending[0].done
+            st.session_state.history_export_polling = running
+            st.fragment(_history_export_panel, run_every=0.5 if running else None)()
+
+    # Cards (a run a live job is still writing to is cancelled from its job panel, not deleted here)
+    live_ids = JOBS.active_analysis_ids()
     for h in items:
         ts = h.get("ts", "")[:19].replace("T", " ")
         title = h.get("title") or ("Single" if h.get("analysis_mode", "").startswith("Single") else "Cross")
@@ -373,14 +571,47 @@ with history_tab:
         with cols[0]:
             exp = st.expander(label, expanded=False)
         with cols[1]:
-            # Use timestamp as stable key for delete
-            if st.button("✖️", key=f"del_{ts}"):
-                analyses_tbl.remove(where("ts") == h["ts"])
+            # Use the store id as stable key for delete
+            if st.button("✖️", key=f"del_{h['id']}", disabled=h["id"] in live_ids):
+                delete_analysis(h["id"])
                 st.toast(f"Deleted history entry from {ts}", icon="🗑️")
                 st.rerun()
 
         with exp:
-            if h.get("thumbnails"):
-                thumbnails_gallery(h["thumbnails"])
-                st.markdown("---")
-            st.markdown(h.get("analysis_summary", ""))
+            if h.get("snippet"):
+                st.caption(h["snippet"])
+            # Streamlit renders collapsed expanders too, so the record and its
+            # thumbnails are only fetched once the user asks for them.
+            if st.toggle("Show details", key=f"hist_open_{h['id']}"):
+                full = get_analysis(h["id"])
+                if full.get("thumbnails"):
+                    thumbnails_gallery(full["thumbnails"])
+                    st.markdown("---")
+                st.markdown(full.get("analysis_summary", ""))
+                perf = full.get("perf")
+                if perf:
+                    gen = perf["stages"].get("generate", {})
+                    st.caption(
+                        f"⏱️ {perf.get('wall_ms', 0) / 1000:.1f}s · {gen.get('calls', 0)} model call(s) · "
+                        f"{gen.get('tokens_in', 0):,} → {gen.get('tokens_out', 0):,} tokens"
+                    )
+
+# =============================================================================
+# Performance panel (rendered last so it reflects a run made in this rerun)
+# =============================================================================
+if show_perf:
+    with perf_slot:
+        last = st.session_state.last_perf
+        if last:
+            st.caption(f"Last run: {last.get('wall_ms', 0) / 1000:.2f}s wall (stage times summed across workers)")
+            st.dataframe([{"stage": k, **v} for k, v in last["stages"].items()], hide_index=True)
+        rows = METRICS.snapshot()
+        if rows:
+            st.caption("Since process start")
+            st.dataframe(rows, hide_index=True)
+            st.download_button(
+                "Download Prometheus metrics", data=METRICS.prometheus_text(),
+                file_name="chartify_metrics.prom", mime="text/plain", key="perf_prom_dl",
+            )
+        elif not last:
+            st.caption("No timings yet — run an analysis.")